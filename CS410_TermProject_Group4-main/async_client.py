@@ -0,0 +1,161 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import paramiko
+
+import sftp_client
+import stream_diff
+
+# Blocking calls run at the same time per client.
+DEFAULT_ASYNC_WORKERS = 8
+# Diff hunks computed ahead of the consumer before the diff thread waits.
+DIFF_QUEUE_HUNKS = 16
+
+class AsyncSftpClient:
+    """
+    Awaitable facade over sftp_client.  Every call runs on the client's own
+    thread pool so the event loop never blocks on paramiko.
+
+    Calls on one connection are serialized per SFTP channel: with ssh each
+    pool thread opens its own channel on the shared transport (see
+    sftp_client.WorkerChannels), without it all calls take turns on sftp.
+
+    Cancelling a task that awaits a call which has not started yet removes
+    it from the queue.  A call already running in a thread can not be
+    interrupted; it runs to completion and its result is dropped.
+
+        async with AsyncSftpClient(sftp, ssh) as client:
+            entries, found = await asyncio.gather(client.ls('/var/log'),
+                                                  client.search('/var/log', '*.gz'))
+    """
+
+    def __init__(self, sftp: paramiko.SFTPClient, ssh: paramiko.SSHClient = None,
+                 max_workers: int = DEFAULT_ASYNC_WORKERS):
+        self.sftp = sftp
+        self.ssh = ssh
+        self._channels = sftp_client.WorkerChannels(sftp, ssh)
+        self._pool = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='sftp-async')
+        self._tasks = set()
+        self._closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.close()
+
+    # Run func(channel, *args, **kwargs) on the pool, where channel is the
+    # worker thread's SFTP channel.  Any sftp_client function that takes
+    # the client as its first argument can be awaited this way.
+    async def run(self, func, *args, **kwargs):
+        if self._closed:
+            raise RuntimeError("AsyncSftpClient is closed")
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            return await loop.run_in_executor(self._pool, functools.partial(self._call, func, *args, **kwargs))
+        finally:
+            self._tasks.discard(task)
+
+    def _call(self, func, *args, **kwargs):
+        with self._channels.use() as channel:
+            return func(channel, *args, **kwargs)
+
+    # Entries (sftp_client.FileEntry) of a remote directory, through the
+    # listing cache unless fresh is set.  Options are passed to
+    # sftp_client.list_entries (list_all, pattern, sort, ...).
+    async def ls(self, path: str = '.', fresh: bool = False, **options) -> list:
+        return await self.run(_list, path, fresh=fresh, **options)
+
+    # Download into ./downloads like sftp_client.get_file.  Options are
+    # passed through (large_file, segments, resume, delta, compress, ...).
+    async def get(self, remote_path: str, **options) -> bool:
+        return await self.run(sftp_client.get_file, remote_path, ssh=self.ssh, **options)
+
+    # Upload local_path into the remote directory remote_dir like
+    # sftp_client.put_file.  Options are passed through.
+    async def put(self, local_path: str, remote_dir: str, **options) -> bool:
+        return await self.run(sftp_client.put_file, local_path, remote_dir, ssh=self.ssh, **options)
+
+    async def rm(self, path: str) -> int:
+        return await self.run(sftp_client.rm, path)
+
+    # Remote paths under remote_dir whose name matches file_pattern.
+    async def search(self, remote_dir: str, file_pattern: str, max_depth: int = None, exclude=(),
+                     fresh: bool = False) -> list:
+        return await self.run(sftp_client.search_files_remote, remote_dir, file_pattern, self.ssh,
+                              max_depth, exclude, fresh=fresh, echo=False)
+
+    # Yield the unified diff hunks (lists of lines, each starting with its
+    # @@ header) between two remote files as they are found, nothing when
+    # their checksums match.  Files are streamed and the diff thread stays
+    # at most DIFF_QUEUE_HUNKS hunks ahead, so their size does not matter.
+    #
+    #     async for hunk in client.diff('a.log', 'b.log'):
+    #         print(''.join(hunk))
+    async def diff(self, remote_file1: str, remote_file2: str):
+        loop = asyncio.get_running_loop()
+        hunks = asyncio.Queue(maxsize=DIFF_QUEUE_HUNKS)
+        stopped = threading.Event()
+
+        # Called on the diff thread, waits while the queue is full.  False
+        # once the consumer is gone, which ends the diff.
+        def deliver(hunk) -> bool:
+            asyncio.run_coroutine_threadsafe(hunks.put(hunk), loop).result()
+            return not stopped.is_set()
+
+        producer = asyncio.ensure_future(self.run(_diff_hunks, remote_file1, remote_file2, self.ssh, deliver))
+        try:
+            while True:
+                getter = asyncio.ensure_future(hunks.get())
+                done, _ = await asyncio.wait({getter, producer}, return_when=asyncio.FIRST_COMPLETED)
+                if getter in done:
+                    yield getter.result()
+                    continue
+                getter.cancel()
+                # Every hunk was queued before the diff thread returned.
+                while not hunks.empty():
+                    yield hunks.get_nowait()
+                producer.result()
+                return
+        finally:
+            stopped.set()
+            if not producer.done():
+                producer.cancel()
+            # Make room for a hunk the diff thread may be waiting to queue.
+            while not hunks.empty():
+                hunks.get_nowait()
+
+    # Cancel every call this client is still awaiting.
+    def cancel_all(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+
+    # Cancel outstanding calls, wait for running ones and close the extra
+    # SFTP channels.  The sftp and ssh clients given are left open.
+    async def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self.cancel_all()
+        await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(self._pool.shutdown, wait=True, cancel_futures=True))
+        self._channels.close()
+
+def _list(sftp: paramiko.SFTPClient, path: str, **options) -> list:
+    return list(sftp_client.list_entries(sftp, path, **options))
+
+# Hand every hunk between the two files to deliver as soon as it is found,
+# stopping early when deliver returns False.
+def _diff_hunks(sftp: paramiko.SFTPClient, remote_file1: str, remote_file2: str,
+                ssh: paramiko.SSHClient, deliver) -> None:
+    if sftp_client.remote_files_match(sftp, remote_file1, remote_file2, ssh):
+        return
+    diff = stream_diff.StreamingDiff(stream_diff.iter_lines(sftp_client.iter_remote_blocks(sftp, remote_file1)),
+                                     stream_diff.iter_lines(sftp_client.iter_remote_blocks(sftp, remote_file2)))
+    for hunk in diff.hunks():
+        if not deliver(hunk):
+            return
@@ -0,0 +1,64 @@
+# Benchmark of the block delta used by 'get -d' and 'put -d'.
+#
+# Builds a random file, changes it in a few places (overwrites, an
+# insertion and a deletion) and reports how many bytes a delta transfer
+# sends compared with a full transfer.  Run from the base directory:
+#   python benchmarks/delta_benchmark.py [size in MB] [number of edits]
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import block_delta
+
+def edit(data: bytes, edits: int, rng: random.Random) -> bytes:
+    data = bytearray(data)
+    for _ in range(edits):
+        offset = rng.randrange(len(data) - 100)
+        data[offset:offset + 100] = os.urandom(100)
+    offset = rng.randrange(len(data))
+    data[offset:offset] = b'inserted bytes'
+    offset = rng.randrange(len(data) - 5000)
+    del data[offset:offset + 5000]
+    return bytes(data)
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    edits = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    rng = random.Random(410)
+
+    basis = os.urandom(size_mb * 1024 * 1024)
+    target = edit(basis, edits, rng)
+    block_size = block_delta.choose_block_size(len(basis))
+
+    start = time.perf_counter()
+    signatures = io.BytesIO()
+    signature_bytes = block_delta.write_signatures(io.BytesIO(basis), block_size, signatures)
+    signature_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    delta = io.BytesIO()
+    _, signature_list = block_delta.read_signatures(io.BytesIO(signatures.getvalue()))
+    literal_bytes = block_delta.compute_delta(block_size, signature_list, io.BytesIO(target), delta)
+    delta_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    rebuilt = io.BytesIO()
+    delta.seek(0)
+    block_delta.apply_delta(io.BytesIO(basis), block_size, delta, rebuilt)
+    apply_time = time.perf_counter() - start
+    assert rebuilt.getvalue() == target
+
+    sent = signature_bytes + len(delta.getvalue())
+    print(f"File size:          {len(target)} bytes ({size_mb} MB, {edits} edits, block size {block_size})")
+    print(f"Full transfer:      {len(target)} bytes")
+    print(f"Delta transfer:     {sent} bytes ({signature_bytes} signatures + {len(delta.getvalue())} delta, "
+          f"{literal_bytes} literal)")
+    print(f"Bytes saved:        {len(target) - sent} ({100 * (len(target) - sent) / len(target):.2f}%)")
+    print(f"Time:               signatures {signature_time:.2f}s, delta {delta_time:.2f}s, apply {apply_time:.2f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# Benchmark of the memory mapped upload used by put for large files.
+#
+# Compares the CPU time per GB of paramiko's put, which reads a new bytes
+# object for every 32 KB request, with sftp_client.upload_mmap, which
+# hands memoryview slices of a memory map to the write requests.
+#
+# Without a server the SFTP side is replaced by a sink that encodes every
+# write request into a paramiko Message, the copy both paths share, so
+# only the client side cost is measured.  With a server both uploads run
+# for real and the wall time is reported too.  Run from the base directory:
+#   python benchmarks/upload_benchmark.py [size in MB]
+#   python benchmarks/upload_benchmark.py [size in MB] hostname username
+import getpass
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import paramiko
+
+import sftp_client
+
+# Bytes per SFTP write request, as in paramiko's SFTPFile.
+REQUEST_SIZE = 32768
+
+class SinkFile:
+    """Remote file that only encodes its write requests."""
+
+    def __init__(self):
+        self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set_pipelined(self, pipelined=True):
+        pass
+
+    def write(self, data):
+        view = memoryview(data)
+        for offset in range(0, len(view), REQUEST_SIZE):
+            paramiko.Message().add_string(view[offset:offset + REQUEST_SIZE])
+        self.size += len(view)
+
+class SinkSftp:
+    """Just enough of SFTPClient for put and upload_mmap."""
+
+    def __init__(self):
+        self.file = None
+
+    def open(self, path, mode='r', bufsize=-1):
+        self.file = SinkFile()
+        return self.file
+
+    def put(self, localpath, remotepath):
+        # paramiko's putfo: read a chunk, write it, repeat
+        with open(localpath, 'rb') as local_file, self.open(remotepath, 'wb') as remote_file:
+            for data in iter(lambda: local_file.read(REQUEST_SIZE), b''):
+                remote_file.write(data)
+
+    def stat(self, path):
+        attributes = paramiko.SFTPAttributes()
+        attributes.st_size = self.file.size
+        return attributes
+
+def measure(label, upload, size):
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    upload()
+    cpu = time.process_time() - cpu
+    wall = time.perf_counter() - wall
+    gigabytes = size / (1024 ** 3)
+    print(f"{label:<14} CPU {cpu / gigabytes:6.2f} s/GB   wall {wall:6.2f}s "
+          f"({sftp_client.format_throughput(size, wall)})")
+    return cpu
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    if len(sys.argv) > 3:
+        password = getpass.getpass(f"Password for {sys.argv[3]}@{sys.argv[2]}: ")
+        sftp, ssh = sftp_client.connect_sftp(sys.argv[2], sys.argv[3], password)
+        if sftp is None:
+            print("Connection failed")
+            return
+    else:
+        sftp, ssh = SinkSftp(), None
+
+    size = size_mb * 1024 * 1024
+    with tempfile.NamedTemporaryFile(delete=False) as source:
+        block = os.urandom(1024 * 1024)
+        for _ in range(size_mb):
+            source.write(block)
+    remote_path = f"upload_benchmark_{os.getpid()}.bin"
+    try:
+        print(f"Uploading {size_mb} MB {'to ' + sys.argv[2] if ssh else 'into a local sink'}")
+        put_cpu = measure("sftp.put", lambda: sftp.put(source.name, remote_path), size)
+        mmap_cpu = measure("upload_mmap", lambda: sftp_client.upload_mmap(sftp, source.name, remote_path), size)
+        print(f"CPU saved:     {100 * (put_cpu - mmap_cpu) / put_cpu:.1f}%")
+    finally:
+        os.remove(source.name)
+        if ssh:
+            sftp.remove(remote_path)
+            sftp_client.disconnect_sftp(sftp)
+
+if __name__ == "__main__":
+    main()
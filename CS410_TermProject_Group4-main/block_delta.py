@@ -0,0 +1,273 @@
+"""
+rsync style block delta.  The side holding the old copy of a file (the
+basis) sends block signatures, the side holding the new copy answers with a
+delta made of references to matching basis blocks and literal data, and
+the basis side rebuilds the new file from it.
+
+This module only uses the standard library because it is also sent to the
+server and run there with python3 (see remote_command).
+"""
+import hashlib
+import os
+import shutil
+import struct
+import sys
+import zlib
+
+# Modulus of the adler32 weak checksum.
+ADLER_MOD = 65521
+# Bytes read from the new file at a time while computing a delta.
+READ_SIZE = 1024 * 1024
+# Literal data is sent in pieces of at most this many bytes.
+MAX_LITERAL = 64 * 1024
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 128 * 1024
+# compute_delta gives up once more than this share of the bytes it has
+# scanned is literal data, checked after the first DELTA_PROBE_BYTES.
+# Unmatched bytes go through the rolling checksum one at a time in Python
+# (about 1.6 MB/s against 160 MB/s for matching blocks), so a file this
+# changed is sent faster outright on any link above a few MB/s.
+MAX_LITERAL_RATIO = 0.25
+DELTA_PROBE_BYTES = 4 * 1024 * 1024
+
+SIGNATURE_HEADER = struct.Struct('>IQ')
+SIGNATURE_ENTRY = struct.Struct('>I16s')
+OP_COPY = b'C'
+OP_DATA = b'D'
+OP_END = b'E'
+OP_ABORT = b'A'
+# Exit status of the server side when a delta was abandoned.
+ABANDONED_STATUS = 3
+
+class DeltaAbandoned(Exception):
+    """The file changed too much for a delta to pay off."""
+
+# Block size for a basis of size bytes, roughly its square root like rsync.
+def choose_block_size(size: int) -> int:
+    block_size = int(size ** 0.5) // 1024 * 1024
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block_size))
+
+def strong_hash(data) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+# Write the signature of every block of basis to out.  The header holds
+# the block size and the basis size, followed by a weak and strong hash
+# per block.
+def write_signatures(basis, block_size: int, out) -> int:
+    basis.seek(0, os.SEEK_END)
+    size = basis.tell()
+    basis.seek(0)
+    out.write(SIGNATURE_HEADER.pack(block_size, size))
+    written = SIGNATURE_HEADER.size
+    while True:
+        block = basis.read(block_size)
+        if not block:
+            break
+        out.write(SIGNATURE_ENTRY.pack(zlib.adler32(block), strong_hash(block)))
+        written += SIGNATURE_ENTRY.size
+    return written
+
+# Read signatures written by write_signatures.  Returns the block size and
+# a list of (weak, strong, length) per block.
+def read_signatures(stream):
+    block_size, size = SIGNATURE_HEADER.unpack(_read_exact(stream, SIGNATURE_HEADER.size))
+    signatures = []
+    for offset in range(0, size, block_size):
+        weak, strong = SIGNATURE_ENTRY.unpack(_read_exact(stream, SIGNATURE_ENTRY.size))
+        signatures.append((weak, strong, min(block_size, size - offset)))
+    return block_size, signatures
+
+# Compare the new file source against the basis signatures and write the
+# delta to out.  Matching blocks are found at any offset with the rolling
+# weak checksum and confirmed with the strong hash, so inserted or removed
+# bytes only cost the literal data around them.  Returns the number of
+# literal bytes written.  When more than max_literal_ratio of the scanned
+# bytes turn out to be literal (see MAX_LITERAL_RATIO), an abort is
+# written instead of the end and DeltaAbandoned is raised.
+def compute_delta(block_size: int, signatures, source, out,
+                  max_literal_ratio: float = MAX_LITERAL_RATIO) -> int:
+    table = {}
+    for index, (weak, strong, length) in enumerate(signatures):
+        if length == block_size:
+            table.setdefault(weak, {}).setdefault(strong, index)
+    tail = None
+    if signatures and signatures[-1][2] < block_size:
+        tail = (len(signatures) - 1,) + signatures[-1]
+
+    target_hash = hashlib.sha256()
+    literal_bytes = 0
+    buffer = b''
+    pos = 0
+    literal_start = 0
+    eof = False
+    a = b = None
+    # Consecutive matching blocks are sent as one (first index, count) run.
+    run = [0, 0]
+
+    def emit_run():
+        if run[1]:
+            out.write(OP_COPY + struct.pack('>II', run[0], run[1]))
+            run[1] = 0
+
+    def emit_copy(index):
+        if run[1] and index == run[0] + run[1]:
+            run[1] += 1
+        else:
+            emit_run()
+            run[0], run[1] = index, 1
+
+    def emit_literal(data):
+        if data:
+            emit_run()
+        for start in range(0, len(data), MAX_LITERAL):
+            piece = data[start:start + MAX_LITERAL]
+            out.write(OP_DATA + struct.pack('>I', len(piece)) + piece)
+        return len(data)
+
+    # Bytes of the new file behind the current position.
+    scanned = 0
+
+    def check_worthwhile():
+        if scanned >= DELTA_PROBE_BYTES and literal_bytes > max_literal_ratio * scanned:
+            emit_run()
+            out.write(OP_ABORT)
+            raise DeltaAbandoned(f"{literal_bytes} of the first {scanned} bytes changed")
+
+    while True:
+        remaining = len(buffer) - pos
+        # Keep at least one byte past the window so the checksum can roll.
+        if not eof and remaining <= block_size:
+            literal_bytes += emit_literal(buffer[literal_start:pos])
+            scanned += pos
+            check_worthwhile()
+            data = source.read(READ_SIZE)
+            if not data:
+                eof = True
+            target_hash.update(data)
+            buffer = buffer[pos:] + data
+            pos = literal_start = 0
+            continue
+
+        if remaining >= block_size:
+            if a is None:
+                weak = zlib.adler32(buffer[pos:pos + block_size])
+                a, b = weak & 0xffff, weak >> 16
+            candidates = table.get((b << 16) | a)
+            if candidates is not None:
+                index = candidates.get(strong_hash(buffer[pos:pos + block_size]))
+                if index is not None:
+                    literal_bytes += emit_literal(buffer[literal_start:pos])
+                    emit_copy(index)
+                    pos += block_size
+                    literal_start = pos
+                    a = b = None
+                    continue
+            if remaining > block_size:
+                out_byte, in_byte = buffer[pos], buffer[pos + block_size]
+                a = (a - out_byte + in_byte) % ADLER_MOD
+                b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+            else:
+                a = b = None
+            pos += 1
+            continue
+
+        # Fewer than block_size bytes are left, only the short last basis
+        # block can still match.
+        if remaining and tail is not None and remaining == tail[3] \
+                and zlib.adler32(buffer[pos:]) == tail[1] and strong_hash(buffer[pos:]) == tail[2]:
+            literal_bytes += emit_literal(buffer[literal_start:pos])
+            emit_copy(tail[0])
+            literal_start = len(buffer)
+        literal_bytes += emit_literal(buffer[literal_start:])
+        break
+
+    emit_run()
+    out.write(OP_END + target_hash.digest())
+    return literal_bytes
+
+# Rebuild the new file into out from the basis and a delta stream.  The
+# result is checked against the hash at the end of the delta.  Returns the
+# number of bytes copied from the basis and the number of literal bytes.
+def apply_delta(basis, block_size: int, delta, out):
+    target_hash = hashlib.sha256()
+    copied_bytes = literal_bytes = 0
+    while True:
+        op = _read_exact(delta, 1)
+        if op == OP_COPY:
+            index, count = struct.unpack('>II', _read_exact(delta, 8))
+            basis.seek(index * block_size)
+            for _ in range(count):
+                data = basis.read(block_size)
+                copied_bytes += len(data)
+                out.write(data)
+                target_hash.update(data)
+            continue
+        elif op == OP_DATA:
+            length, = struct.unpack('>I', _read_exact(delta, 4))
+            data = _read_exact(delta, length)
+            literal_bytes += len(data)
+        elif op == OP_END:
+            if _read_exact(delta, 32) != target_hash.digest():
+                raise IOError("Delta result does not match the source file")
+            return copied_bytes, literal_bytes
+        elif op == OP_ABORT:
+            raise DeltaAbandoned("The sender abandoned the delta")
+        else:
+            raise IOError(f"Corrupt delta stream (operation {op!r})")
+        out.write(data)
+        target_hash.update(data)
+
+def _read_exact(stream, length: int) -> bytes:
+    data = b''
+    while len(data) < length:
+        piece = stream.read(length - len(data))
+        if not piece:
+            raise IOError("Unexpected end of delta stream")
+        data += piece
+    return data
+
+# Shell command that runs this module on the server in the given mode.
+def remote_command(mode: str, path: str, *args) -> str:
+    import shlex
+    with open(__file__, 'r') as file:
+        source = file.read()
+    return ' '.join(['python3', '-c', shlex.quote(source), mode, shlex.quote(path)] +
+                    [shlex.quote(str(arg)) for arg in args])
+
+# Entry point on the server:
+#   signature PATH BLOCK_SIZE : write the signatures of PATH
+#   delta PATH                : read signatures, write the delta of PATH
+#   patch PATH                : read a delta and rebuild PATH in place
+def main(argv) -> int:
+    mode, path = argv[1], argv[2]
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    if mode == 'signature':
+        with open(path, 'rb') as basis:
+            write_signatures(basis, int(argv[3]), stdout)
+    elif mode == 'delta':
+        block_size, signatures = read_signatures(stdin)
+        with open(path, 'rb') as source:
+            try:
+                compute_delta(block_size, signatures, source, stdout)
+            except DeltaAbandoned:
+                pass
+    elif mode == 'patch':
+        block_size = int(argv[3])
+        temp = path + '.delta'
+        try:
+            with open(path, 'rb') as basis, open(temp, 'wb') as out:
+                apply_delta(basis, block_size, stdin, out)
+            shutil.copymode(path, temp)
+            os.replace(temp, path)
+        except DeltaAbandoned:
+            return ABANDONED_STATUS
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+    else:
+        return 2
+    stdout.flush()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,167 @@
+import os
+import shlex
+import threading
+import weakref
+import zlib
+
+import paramiko
+
+import rate_limit
+import sftp_client
+from remote_cache import session_of
+
+# gzip level used on both ends.  Level 1 keeps up with fast links and
+# still shrinks text and CSV files severalfold.
+GZIP_LEVEL = 1
+# Bytes read from the start, middle and end of a file to estimate how
+# well it compresses.
+SAMPLE_SIZE = 64 * 1024
+# Files smaller than this are sent as they are, the extra exec channel
+# costs more than it saves.
+MIN_COMPRESS_SIZE = 1024 * 1024
+# Only compress when the sample shrinks below this fraction of its size.
+MAX_COMPRESSED_RATIO = 0.7
+# Rate gzip -1 compresses and decompresses at, in bytes per second.
+GZIP_SPEED = 60 * 1024 * 1024
+# Assumed link speed for sessions without a measured transfer yet.
+DEFAULT_LINK_SPEED = 10 * 1024 * 1024
+# Transfers smaller than this say more about latency than link speed and
+# are not used to estimate it.
+MIN_MEASURED_SIZE = 1024 * 1024
+# Weight of the newest measurement in the link speed average.
+LINK_SPEED_WEIGHT = 0.3
+# Bytes read or written per step while streaming.
+STREAM_BLOCK_SIZE = 256 * 1024
+
+# session -> estimated link speed in bytes per second
+_link_speeds = weakref.WeakKeyDictionary()
+_link_speeds_lock = threading.Lock()
+
+# Fraction of its size data shrinks to with zlib at GZIP_LEVEL.
+def compressed_ratio(data: bytes) -> float:
+    if not data:
+        return 1.0
+    return len(zlib.compress(data, GZIP_LEVEL)) / len(data)
+
+# Offsets of the samples taken from a file of size bytes.
+def sample_offsets(size: int) -> list:
+    if size <= SAMPLE_SIZE * 3:
+        return [0]
+    return [0, (size - SAMPLE_SIZE) // 2, size - SAMPLE_SIZE]
+
+def sample_local(path: str) -> bytes:
+    size = os.path.getsize(path)
+    with open(path, 'rb') as file:
+        samples = []
+        for offset in sample_offsets(size):
+            file.seek(offset)
+            samples.append(file.read(SAMPLE_SIZE))
+    return b''.join(samples)
+
+def sample_remote(sftp: paramiko.SFTPClient, path: str, size: int) -> bytes:
+    chunks = [(offset, min(SAMPLE_SIZE, size - offset)) for offset in sample_offsets(size)]
+    with sftp.open(path, 'rb') as remote_file:
+        return b''.join(remote_file.readv(chunks))
+
+# Fold the throughput of a finished transfer into the session's link speed.
+def record_throughput(sftp: paramiko.SFTPClient, num_bytes: int, seconds: float) -> None:
+    if num_bytes < MIN_MEASURED_SIZE or seconds <= 0:
+        return
+    with _link_speeds_lock:
+        session = session_of(sftp)
+        previous = _link_speeds.get(session)
+        speed = num_bytes / seconds
+        if previous is not None:
+            speed = LINK_SPEED_WEIGHT * speed + (1 - LINK_SPEED_WEIGHT) * previous
+        _link_speeds[session] = speed
+
+def link_speed(sftp: paramiko.SFTPClient) -> float:
+    with _link_speeds_lock:
+        return _link_speeds.get(session_of(sftp), DEFAULT_LINK_SPEED)
+
+# True if the SSH transport already compresses everything it sends.
+def transport_compressed(ssh: paramiko.SSHClient) -> bool:
+    transport = ssh.get_transport()
+    return getattr(transport, 'local_compression', 'none') not in ('none', None)
+
+# Decide whether gzip through an exec pipe beats a plain transfer.  The
+# compressed transfer is limited by whichever is slower, gzip or sending
+# the smaller stream, and must win by at least 10%.
+def should_compress(size: int, ratio: float, speed: float) -> bool:
+    if size < MIN_COMPRESS_SIZE or ratio > MAX_COMPRESSED_RATIO:
+        return False
+    plain_time = size / speed
+    compressed_time = max(size / GZIP_SPEED, size * ratio / speed)
+    return compressed_time < plain_time * 0.9
+
+# Automatic choice for a transfer of size bytes whose sample is given.
+# Needs ssh, gzip on the server and a transport that does not compress yet.
+def choose(sftp: paramiko.SFTPClient, ssh: paramiko.SSHClient, size: int, sample) -> bool:
+    if ssh is None or size < MIN_COMPRESS_SIZE or transport_compressed(ssh):
+        return False
+    if not sftp_client.remote_command_available(ssh, 'gzip'):
+        return False
+    return should_compress(size, compressed_ratio(sample()), link_speed(sftp))
+
+def choose_download(sftp: paramiko.SFTPClient, ssh: paramiko.SSHClient, src: str) -> bool:
+    size = sftp.stat(src).st_size
+    return choose(sftp, ssh, size, lambda: sample_remote(sftp, src, size))
+
+def choose_upload(sftp: paramiko.SFTPClient, ssh: paramiko.SSHClient, local_path: str) -> bool:
+    return choose(sftp, ssh, os.path.getsize(local_path), lambda: sample_local(local_path))
+
+# Download src to dest as a gzip stream from the server, decompressing it
+# into the destination as it arrives.  Returns (bytes written, bytes received).
+def download_gzip(ssh: paramiko.SSHClient, src: str, dest: str):
+    stdin, stdout, stderr = ssh.exec_command(f"gzip -c -{GZIP_LEVEL} -- {shlex.quote(src)}")
+    stdin.channel.shutdown_write()
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    temp = dest + '.gz.part'
+    written = received = 0
+    try:
+        with open(temp, 'wb') as out:
+            while True:
+                data = stdout.read(STREAM_BLOCK_SIZE)
+                if not data:
+                    break
+                received += len(data)
+                rate_limit.throttle(len(data))
+                block = decompressor.decompress(data)
+                out.write(block)
+                written += len(block)
+            block = decompressor.flush()
+            out.write(block)
+            written += len(block)
+        sftp_client._check_exit_status(stdout, stderr, "gzip")
+        if not decompressor.eof:
+            raise IOError(f"Compressed stream of {src} ended early")
+        os.replace(temp, dest)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+    return written, received
+
+# Upload local_path to remote_path as a gzip stream that the server
+# decompresses into a temporary file, moved into place once complete.
+# Returns (bytes read, bytes sent).
+def upload_gzip(ssh: paramiko.SSHClient, local_path: str, remote_path: str):
+    remote_temp = shlex.quote(remote_path + '.gz.part')
+    stdin, stdout, stderr = ssh.exec_command(
+        f"gzip -dc > {remote_temp} && mv -f -- {remote_temp} {shlex.quote(remote_path)}")
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    read = sent = 0
+    with open(local_path, 'rb') as source:
+        for block in iter(lambda: source.read(STREAM_BLOCK_SIZE), b''):
+            read += len(block)
+            data = compressor.compress(block)
+            if data:
+                rate_limit.throttle(len(data))
+                stdin.write(data)
+                sent += len(data)
+    data = compressor.flush()
+    rate_limit.throttle(len(data))
+    stdin.write(data)
+    sent += len(data)
+    stdin.channel.shutdown_write()
+    sftp_client._check_exit_status(stdout, stderr, "gzip")
+    return read, sent
@@ -0,0 +1,200 @@
+import atexit
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import paramiko
+
+import sftp_client
+from connection_storage import connection_info
+from logger import logger
+from rate_limit import rate_limiter
+
+# Most transports kept open at once, the least recently used is closed first.
+DEFAULT_MAX_CONNECTIONS = 8
+# Seconds a transport may sit unused before it is closed.
+DEFAULT_IDLE_TTL = 300
+# Seconds between SSH keepalive packets on pooled transports.
+KEEPALIVE_INTERVAL = 30
+
+# Key for the credential digests in pool keys, new every run so the
+# digests are useless outside this process.
+_CREDENTIAL_KEY = os.urandom(32)
+
+# Digest of the login, part of every pool key so a transport is only
+# handed to a caller that knows the password it was opened with.
+def _credential_digest(hostname, username, password) -> str:
+    login = '\0'.join((str(hostname), str(username), str(password)))
+    return hmac.new(_CREDENTIAL_KEY, login.encode(), 'sha256').hexdigest()
+
+class ConnectionPool:
+    """
+    Keeps authenticated SSH transports open so later operations against the
+    same server skip the key exchange and login.  Entries are keyed by
+    connection alias or by (hostname, username) together with a digest of
+    the password, and hand out new SFTP channels on the shared transport.
+
+    Every get_ssh (and connect) leases the transport until the caller hands
+    it back with release().  Leased transports are never closed for being
+    idle or least recently used; the idle time counts from the release.
+    """
+
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS, idle_ttl=DEFAULT_IDLE_TTL,
+                 keepalive_interval=KEEPALIVE_INTERVAL):
+        self.max_connections = max_connections
+        self.idle_ttl = idle_ttl
+        self.keepalive_interval = keepalive_interval
+        # key -> [ssh, last used time, leases], ordered from least to most
+        # recently used
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Return a live SSHClient for the server, reusing a pooled one when
+    # possible, leased to the caller until release(ssh).  Raises if a new
+    # connection cannot be made.
+    #   - compress: use a transport with zlib compression.  Compression is
+    #     fixed when the transport is opened, so these are pooled separately.
+    def get_ssh(self, hostname, username, password, key=None, compress=False) -> paramiko.SSHClient:
+        name = key if key is not None else (hostname, username)
+        key = (name, bool(compress), _credential_digest(hostname, username, password))
+
+        with self._lock:
+            self._evict_idle()
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._is_alive(entry[0]):
+                    entry[1] = time.monotonic()
+                    entry[2] += 1
+                    self._entries.move_to_end(key)
+                    return entry[0]
+                logger.log_warning(f"Pooled connection {name} is no longer alive, reconnecting")
+                self._close_entry(key)
+
+        # Connect without holding the lock so a slow handshake does not
+        # block other servers.
+        if compress:
+            ssh = sftp_client.open_ssh(hostname, username, password, compress=True)
+        else:
+            ssh = sftp_client.open_ssh(hostname, username, password)
+        transport = ssh.get_transport()
+        if transport is not None:
+            transport.set_keepalive(self.keepalive_interval)
+
+        with self._lock:
+            if key in self._entries:
+                # Another thread connected first, keep its connection.
+                ssh.close()
+                entry = self._entries[key]
+                entry[2] += 1
+                self._entries.move_to_end(key)
+                return entry[0]
+            self._entries[key] = [ssh, time.monotonic(), 1]
+            # Close the least recently used transports nobody holds.
+            for old_key in [old_key for old_key, entry in self._entries.items() if entry[2] == 0]:
+                if len(self._entries) <= self.max_connections:
+                    break
+                self._close_entry(old_key)
+        logger.log_info(f"Opened pooled connection to {hostname} as {username}")
+        return ssh
+
+    # Open a new SFTP channel on a pooled transport.  Returns (sftp, ssh)
+    # like sftp_client.connect_sftp, or (None, '') on failure.
+    # The caller releases ssh when done with the connection.
+    def connect(self, hostname, username, password, key=None, compress=False):
+        ssh = None
+        try:
+            ssh = self.get_ssh(hostname, username, password, key, compress)
+            sftp = ssh.open_sftp()
+            logger.log_info(f"Successfully connected to {hostname}")
+            return sftp, ssh
+        except Exception as e:
+            if ssh is not None:
+                self.release(ssh)
+            logger.log_error(f"Error opening SFTP: {e}")
+            return None, ''
+
+    # Same as connect, looking the server up in the stored connections.
+    def connect_alias(self, alias):
+        connection = connection_info.get_connection_by_alias(alias)
+        if connection is None:
+            logger.log_warning(f"No stored connection named {alias}")
+            return None, ''
+        sftp, ssh = self.connect(connection['hostname'], connection['username'], connection['password'], key=alias,
+                                 compress=connection.get('compress', False))
+        if sftp is not None:
+            # Transfers on this connection count against the alias's limit
+            rate_limiter.bind(sftp, alias)
+            rate_limiter.set_alias_rate(alias, connection.get('rate_limit'))
+        return sftp, ssh
+
+    # Take another lease on a pooled transport, i.e. for a background job
+    # that keeps using a session after its owner released it.  Returns
+    # False if ssh is not pooled.
+    def acquire(self, ssh) -> bool:
+        with self._lock:
+            for entry in self._entries.values():
+                if entry[0] is ssh:
+                    entry[2] += 1
+                    return True
+        return False
+
+    # Hand back a transport leased by get_ssh or connect.  It stays pooled
+    # for reuse and is closed once idle for idle_ttl.
+    def release(self, ssh) -> None:
+        with self._lock:
+            for entry in self._entries.values():
+                if entry[0] is ssh:
+                    entry[2] = max(0, entry[2] - 1)
+                    entry[1] = time.monotonic()
+                    return
+
+    # Close and forget the connections stored under name (an alias or
+    # (hostname, username)), leased or not.
+    def evict(self, name) -> None:
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == name]:
+                self._close_entry(key)
+
+    # Close every pooled connection.
+    def close_all(self) -> None:
+        with self._lock:
+            for key in list(self._entries):
+                self._close_entry(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, name):
+        return any(key[0] == name for key in self._entries)
+
+    # The transport must be active and still accept a packet.
+    def _is_alive(self, ssh) -> bool:
+        transport = ssh.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+            return True
+        except Exception:
+            return False
+
+    def _evict_idle(self) -> None:
+        now = time.monotonic()
+        for key, (ssh, last_used, leases) in list(self._entries.items()):
+            if leases == 0 and now - last_used > self.idle_ttl:
+                self._close_entry(key)
+
+    def _close_entry(self, key) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        try:
+            entry[0].close()
+            logger.log_info(f"Closed pooled connection {key[0]}")
+        except Exception as e:
+            logger.log_error(f"Error closing pooled connection {key[0]}: {e}")
+
+connection_pool = ConnectionPool()
+atexit.register(connection_pool.close_all)
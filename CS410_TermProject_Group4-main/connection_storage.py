@@ -25,8 +25,14 @@ class ConnectionManager:
             json.dump(alias_list, file)
 
     # Store the connection information as a JSON string in the keyring
-    def store_new_connection(self, alias, hostname, username, password):
-        connection_info = json.dumps({'hostname': hostname, 'username': username, 'password': password})
+    #   - rate_limit: bandwidth limit for the alias in bytes per second
+    def store_new_connection(self, alias, hostname, username, password, compress=False, rate_limit=None):
+        connection = {'hostname': hostname, 'username': username, 'password': password}
+        if compress:
+            connection['compress'] = True
+        if rate_limit:
+            connection['rate_limit'] = rate_limit
+        connection_info = json.dumps(connection)
         keyring.set_password(self.service_name, alias, connection_info)
 
         # Update the alias list
@@ -59,7 +65,18 @@ class ConnectionManager:
                 connection_info['password'] = new_password
 
             # Store the updated connection info
-            self.store_new_connection(alias, connection_info['hostname'], connection_info['username'], connection_info['password'])
+            self.store_new_connection(alias, connection_info['hostname'], connection_info['username'], connection_info['password'],
+                                      connection_info.get('compress', False), connection_info.get('rate_limit'))
+            return True
+        else:
+            return False
+
+    # Set or clear (None) the bandwidth limit stored for an alias
+    def set_rate_limit(self, alias, rate_limit):
+        connection_info = self.get_connection_by_alias(alias)
+        if connection_info:
+            self.store_new_connection(alias, connection_info['hostname'], connection_info['username'], connection_info['password'],
+                                      connection_info.get('compress', False), rate_limit)
             return True
         else:
             return False
@@ -0,0 +1,207 @@
+import os
+import posixpath
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import paramiko
+
+import rate_limit
+import remote_walker
+import sftp_client
+from logger import logger
+from remote_cache import listing_cache
+
+# Number of files transferred at the same time by sync.
+DEFAULT_SYNC_WORKERS = 8
+
+# Walk a local directory.  Returns a dict of relative path (always with
+# '/' separators) -> (size, mtime) for every file, and the set of relative
+# directory paths.
+def scan_local_tree(local_dir: str):
+    files = {}
+    directories = set()
+    for root, dirs, names in os.walk(local_dir):
+        relative_root = os.path.relpath(root, local_dir).replace(os.sep, '/')
+        relative_root = '' if relative_root == '.' else relative_root
+        for name in dirs:
+            directories.add(posixpath.join(relative_root, name))
+        for name in names:
+            attributes = os.stat(os.path.join(root, name))
+            files[posixpath.join(relative_root, name)] = (attributes.st_size, int(attributes.st_mtime))
+    return files, directories
+
+# Walk a remote directory with remote_walker.walk_remote.  Returns the
+# same shape as scan_local_tree.  A missing remote directory is treated as
+# empty.
+def scan_remote_tree(sftp: paramiko.SFTPClient, remote_dir: str, ssh: paramiko.SSHClient = None):
+    files = {}
+    directories = set()
+
+    def on_error(path, error):
+        if path == remote_dir and getattr(error, 'errno', None) == 2:
+            return
+        raise error
+
+    prefix = remote_dir.rstrip('/') + '/'
+    for path, entry, depth in remote_walker.walk_remote(sftp, remote_dir, ssh, on_error=on_error, fresh=True):
+        relative_path = path[len(prefix):] if path.startswith(prefix) else path
+        if stat.S_ISDIR(entry.st_mode):
+            directories.add(relative_path)
+        else:
+            files[relative_path] = (entry.st_size, int(entry.st_mtime))
+    return files, directories
+
+# Compare two trees and return the relative paths that must be copied from
+# source to destination and the ones that only exist at the destination.
+# Files are copied when they are new or their size or mtime differ; with
+# checksum, files of equal size are compared by content instead of mtime.
+#   - same_content(relative_path): only called when checksum is set
+def plan_sync(source_files: dict, dest_files: dict, checksum: bool = False, same_content=None):
+    to_copy = []
+    for relative_path, (size, mtime) in sorted(source_files.items()):
+        if relative_path not in dest_files:
+            to_copy.append(relative_path)
+            continue
+        dest_size, dest_mtime = dest_files[relative_path]
+        if size != dest_size:
+            to_copy.append(relative_path)
+        elif checksum:
+            if not same_content(relative_path):
+                to_copy.append(relative_path)
+        elif mtime != dest_mtime:
+            to_copy.append(relative_path)
+    extraneous = sorted(set(dest_files) - set(source_files))
+    return to_copy, extraneous
+
+# Make local_dir and remote_dir hold the same files, copying only files
+# that are new or changed.
+#   - sftp / ssh: the client we are connected with.  With ssh every worker
+#     transfers over its own SFTP channel.
+#   - pull: copy remote -> local instead of local -> remote
+#   - delete: remove destination files and directories missing at the source
+#   - checksum: compare file contents instead of mtimes
+#   - dry_run: only print what would be done
+#   - limit: bytes per second for each file (see rate_limit)
+# Returns True when every transfer and deletion succeeded.
+def sync_directories(sftp: paramiko.SFTPClient, local_dir: str, remote_dir: str,
+                     ssh: paramiko.SSHClient = None, pull: bool = False, delete: bool = False,
+                     checksum: bool = False, dry_run: bool = False,
+                     workers: int = DEFAULT_SYNC_WORKERS, limit: float = None) -> bool:
+    start = time.monotonic()
+    local_files, local_dirs = scan_local_tree(local_dir)
+    remote_files, remote_dirs = scan_remote_tree(sftp, remote_dir, ssh)
+
+    # Remote files are hashed on the server, see sftp_client.remote_checksum.
+    def same_content(relative_path):
+        return sftp_client.remote_matches_local(sftp, posixpath.join(remote_dir, relative_path),
+                                                os.path.join(local_dir, *relative_path.split('/')), ssh)
+
+    if pull:
+        source_files, dest_files = remote_files, local_files
+        source_dirs, dest_dirs = remote_dirs, local_dirs
+    else:
+        source_files, dest_files = local_files, remote_files
+        source_dirs, dest_dirs = local_dirs, remote_dirs
+    to_copy, extraneous = plan_sync(source_files, dest_files, checksum, same_content)
+    missing_dirs = sorted(source_dirs - dest_dirs)
+    extraneous_dirs = sorted(dest_dirs - source_dirs, reverse=True) if delete else []
+    if not delete:
+        extraneous = []
+
+    if dry_run:
+        for relative_path in to_copy:
+            print(f"copy {relative_path}")
+        for relative_path in extraneous + extraneous_dirs:
+            print(f"delete {relative_path}")
+        print(f"{len(to_copy)} to copy, {len(source_files) - len(to_copy)} unchanged, "
+              f"{len(extraneous) + len(extraneous_dirs)} to delete")
+        return True
+
+    # Parents sort before their children so directories are created in order.
+    if pull:
+        for relative_path in missing_dirs:
+            os.makedirs(os.path.join(local_dir, *relative_path.split('/')), exist_ok=True)
+    else:
+        if remote_dir not in ('', '.', '/'):
+            _ensure_remote_dir(sftp, remote_dir)
+        for relative_path in missing_dirs:
+            _ensure_remote_dir(sftp, posixpath.join(remote_dir, relative_path))
+
+    channels = sftp_client.WorkerChannels(sftp, ssh)
+
+    def copy(relative_path):
+        local_path = os.path.join(local_dir, *relative_path.split('/'))
+        remote_path = posixpath.join(remote_dir, relative_path)
+        size, mtime = source_files[relative_path]
+        with channels.use() as channel, rate_limit.rate_limiter.transfer(channel, limit):
+            if pull:
+                channel.get(remote_path, local_path, callback=rate_limit.callback())
+                os.utime(local_path, (mtime, mtime))
+            else:
+                channel.put(local_path, remote_path, callback=rate_limit.callback())
+                # Keep the source mtime so the next sync sees the file as unchanged.
+                channel.utime(remote_path, (mtime, mtime))
+        return size
+
+    failed = []
+    copied_bytes = 0
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = {pool.submit(copy, relative_path): relative_path for relative_path in to_copy}
+            for done, future in enumerate(as_completed(futures), 1):
+                relative_path = futures[future]
+                try:
+                    copied_bytes += future.result()
+                    print(f"[{done}/{len(to_copy)}] {relative_path}")
+                except Exception as e:
+                    failed.append(relative_path)
+                    logger.log_error(f"Error syncing {relative_path}: {e}")
+    finally:
+        channels.close()
+        if not pull:
+            listing_cache.invalidate(sftp, remote_dir, subtree=True)
+    copy_failures = len(failed)
+
+    def remove(relative_path, directory):
+        if pull:
+            local_path = os.path.join(local_dir, *relative_path.split('/'))
+            if directory:
+                os.rmdir(local_path)
+            else:
+                os.remove(local_path)
+        else:
+            remote_path = posixpath.join(remote_dir, relative_path)
+            if directory:
+                sftp.rmdir(remote_path)
+            else:
+                sftp.remove(remote_path)
+
+    # Deepest directories sort last, so the reversed order empties children
+    # first.  A failed deletion is logged like a failed copy and the rest go on.
+    deleted = 0
+    for relative_path, directory in [(path, False) for path in extraneous] + \
+                                    [(path, True) for path in extraneous_dirs]:
+        try:
+            remove(relative_path, directory)
+            deleted += 1
+        except Exception as e:
+            failed.append(relative_path)
+            logger.log_error(f"Error deleting {relative_path}: {e}")
+    if deleted and not pull:
+        listing_cache.invalidate(sftp, remote_dir, subtree=True)
+
+    elapsed = time.monotonic() - start
+    summary = (f"Synced {local_dir} {'<-' if pull else '->'} {remote_dir}: "
+               f"{len(to_copy) - copy_failures} copied, {len(source_files) - len(to_copy)} unchanged, "
+               f"{deleted} deleted, {len(failed)} failed, {copied_bytes} bytes in {elapsed:.2f}s "
+               f"({sftp_client.format_throughput(copied_bytes, elapsed)})")
+    print(summary)
+    logger.log_info(summary)
+    return not failed
+
+def _ensure_remote_dir(sftp: paramiko.SFTPClient, remote_path: str) -> None:
+    try:
+        sftp.stat(remote_path)
+    except IOError:
+        sftp.mkdir(remote_path)
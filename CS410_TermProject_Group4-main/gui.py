@@ -10,15 +10,21 @@ from PyQt5.QtWidgets import (
     QMessageBox,
     QCheckBox,
     QLabel,
-    QTextEdit
+    QTextEdit,
+    QTableView,
+    QAbstractItemView,
+    QHeaderView
 )
 
 import asyncio
 import os
+import posixpath
+import time
 from qasync import QEventLoop, asyncSlot
 
 # from PyQt5.QtCore import Qt, QFileInfo  # we can use this import for accessing files
 from PyQt5.QtGui import QFont, QPixmap
+from PyQt5.QtCore import QObject, pyqtSignal, Qt, QAbstractTableModel, QModelIndex
 import sys
 
 import sftp_client as client
@@ -26,22 +32,101 @@ import sftp_client as client
 from sftp_client import connect_sftp, disconnect_sftp
 from sftp_client import ls
 from connection_storage import connection_info
+from connection_pool import connection_pool
+import task_queue
+from logger import logger
+from listing_view import ListingView
 
 #Styling variables
 base_theme_style = "color: #ebfaff; background-color: #36452f;"
 base_font = QFont("Helvetica", 12)
 white_text = "color: #ebfaff;"
 
-class QTextEditStream:
-    def __init__(self):
-        self.output = ""
-
-    def write(self, text):
-        # Append text to the QTextEdit widget
-        self.output += text
-
-    def flush(self):
-        pass
+# Carries task_queue callbacks from the worker threads to the GUI thread.
+class TaskSignals(QObject):
+    progress = pyqtSignal(object)
+    finished = pyqtSignal(object)
+    # (task, list of FileEntry) from task_queue.stream_listing
+    batch = pyqtSignal(object, object)
+
+# Table of a directory listing that fills in while the listing streams in.
+# The rows live in a ListingView; the table view only gets them a page at a
+# time through canFetchMore / fetchMore as the user scrolls, so it never
+# lays out more rows than have been looked at.
+class FileListModel(QAbstractTableModel):
+    COLUMNS = ("Name", "Size", "Modified")
+    SORT_KEYS = ('name', 'size', 'mtime')
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.view = ListingView()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.view.shown
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return None
+        entry = self.view.rows[index.row()]
+        column = index.column()
+        if column == 0:
+            return entry.name + '/' if entry.is_dir else entry.name
+        if column == 1:
+            return '' if entry.is_dir else str(entry.size)
+        return time.strftime('%Y-%m-%d %H:%M', time.localtime(entry.mtime))
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.COLUMNS[section]
+        return None
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self.view.can_fetch_more()
+
+    def fetchMore(self, parent=QModelIndex()):
+        count = self.view.fetch_count()
+        if parent.isValid() or count <= 0:
+            return
+        first = self.view.shown
+        self.beginInsertRows(QModelIndex(), first, first + count - 1)
+        self.view.show_more(count)
+        self.endInsertRows()
+
+    # Add a batch from the listing.  Sorted batches are merged in place;
+    # the first page is filled without waiting for the view to ask.
+    def add_entries(self, batch):
+        if self.view.sort_key is not None and self.view.shown:
+            self.layoutAboutToBeChanged.emit()
+            self.view.add(batch)
+            self.layoutChanged.emit()
+        else:
+            self.view.add(batch)
+        if self.view.shown < self.view.page_size and self.canFetchMore():
+            self.fetchMore()
+
+    # Column -1 means no sort indicator, rows stay in listing order.
+    def sort(self, column, order=Qt.AscendingOrder):
+        self.beginResetModel()
+        self.view.sort(self.SORT_KEYS[column] if column >= 0 else None, order == Qt.DescendingOrder)
+        self.endResetModel()
+
+    def set_filter(self, pattern):
+        self.beginResetModel()
+        self.view.set_filter(pattern)
+        self.endResetModel()
+
+    # Start over for a new listing, keeping the sort and filter.
+    def clear(self):
+        self.beginResetModel()
+        view = ListingView(self.view.page_size)
+        view.pattern = self.view.pattern
+        view.sort_key = self.view.sort_key
+        view.reverse = self.view.reverse
+        self.view = view
+        self.endResetModel()
 
 class SftpGui(QWidget):
     def __init__(self):
@@ -49,6 +134,14 @@ class SftpGui(QWidget):
         self.sftp = None
         self.ssh = None
         self.connected_host_name = ''
+        self.tasks = None
+        # task id -> function called with the task when it finishes
+        self.task_handlers = {}
+        self.task_signals = TaskSignals()
+        self.task_signals.progress.connect(self.on_task_progress)
+        self.task_signals.finished.connect(self.on_task_finished)
+        self.task_signals.batch.connect(self.on_listing_batch)
+        self.listing_task = None
         self.init_ui()
         self.loop = QEventLoop(self)
 
@@ -61,6 +154,7 @@ class SftpGui(QWidget):
     
     # Stop the event loop when the window is closed
     def closeEvent(self, event):
+        self.stop_tasks()
         self.loop.stop()
         event.accept()
 
@@ -92,6 +186,25 @@ class SftpGui(QWidget):
         location = (200, 350, 70, 30)
         self.logout_button = self.create_button(location, base_font, base_theme_style, "Logout")
         self.logout_button.clicked.connect(self.logout)
+
+        # Transfers run in the background, their progress shows below
+        location = (280, 250, 220, 30)
+        self.transfer_entry = self.create_entry(location, base_font, base_theme_style, "Remote file to download")
+
+        location = (280, 300, 100, 30)
+        self.download_button = self.create_button(location, base_font, base_theme_style, "Download")
+        self.download_button.clicked.connect(self.download_file)
+
+        location = (400, 300, 100, 30)
+        self.upload_button = self.create_button(location, base_font, base_theme_style, "Upload")
+        self.upload_button.clicked.connect(self.upload_file)
+
+        location = (300, 350, 200, 30)
+        self.cancel_transfers_button = self.create_button(location, base_font, base_theme_style, "Cancel Transfers")
+        self.cancel_transfers_button.clicked.connect(self.cancel_transfers)
+
+        location = (100, 400, 450, 30)
+        self.transfer_status_label = self.create_label(location, base_font, white_text, "")
         return
     
     def hide_file_system_ui(self):
@@ -100,6 +213,11 @@ class SftpGui(QWidget):
         self.local_files_button.hide()
         self.remote_files_button.hide()
         self.logout_button.hide()
+        self.transfer_entry.hide()
+        self.download_button.hide()
+        self.upload_button.hide()
+        self.cancel_transfers_button.hide()
+        self.transfer_status_label.hide()
         return
 
     def show_file_system_ui(self):
@@ -109,103 +227,172 @@ class SftpGui(QWidget):
         self.local_files_button.show()
         self.remote_files_button.show()
         self.logout_button.show()
+        self.transfer_entry.show()
+        self.download_button.show()
+        self.upload_button.show()
+        self.cancel_transfers_button.show()
+        self.transfer_status_label.show()
         return
 
     def hide_local_files_ui(self):
+        self.stop_listing()
         self.back_button.hide()
         self.fs_status_label.hide()
-        self.file_list_text.hide()
+        self.file_table.hide()
+        self.filter_entry.hide()
         self.show_file_system_ui()
         return
     
     def list_local_files(self):
+        self.show_file_list("Listing local files...")
+        self.start_listing("ls local", "Local files", local=True)
+        return
+    
+    def list_remote_files(self):
+        self.show_file_list("Listing remote files...")
+        self.start_listing("ls remote", "Remote files")
+        return
+
+    # Show the file list window with a status line while the listing runs.
+    def show_file_list(self, status):
         self.hide_file_system_ui()
 
         location = (200, 450, 300, 30)
-        self.fs_status_label = self.create_label(location, base_font, white_text, "Listing local files...")
+        self.fs_status_label = self.create_label(location, base_font, white_text, status)
         self.fs_status_label.show()
         
-        # Local file display window
-        if not hasattr(self, 'file_list_text'):
-            location = (100, 100, 400, 300)
-            self.file_list_text = QTextEdit(self)
-            self.file_list_text.setGeometry(*location)
-            self.file_list_text.setReadOnly(True)
-            self.file_list_text.show()
-
-        else:
-            self.file_list_text.show()
-            
-        #Store original stdout
-        original_stdout = sys.stdout
-
-        #Change stdout to custom widget
-        sys.stdout = QTextEditStream()
+        # File display window, filled a page at a time by FileListModel
+        if not hasattr(self, 'file_table'):
+            location = (100, 60, 400, 30)
+            self.filter_entry = self.create_entry(location, base_font, base_theme_style, "Filter (e.g. *.log)")
+            self.filter_entry.textChanged.connect(self.filter_file_list)
 
-        client.ls(client=os, args="-a", path='.')
-
-        output_list = sys.stdout.output.split('\n')
-        cleaned_output = "\n".join(output_list).replace('\n', '<br>')
-
-        #Formatted string that controls the html styling
-        styled_output = f"<span style='color: white; font-size: 16pt;'>{cleaned_output}</span>"
-
-        self.file_list_text.setHtml(styled_output)
-
-        #Reset back to original stdout
-        sys.stdout = original_stdout
+            location = (100, 100, 400, 300)
+            self.file_model = FileListModel(self)
+            self.file_table = QTableView(self)
+            self.file_table.setGeometry(*location)
+            self.file_table.setStyleSheet(base_theme_style)
+            self.file_table.setModel(self.file_model)
+            self.file_table.setSortingEnabled(True)
+            self.file_table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+            self.file_table.verticalHeader().hide()
+            self.file_table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+            self.file_table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.file_model.clear()
+        self.filter_entry.show()
+        self.file_table.show()
 
         location = (400, 400, 70, 30)
         self.back_button = self.create_button(location, base_font, base_theme_style, "Back")
         self.back_button.show()
         self.back_button.clicked.connect(self.hide_local_files_ui)
-        return
-    
-    def list_remote_files(self):
-        self.hide_file_system_ui()
-
-        location = (200, 450, 300, 30)
-        self.fs_status_label = self.create_label(location, base_font, white_text, "Listing remote files...")
-        self.fs_status_label.show()
-        
-        # Local file display window
-        if not hasattr(self, 'file_list_text'):
-            location = (100, 100, 400, 300)
-            self.file_list_text = QTextEdit(self)
-            self.file_list_text.setGeometry(*location)
-            self.file_list_text.setReadOnly(True)
-            self.file_list_text.show()
-
-        else:
-            self.file_list_text.show()
-            
-        #Store original stdout
-        original_stdout = sys.stdout
 
-        #Change stdout to custom widget
-        sys.stdout = QTextEditStream()
+    # Stream the current directory into the file table, replacing any
+    # listing still running.
+    def start_listing(self, name, done_text, local=False):
+        self.stop_listing()
+        self.listing_task = self.run_task(name, task_queue.stream_listing, '.', self.task_signals.batch.emit,
+                                          handler=lambda task: self.listing_finished(task, done_text),
+                                          local=local)
+
+    def stop_listing(self):
+        if self.listing_task is not None:
+            self.listing_task.cancel()
+            self.listing_task = None
+
+    def on_listing_batch(self, task, batch):
+        # Batches of a listing that was replaced may still be in flight
+        if task is self.listing_task:
+            self.file_model.add_entries(batch)
+            self.fs_status_label.setText(f"{len(self.file_model.view.entries)} entries...")
+
+    def listing_finished(self, task, done_text):
+        if task is not self.listing_task:
+            return
+        self.listing_task = None
+        if task.result.ok:
+            done_text = f"{done_text} ({task.result.value} entries)"
+        self.fs_status_label.setText(self.result_text(task, done_text))
+
+    def filter_file_list(self, text):
+        self.file_model.set_filter(text)
+
+    def result_text(self, task, done_text):
+        if task.result.ok:
+            return done_text
+        if task.result.status == task_queue.CANCELLED:
+            return f"{task.name} cancelled"
+        return f"{task.name} failed: {task.result.error}"
 
-        client.ls(client=self.sftp, args="-a", path='.')
-
-        output_list = sys.stdout.output.split('\n')
-        cleaned_output = "\n".join(output_list).replace('\n', '<br>')
-
-        #Formatted string that controls the html styling
-        styled_output = f"<span style='color: white; font-size: 16pt;'>{cleaned_output}</span>"
-
-        self.file_list_text.setHtml(styled_output)
+    ##############################################################
+    # Background Tasks                                           #
+    ##############################################################
 
-        #Reset back to original stdout
-        sys.stdout = original_stdout
+    # Queue a task on the connection's background threads.  handler, if
+    # given, is called on the GUI thread with the task once it finished.
+    def run_task(self, name, func, *args, handler=None, **kwargs):
+        if self.tasks is None:
+            self.tasks = task_queue.TaskQueue(self.sftp, self.ssh,
+                                              on_progress=self.task_signals.progress.emit,
+                                              on_finished=self.task_signals.finished.emit)
+        task = self.tasks.submit(name, func, *args, **kwargs)
+        if handler is not None:
+            self.task_handlers[task.id] = handler
+        return task
+
+    def on_task_progress(self, task):
+        if task.total_bytes:
+            self.transfer_status_label.setText(task.describe())
+
+    def on_task_finished(self, task):
+        handler = self.task_handlers.pop(task.id, None)
+        if handler is not None:
+            handler(task)
+
+    def stop_tasks(self):
+        self.listing_task = None
+        if self.tasks is not None:
+            self.tasks.shutdown(wait=False)
+            self.tasks = None
+        self.task_handlers.clear()
+
+    def download_file(self):
+        remote_path = self.transfer_entry.text().strip()
+        if not remote_path:
+            self.transfer_status_label.setText("Enter a remote file to download")
+            return
+        local_path = client.get_download_folder_path(remote_path)
+        self.transfer_status_label.setText(f"Queued download of {remote_path}")
+        self.run_task(f"get {posixpath.basename(remote_path)}", task_queue.download, remote_path, local_path,
+                      ssh=self.ssh, handler=self.transfer_finished)
+
+    def upload_file(self):
+        local_path, _ = QFileDialog.getOpenFileName(self, "File to upload")
+        if not local_path:
+            return
+        remote_path = os.path.basename(local_path)
+        self.transfer_status_label.setText(f"Queued upload of {remote_path}")
+        self.run_task(f"put {remote_path}", task_queue.upload, local_path, remote_path,
+                      ssh=self.ssh, handler=self.transfer_finished)
+
+    def transfer_finished(self, task):
+        result = task.result
+        if result.ok:
+            text = (f"{task.name}: {result.bytes_done} bytes in {result.elapsed:.1f}s "
+                    f"({client.format_throughput(result.bytes_done, result.elapsed)})")
+        else:
+            text = self.result_text(task, task.name)
+        self.transfer_status_label.setText(text)
 
-        location = (400, 400, 70, 30)
-        self.back_button = self.create_button(location, base_font, base_theme_style, "Back")
-        self.back_button.show()
-        self.back_button.clicked.connect(self.hide_local_files_ui)
-        return
+    def cancel_transfers(self):
+        if self.tasks is not None:
+            self.tasks.cancel_all()
         
     def logout(self):
+        self.stop_tasks()
         client.disconnect_sftp(self.sftp)
+        connection_pool.release(self.ssh)
+        logger.set_host(None)
         self.hide_file_system_ui()
         self.show_login_ui()
         print('Logging out.')
@@ -377,13 +564,14 @@ class SftpGui(QWidget):
             self.hide_login_ui()
             self.login_status_label.setText("Login Successful!")
             self.connected_host_name = hostname
+            logger.set_host(hostname)
             self.show_file_system_ui()
         else:
             self.login_status_label.setText("Login Failed, Please try again.")
 
     async def connect_sftp(self, hostname, username, password):
         loop = asyncio.get_event_loop()
-        sftp, ssh = await loop.run_in_executor(None, connect_sftp, hostname, username, password)
+        sftp, ssh = await loop.run_in_executor(None, connection_pool.connect, hostname, username, password)
         self.sftp = sftp
         self.ssh = ssh
         return sftp is not None
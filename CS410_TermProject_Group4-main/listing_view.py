@@ -0,0 +1,109 @@
+import fnmatch
+import heapq
+import operator
+
+# Rows handed to the view per fetchMore.
+PAGE_SIZE = 500
+
+class ListingView:
+    """
+    Display state of a directory listing that arrives in batches: every
+    entry received, the rows matching the filter in display order, and how
+    many of those rows the view has been given so far.  Rows past `shown`
+    exist but are only exposed page by page as the user scrolls, so a
+    directory of 200k entries costs the view no more than a few pages.
+
+    While sorted, rows that arrive after the shown ones wait unsorted in
+    `pending` and are merged in once, when the view asks for more rows,
+    instead of re-sorting every row for every batch.
+
+    Kept free of Qt so the GUI model (gui.FileListModel) stays a thin
+    adapter around it.
+    """
+
+    def __init__(self, page_size: int = PAGE_SIZE):
+        self.page_size = page_size
+        self.entries = []
+        self.rows = []
+        self.pending = []
+        self.shown = 0
+        self.pattern = None
+        self.sort_key = None
+        self.reverse = False
+
+    # Add a batch of entries.  Unsorted rows are appended past the shown
+    # ones.  Sorted rows that belong among the shown ones are merged into
+    # them, which can change the shown rows but never their number; the
+    # rest wait in pending.  Returns True if the shown rows changed.
+    def add(self, batch) -> bool:
+        self.entries.extend(batch)
+        matching = [entry for entry in batch if self._matches(entry)]
+        if not matching:
+            return False
+        if self.sort_key is None:
+            self.rows.extend(matching)
+            return False
+        if not self.shown:
+            self.pending.extend(matching)
+            return False
+        key = operator.attrgetter(self.sort_key)
+        last_shown = key(self.rows[self.shown - 1])
+        early = []
+        for entry in matching:
+            if (key(entry) > last_shown) if self.reverse else (key(entry) < last_shown):
+                early.append(entry)
+            else:
+                self.pending.append(entry)
+        if not early:
+            return False
+        # The shown rows and the early ones are both short, merging them
+        # only moves the rows past them once.
+        self.rows[:self.shown] = sorted(self.rows[:self.shown] + early, key=key, reverse=self.reverse)
+        return True
+
+    def can_fetch_more(self) -> bool:
+        return self.shown < len(self.rows) + len(self.pending)
+
+    # Number of rows the next fetch exposes.
+    def fetch_count(self) -> int:
+        return min(self.page_size, len(self.rows) + len(self.pending) - self.shown)
+
+    def show_more(self, count: int) -> None:
+        self._merge_pending()
+        self.shown += count
+
+    # Merge the pending rows into the rows past the shown ones.
+    def _merge_pending(self) -> None:
+        if not self.pending:
+            return
+        key = operator.attrgetter(self.sort_key)
+        self.pending.sort(key=key, reverse=self.reverse)
+        self.rows[self.shown:] = heapq.merge(self.rows[self.shown:], self.pending, key=key, reverse=self.reverse)
+        self.pending = []
+
+    # Only show names matching pattern (fnmatch, or a plain substring when
+    # it has no wildcards).  Rebuilds the rows and starts again at one page.
+    def set_filter(self, pattern: str) -> None:
+        pattern = (pattern or '').strip()
+        if pattern and not any(char in pattern for char in '*?['):
+            pattern = f"*{pattern}*"
+        self.pattern = pattern or None
+        self._rebuild()
+
+    # Sort by a FileEntry attribute ('name', 'size', 'mtime'), or None for
+    # listing order.  Rebuilds the rows and starts again at one page.
+    def sort(self, key, reverse: bool = False) -> None:
+        self.sort_key = key
+        self.reverse = reverse
+        self._rebuild()
+
+    def _rebuild(self) -> None:
+        rows = [entry for entry in self.entries if self._matches(entry)]
+        if self.sort_key is not None:
+            rows.sort(key=operator.attrgetter(self.sort_key), reverse=self.reverse)
+        self.rows = rows
+        self.pending = []
+        self.shown = min(len(rows), self.page_size)
+
+    def _matches(self, entry) -> bool:
+        return self.pattern is None or fnmatch.fnmatch(entry.name.lower(), self.pattern.lower())
@@ -0,0 +1,265 @@
+import bisect
+import mmap
+import os
+import struct
+import time
+from array import array
+from datetime import datetime
+
+from logger import logger
+
+# Sidecar index next to each log file: <log file>.idx
+INDEX_SUFFIX = '.idx'
+INDEX_MAGIC = b'SFTPLOG1'
+# magic, log bytes indexed, number of lines, bytes of host names, whether
+# the times are in order
+_HEADER = struct.Struct('<8sQQI?')
+LEVELS = ('INFO', 'WARNING', 'ERROR')
+SEPARATOR = b' | '
+HOST_PREFIX = b'host='
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+class LogRecord:
+    """
+    One matching log line: its byte offset in the log file, unix time,
+    level, host (None for lines logged outside a session) and the line.
+    """
+
+    __slots__ = ('offset', 'timestamp', 'level', 'host', 'line')
+
+    def __init__(self, offset, timestamp, level, host, line):
+        self.offset = offset
+        self.timestamp = timestamp
+        self.level = level
+        self.host = host
+        self.line = line
+
+class LogIndex:
+    """
+    Index over the lines of one log file: for every line its offset, time,
+    level and host, kept as parallel arrays.  Lines are appended in time
+    order, so a time range is two binary searches (or a plain scan once a
+    line is found out of order); level and host are compared as small
+    integers.  The file is scanned through mmap.
+
+    The index is saved next to the log and on the next open only the bytes
+    appended since are scanned.  A log that shrank is indexed again.
+    """
+
+    def __init__(self, log_file: str):
+        self.log_file = log_file
+        self.index_file = log_file + INDEX_SUFFIX
+        self._reset()
+
+    def _reset(self):
+        self.size = 0
+        self.offsets = array('Q')
+        self.times = array('I')
+        self.levels = array('B')
+        self.hosts = array('H')
+        self.ordered = True
+        # host number -> name, 0 is "no host"
+        self.host_names = ['']
+        self._host_numbers = {}
+        self._stamps = {}
+
+    # Index of log_file, loaded from its sidecar and brought up to date.
+    @classmethod
+    def open(cls, log_file: str) -> 'LogIndex':
+        index = cls(log_file)
+        index.load()
+        if index.update():
+            index.save()
+        return index
+
+    def __len__(self):
+        return len(self.offsets)
+
+    # Index the lines appended since the last update.  Returns how many.
+    def update(self) -> int:
+        size = os.path.getsize(self.log_file)
+        if size < self.size:
+            self._reset()
+        if size == self.size:
+            return 0
+        before = len(self)
+        with open(self.log_file, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                self.size = self._scan(data, self.size, len(data))
+        return len(self) - before
+
+    # Add every complete line in data[start:end].  Returns where the
+    # scan stopped, the start of a line still being written if any.
+    def _scan(self, data, start: int, end: int) -> int:
+        position = start
+        while position < end:
+            newline = data.find(b'\n', position, end)
+            if newline < 0:
+                break
+            self._add_line(data, position, newline)
+            position = newline + 1
+        return position
+
+    # Lines look like "LEVEL | 2024-01-31 10:00:00 | [host=name | ]message".
+    # Anything else (i.e. a continuation of a multi line message) is skipped.
+    def _add_line(self, data, start: int, end: int) -> None:
+        first = data.find(SEPARATOR, start, end)
+        if first < 0:
+            return
+        level = data[start:first]
+        if level not in _LEVEL_NUMBERS:
+            return
+        stamp_start = first + len(SEPARATOR)
+        second = data.find(SEPARATOR, stamp_start, end)
+        if second < 0:
+            return
+        timestamp = self._parse_stamp(data[stamp_start:second])
+        if timestamp is None:
+            return
+        host = 0
+        field = second + len(SEPARATOR)
+        if data[field:field + len(HOST_PREFIX)] == HOST_PREFIX:
+            third = data.find(SEPARATOR, field, end)
+            if third >= 0:
+                host = self._host_number(data[field + len(HOST_PREFIX):third].decode(errors='replace'))
+        if self.times and timestamp < self.times[-1]:
+            self.ordered = False
+        self.offsets.append(start)
+        self.times.append(timestamp)
+        self.levels.append(_LEVEL_NUMBERS[level])
+        self.hosts.append(host)
+
+    # Lines of the same second share a parse.
+    def _parse_stamp(self, stamp: bytes):
+        timestamp = self._stamps.get(stamp)
+        if timestamp is None:
+            try:
+                timestamp = int(datetime.strptime(stamp.decode(), TIMESTAMP_FORMAT).timestamp())
+            except ValueError:
+                return None
+            if len(self._stamps) > 4096:
+                self._stamps.clear()
+            self._stamps[stamp] = timestamp
+        return timestamp
+
+    def _host_number(self, host: str) -> int:
+        number = self._host_numbers.get(host)
+        if number is None:
+            number = self._host_numbers[host] = len(self.host_names)
+            self.host_names.append(host)
+        return number
+
+    # Positions (into the arrays) of the lines matching every given filter.
+    #   - level: 'INFO', 'WARNING' or 'ERROR'
+    #   - host: hostname as tagged by logger.set_host
+    #   - since, until: unix times, both inclusive
+    def query(self, level: str = None, host: str = None, since: float = None, until: float = None) -> list:
+        first, last = 0, len(self)
+        if self.ordered:
+            if since is not None:
+                first = bisect.bisect_left(self.times, since)
+            if until is not None:
+                last = bisect.bisect_right(self.times, until)
+        elif since is not None or until is not None:
+            low = float('-inf') if since is None else since
+            high = float('inf') if until is None else until
+            return [position for position in self.query(level, host) if low <= self.times[position] <= high]
+        level_number = None if level is None else _LEVEL_NUMBERS.get(level.upper().encode(), -1)
+        host_number = None if host is None else self._host_numbers.get(host, -1)
+        return [position for position in range(first, last)
+                if (level_number is None or self.levels[position] == level_number)
+                and (host_number is None or self.hosts[position] == host_number)]
+
+    def load(self) -> bool:
+        try:
+            with open(self.index_file, 'rb') as f:
+                magic, size, count, hosts_length, ordered = _HEADER.unpack(f.read(_HEADER.size))
+                if magic != INDEX_MAGIC:
+                    return False
+                host_names = f.read(hosts_length).decode().split('\n') if hosts_length else []
+                columns = [array(column.typecode) for column in (self.offsets, self.times, self.levels, self.hosts)]
+                for column in columns:
+                    column.fromfile(f, count)
+        except (OSError, EOFError, struct.error, UnicodeDecodeError):
+            self._reset()
+            return False
+        self._reset()
+        self.size = size
+        self.ordered = ordered
+        self.offsets, self.times, self.levels, self.hosts = columns
+        for host in host_names:
+            self._host_number(host)
+        return True
+
+    # Write the index next to the log, replacing the old one in one step.
+    def save(self) -> None:
+        host_names = '\n'.join(self.host_names[1:]).encode()
+        temp = self.index_file + '.part'
+        try:
+            with open(temp, 'wb') as f:
+                f.write(_HEADER.pack(INDEX_MAGIC, self.size, len(self), len(host_names), self.ordered))
+                f.write(host_names)
+                for column in (self.offsets, self.times, self.levels, self.hosts):
+                    column.tofile(f)
+            os.replace(temp, self.index_file)
+        except OSError as e:
+            print(f"Could not save log index {self.index_file}: {e}")
+
+_LEVEL_NUMBERS = {level.encode(): number for number, level in enumerate(LEVELS)}
+
+# Log file of a day given as MM-DD-YYYY, today's when None.
+def log_file_for(day: str = None) -> str:
+    if day is None:
+        return logger.log_file
+    return os.path.join(logger.default_path, f'{day}_rolling_log.txt')
+
+# Parse "HH:MM", "HH:MM:SS" on the log's day, or a full "YYYY-MM-DD HH:MM[:SS]".
+def parse_time(text: str, day: str = None) -> float:
+    if day is None:
+        day = datetime.now().strftime('%m-%d-%Y')
+    for form, prefix in (('%m-%d-%Y %H:%M:%S', day + ' '), ('%m-%d-%Y %H:%M', day + ' '),
+                         ('%Y-%m-%d %H:%M:%S', ''), ('%Y-%m-%d %H:%M', '')):
+        try:
+            return datetime.strptime(prefix + text, form).timestamp()
+        except ValueError:
+            continue
+    raise ValueError(f"Invalid time {text}, use HH:MM or YYYY-MM-DD HH:MM")
+
+# Lines of log_file matching every given filter, oldest first.  text is a
+# plain substring searched for in the lines the index selected.
+def search_log(log_file: str, level: str = None, host: str = None, since: float = None, until: float = None,
+               text: str = None, limit: int = None) -> list:
+    logger.flush()
+    if not os.path.exists(log_file):
+        return []
+    index = LogIndex.open(log_file)
+    if not len(index):
+        return []
+    needle = text.encode() if text else None
+    records = []
+    with open(log_file, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for position in index.query(level, host, since, until):
+                offset = index.offsets[position]
+                end = data.find(b'\n', offset)
+                if needle is not None and data.find(needle, offset, end) < 0:
+                    continue
+                records.append(LogRecord(offset, index.times[position], LEVELS[index.levels[position]],
+                                         index.host_names[index.hosts[position]] or None,
+                                         data[offset:end].decode(errors='replace')))
+                if limit is not None and len(records) >= limit:
+                    break
+    return records
+
+# Print the matching lines of a day's log, used by the "logs" command.
+def print_log_search(day: str = None, level: str = None, host: str = None, since: str = None, until: str = None,
+                     text: str = None, limit: int = None) -> int:
+    start_time = time.monotonic()
+    records = search_log(log_file_for(day), level, host,
+                         parse_time(since, day) if since else None,
+                         parse_time(until, day) if until else None,
+                         text, limit)
+    for record in records:
+        print(record.line)
+    print(f"{len(records)} matching lines ({time.monotonic() - start_time:.2f}s)")
+    return len(records)
@@ -1,13 +1,54 @@
+import atexit
+import mmap
 import os
+import queue
+import threading
+import time
 from datetime import datetime
 
+# Messages waiting for the writer thread at most.
+LOG_QUEUE_SIZE = 10000
+# Messages written per batch at most.
+LOG_BATCH_SIZE = 512
+# Seconds a written message may sit in the file buffer before it is flushed.
+LOG_FLUSH_INTERVAL = 1.0
+
+# What log calls do when the queue is full: wait for the writer, or drop
+# the message and count it.
+BLOCK = 'block'
+DROP = 'drop'
+
 class Logger:
-    def __init__(self):
+    """
+    Writes log lines from a background thread.  log_* calls only queue the
+    line; the writer takes them off the queue in batches, appends each batch
+    with one write through a file handle it keeps open, and flushes at least
+    every flush_interval seconds.  flush() waits until everything logged so
+    far is on disk, and runs at exit.
+    """
+
+    def __init__(self, queue_size: int = LOG_QUEUE_SIZE, policy: str = BLOCK,
+                 flush_interval: float = LOG_FLUSH_INTERVAL):
         super().__init__()
+        if policy not in (BLOCK, DROP):
+            raise ValueError(f"Unknown log queue policy: {policy}")
+        self.policy = policy
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        # Server the session is connected to, tagged on every line while set
+        self.host = None
         self.default_path = os.path.join(os.getcwd(), 'Logs')
         if not os.path.exists(self.default_path):
             os.makedirs(self.default_path)
         self.update_log_file_name()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        # file path -> open handle, only used by the writer thread
+        self._handles = {}
+        self._reported_dropped = 0
+        atexit.register(self.close)
 
     def update_log_file_name(self):
         current_date = datetime.now().strftime('%m-%d-%Y')
@@ -15,38 +56,160 @@ class Logger:
 
     def log_info(self, message):
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        log_message = f'INFO | {timestamp} | {message}'
+        log_message = f'INFO | {timestamp} | {self._host_field()}{message}'
         self.write_to_file(self.log_file, log_message)
         return timestamp
 
     def log_warning(self, message):
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        log_message = f'WARNING | {timestamp} | {message}'
+        log_message = f'WARNING | {timestamp} | {self._host_field()}{message}'
         self.write_to_file(self.log_file, log_message)
         return timestamp
 
     def log_error(self, message):
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        log_message = f'ERROR | {timestamp} | {message}'
+        log_message = f'ERROR | {timestamp} | {self._host_field()}{message}'
         self.write_to_file(self.log_file, log_message)
         return timestamp
 
+    # Tag the lines logged from now on with hostname ("host=name" after the
+    # timestamp) so log_search can find a server's lines.  None stops it.
+    def set_host(self, hostname):
+        self.host = hostname or None
+
+    def _host_field(self):
+        return f'host={self.host} | ' if self.host else ''
+
+    # Queue a line for file_path.  Once the logger is closed lines are
+    # written directly, so logging from atexit handlers still works.
     def write_to_file(self, file_path, message):
-        try:
-            with open(file_path, 'a') as f:
-                f.write(f'{message}\n')
-        except Exception as e:
-            print(e)
+        if self._closed:
+            self._write_now(file_path, message)
+            return 0
+        self._start()
+        if self.policy == BLOCK:
+            self._queue.put((file_path, message))
+        else:
+            try:
+                self._queue.put_nowait((file_path, message))
+            except queue.Full:
+                with self._lock:
+                    self.dropped += 1
         return 0
-    
+
+    # Wait until every line logged so far is written and flushed.
+    def flush(self, timeout: float = None) -> bool:
+        if self._closed or self._thread is None:
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    # Flush, stop the writer and close the log files.
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    # Whether file_path contains search_string anywhere.  The file is mapped
+    # and searched in one find instead of line by line.
     def contains_string(self, file_path, search_string):
+        self.flush()
         try:
-            with open(file_path, 'r') as f:
-                for line in f:
-                    if search_string in line:
-                        return True
+            with open(file_path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return False
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    return data.find(search_string.encode()) >= 0
         except Exception as e:
             print(e)
         return False
 
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._write_loop, name='log-writer', daemon=True)
+                self._thread.start()
+
+    def _write_loop(self):
+        last_flush = time.monotonic()
+        running = True
+        while running:
+            try:
+                items = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                items = []
+            while items and len(items) < LOG_BATCH_SIZE:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = {}
+            waiting = []
+            for item in items:
+                if item is None:
+                    running = False
+                elif isinstance(item, threading.Event):
+                    waiting.append(item)
+                else:
+                    lines.setdefault(item[0], []).append(item[1])
+            self._note_dropped(lines)
+            for file_path, messages in lines.items():
+                self._write_batch(file_path, messages)
+
+            if waiting or not running or time.monotonic() - last_flush >= self.flush_interval:
+                self._flush_handles()
+                last_flush = time.monotonic()
+            for done in waiting:
+                done.set()
+        for handle in self._handles.values():
+            handle.close()
+        self._handles.clear()
+
+    # Record how many lines the DROP policy threw away since the last batch.
+    def _note_dropped(self, lines):
+        with self._lock:
+            dropped = self.dropped - self._reported_dropped
+            self._reported_dropped = self.dropped
+        if dropped:
+            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            lines.setdefault(self.log_file, []).append(
+                f'WARNING | {timestamp} | Log queue full, dropped {dropped} messages')
+
+    def _write_batch(self, file_path, messages):
+        try:
+            handle = self._handles.get(file_path)
+            if handle is None:
+                # Only today's file stays open
+                for old_handle in self._handles.values():
+                    old_handle.close()
+                self._handles.clear()
+                handle = self._handles[file_path] = open(file_path, 'a')
+            handle.write(''.join(f'{message}\n' for message in messages))
+        except Exception as e:
+            self._handles.pop(file_path, None)
+            print(e)
+
+    def _flush_handles(self):
+        for handle in self._handles.values():
+            try:
+                handle.flush()
+            except Exception as e:
+                print(e)
+
+    def _write_now(self, file_path, message):
+        try:
+            with open(file_path, 'a') as f:
+                f.write(f'{message}\n')
+        except Exception as e:
+            print(e)
+
 logger = Logger()
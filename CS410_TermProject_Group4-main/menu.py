@@ -2,8 +2,16 @@ from sftp_client import connect_sftp
 from sftp_client import ls
 from sftp_client import file_diff
 from connection_storage import connection_info
+from connection_pool import connection_pool
 from inputimeout import inputimeout, TimeoutOccurred
 import sftp_client as client
+import directory_sync
+import log_search
+import rate_limit
+import upload_pipeline
+import transfer_scheduler
+from transfer_scheduler import scheduler
+from logger import logger
 import os
 import getpass
 
@@ -35,8 +43,8 @@ def existing_connection_prompts():
     option = input("Enter an alias from the list above to connect to. ")
     connection = connection_info.get_connection_by_alias(option)
     if(connection != None):
-        sftp , ssh = connect_sftp(connection['hostname'],connection['username'],connection['password'])
-        logged_on_menu(sftp , connection['hostname'], ssh)
+        sftp , ssh = connection_pool.connect_alias(option)
+        logged_on_menu(sftp , connection['hostname'], ssh, option)
     else:
         print('Invalid Alias.\n')
 
@@ -46,26 +54,36 @@ def new_connection_prompts():
         hostname = input("Hostname: ")
         username = input("Username: ")
         user_pass = getpass.getpass("Password: ")
-        sftp , ssh = connect_sftp(hostname,username,user_pass)
+        compress = input("Compress the connection (helps on slow links)? Enter y or n [n]: ").strip().lower() == 'y'
+        sftp , ssh = connection_pool.connect(hostname,username,user_pass,compress=compress)
         if(sftp != None):
+            host = f"{username}@{hostname}"
             while True:
                 option = input("Would you like to store the connection information? Enter y or n. ")
                 if(option == 'y'):
                     alias = input("Enter an alias for your new connection. ")
-                    connection_info.store_new_connection(alias,hostname,username,user_pass)
+                    connection_info.store_new_connection(alias,hostname,username,user_pass,compress)
+                    host = alias
                     break
                 elif(option == 'n'):
                     break
                 else:
                     print('Invalid entry, enter y or n.')
-            logged_on_menu(sftp , hostname, ssh)
+            logged_on_menu(sftp , hostname, ssh, host)
         else:
             print('\nConnection failed - please verify you have the correct hostname and username/password.')
     except Exception as e:
         print(f"Error: {e}")
 
-def logged_on_menu(sftp, hostname, ssh):
+# host is the stored connection alias, or "user@hostname" for a login
+# that was not stored; queued jobs (see the jobs command) are kept under it.
+def logged_on_menu(sftp, hostname, ssh, host=None):
     print(f'\n\nConnected to {hostname}.\n')
+    logger.set_host(hostname)
+    host = host or hostname
+    if ssh:
+        scheduler.register_host(host, ssh)
+        scheduler.start()
     while True:
         option = user_input(sftp)
         if not option:
@@ -87,27 +105,51 @@ def logged_on_menu(sftp, hostname, ssh):
                     client.disconnect_sftp(sftp)
                 except Exception as e:
                     print(f"Error: {e}")
+                logger.set_host(None)
                 break
             case 'ls': 
-                ls(client=sftp, args="-a", path='.')
+                fresh, arguments = pop_flag(arguments, '--fresh')
+                long_listing, arguments = pop_flag(arguments, '-l')
+                ls(client=sftp, args="-a" + (" -l" if long_listing else "") + (" --fresh" if fresh else ""),
+                   path=arguments[0] if arguments else '.')
             case 'lsl': 
-                ls(client=os, args="-a", path='.')
+                long_listing, arguments = pop_flag(arguments, '-l')
+                ls(client=os, args="-al" if long_listing else "-a", path='.')
             case 'get':
                 try:
+                    workers, arguments = pop_option(arguments, '-j', client.DEFAULT_GET_WORKERS)
+                    chunk_size, arguments = pop_option(arguments, '-c', client.DEFAULT_CHUNK_SIZE)
+                    window, arguments = pop_option(arguments, '-w', client.DEFAULT_PREFETCH_WINDOW)
+                    segments, arguments = pop_option(arguments, '-S', 1)
+                    large_file, arguments = pop_flag(arguments, '-L')
+                    resume, arguments = pop_flag(arguments, '-r')
+                    delta, arguments = pop_flag(arguments, '-d')
+                    compress, arguments = pop_compress(arguments)
+                    limit, arguments = pop_rate(arguments)
                     if len(arguments) == 1: 
-                        client.get_file(sftp, arguments[0])
+                        client.get_file(sftp, arguments[0], large_file, chunk_size, window, segments, ssh, resume, delta,
+                                        compress, limit)
                     else:
-                        client.get_multiple(sftp, arguments)
+                        client.get_multiple(sftp, arguments, ssh, workers=workers, limit=limit)
                 except Exception as e:
                     print(f"Error: {e}")
             case 'put':
                 try:
-                    client.put_file(sftp)
+                    segments, arguments = pop_option(arguments, '-S', 1)
+                    large_file, arguments = pop_flag(arguments, '-L')
+                    resume, arguments = pop_flag(arguments, '-r')
+                    delta, arguments = pop_flag(arguments, '-d')
+                    compress, arguments = pop_compress(arguments)
+                    limit, arguments = pop_rate(arguments)
+                    client.put_file(sftp, segments=segments, ssh=ssh, resume=resume, delta=delta, compress=compress,
+                                    limit=limit, large_file=large_file)
                 except Exception as e:
                     print(f"Error: {e}")
             case 'putm':
                 try:
-                    client.put_multiple_files(sftp)
+                    workers, arguments = pop_option(arguments, '-j', upload_pipeline.DEFAULT_UPLOAD_WORKERS)
+                    limit, arguments = pop_rate(arguments)
+                    client.put_multiple_files(sftp, ssh, workers, limit)
                 except Exception as e:
                     print(f"Error: {e}")
             case 'mkdir':
@@ -159,7 +201,7 @@ def logged_on_menu(sftp, hostname, ssh):
                 if arguments:
                     try:
                         if len(arguments) > 1:
-                            client.rmdir(sftp, arguments[0], arguments[1:])
+                            client.rmdir(sftp, arguments[0], arguments[1:], ssh)
                         else:
                             client.rmdir(sftp, arguments[0])
                     except Exception as e:
@@ -177,27 +219,203 @@ def logged_on_menu(sftp, hostname, ssh):
             case "search_local":
                 client.search_files_local()
             case "search_remote":
+                max_depth, arguments = pop_option(arguments, '--depth', None)
+                fresh, arguments = pop_flag(arguments, '--fresh')
+                exclude = []
+                while '--exclude' in arguments:
+                    index = arguments.index('--exclude')
+                    exclude += arguments[index + 1:index + 2]
+                    arguments = arguments[:index] + arguments[index + 2:]
                 if len(arguments) == 2:
                     remote_dir = arguments[0]
                     file_pattern = arguments[1]
                     try:
-                        client.search_files_remote(sftp, remote_dir, file_pattern)
+                        client.search_files_remote(sftp, remote_dir, file_pattern, ssh, max_depth, exclude, fresh=fresh)
                     except Exception as e:
                         print(e)
                 else:
                     print("Error: 'search_remote' command requires a directory and a pattern")
+            case 'sync':
+                try:
+                    workers, arguments = pop_option(arguments, '-j', directory_sync.DEFAULT_SYNC_WORKERS)
+                    pull, arguments = pop_flag(arguments, '--pull')
+                    delete, arguments = pop_flag(arguments, '--delete')
+                    checksum, arguments = pop_flag(arguments, '--checksum')
+                    dry_run, arguments = pop_flag(arguments, '-n')
+                    limit, arguments = pop_rate(arguments)
+                    if len(arguments) == 2:
+                        directory_sync.sync_directories(sftp, arguments[0], arguments[1], ssh, pull=pull,
+                                                        delete=delete, checksum=checksum,
+                                                        dry_run=dry_run, workers=workers, limit=limit)
+                    else:
+                        print("Error: 'sync' command requires a local and a remote directory")
+                except Exception as e:
+                    print(f"Error: {e}")
             case 'diff':
+                streaming, arguments = pop_flag(arguments, '--stream')
                 if len(arguments) == 2:
                     try:
-                        file_diff(sftp, arguments[0], arguments[1])
+                        file_diff(sftp, arguments[0], arguments[1], streaming=streaming or None, ssh=ssh)
                     except Exception as e:
                         print(f"Error: {e}")
                 else:
                     print("Error: 'diff' command requires two remote file paths to compare")
 
+            case 'logs':
+                try:
+                    level, arguments = pop_text_option(arguments, '--level')
+                    host, arguments = pop_text_option(arguments, '--host')
+                    since, arguments = pop_text_option(arguments, '--since')
+                    until, arguments = pop_text_option(arguments, '--until')
+                    day, arguments = pop_text_option(arguments, '--date')
+                    limit, arguments = pop_option(arguments, '-n', None)
+                    log_search.print_log_search(day, level, host, since, until, ' '.join(arguments) or None, limit)
+                except Exception as e:
+                    print(f"Error: {e}")
+
+            case 'jobs':
+                try:
+                    manage_jobs(sftp, host, arguments)
+                except Exception as e:
+                    print(f"Error: {e}")
+
+            case 'limit':
+                try:
+                    set_limits(arguments)
+                except Exception as e:
+                    print(f"Error: {e}")
+
             case _:
                 print("Unknown command. Enter 'help' for available commands.")
 
+    # The transport stays pooled for reuse (and queued jobs) until idle.
+    if ssh:
+        connection_pool.release(ssh)
+
+# Remove an option and its integer value (i.e. "-j 4") from the argument
+# list.  Returns the value (or default if the option is missing) and the
+# remaining arguments.
+def pop_option(arguments, flag, default):
+    if flag not in arguments:
+        return default, arguments
+    index = arguments.index(flag)
+    if index + 1 >= len(arguments):
+        raise ValueError(f"{flag} requires a value")
+    value = int(arguments[index + 1])
+    return value, arguments[:index] + arguments[index + 2:]
+
+# Remove an option and its text value (i.e. "--host example.com").  Returns
+# the value (or default) and the remaining arguments.  --since and --until
+# may have a date before the time ("--since 2024-01-31 10:00").
+def pop_text_option(arguments, flag, default=None):
+    if flag not in arguments:
+        return default, arguments
+    index = arguments.index(flag)
+    if index + 1 >= len(arguments):
+        raise ValueError(f"{flag} requires a value")
+    end = index + 2
+    if (flag in ('--since', '--until') and end < len(arguments)
+            and arguments[index + 1].count('-') == 2 and ':' in arguments[end]):
+        end += 1
+    return ' '.join(arguments[index + 1:end]), arguments[:index] + arguments[end:]
+
+# Remove "--limit RATE" (i.e. "--limit 2M") from the argument list.
+# Returns the rate in bytes per second (None for no limit) and the
+# remaining arguments.
+def pop_rate(arguments):
+    rate, arguments = pop_text_option(arguments, '--limit')
+    return (rate_limit.parse_rate(rate) if rate else None), arguments
+
+# The limit command: "limit" shows the limits in force, "limit RATE" sets
+# the global limit and "limit RATE --alias NAME" the limit of a stored
+# connection (kept with it).  --fair shares every limit equally between
+# the transfers using it, --no-fair goes back to first come first served.
+def set_limits(arguments):
+    fair, arguments = pop_flag(arguments, '--fair')
+    no_fair, arguments = pop_flag(arguments, '--no-fair')
+    alias, arguments = pop_text_option(arguments, '--alias')
+    if fair or no_fair:
+        rate_limit.rate_limiter.set_fair(fair)
+    if arguments:
+        rate = rate_limit.parse_rate(arguments[0])
+        if alias:
+            rate_limit.rate_limiter.set_alias_rate(alias, rate)
+            if not connection_info.set_rate_limit(alias, rate):
+                print(f"{alias} is not a stored connection, the limit lasts until exit")
+        else:
+            rate_limit.rate_limiter.set_global_rate(rate)
+    print(f"Bandwidth limits: {rate_limit.rate_limiter.describe()}")
+
+# The jobs command, managing the background transfer queue:
+#   jobs [--all]                     list queued, running and paused jobs
+#   jobs get REMOTE [LOCAL] [-p N]   queue a download (into ./downloads)
+#   jobs put LOCAL [REMOTE] [-p N]   queue an upload
+#   jobs pause|resume|cancel ID|all
+#   jobs priority ID N               change the priority of a job
+#   jobs hostlimit N                 transfers at a time against this host
+#   jobs clear                       forget finished jobs
+# get and put also take --limit RATE.  Higher priorities run first.
+def manage_jobs(sftp, host, arguments):
+    action = arguments[0].lower() if arguments else 'list'
+    arguments = arguments[1:]
+    match action:
+        case 'list' | '--all':
+            jobs = scheduler.jobs(include_finished=action == '--all' or '--all' in arguments)
+            for job in jobs:
+                print(job.describe())
+            print(f"{len(jobs)} jobs")
+        case 'get' | 'put':
+            priority, arguments = pop_option(arguments, '-p', 0)
+            limit, arguments = pop_rate(arguments)
+            if not arguments:
+                raise ValueError(f"jobs {action} requires a source path")
+            if action == 'get':
+                source = transfer_scheduler.remote_path_for(sftp, arguments[0])
+                destination = os.path.abspath(arguments[1] if len(arguments) > 1
+                                              else client.get_download_folder_path(source))
+            else:
+                source = os.path.abspath(arguments[0])
+                if not os.path.isfile(source):
+                    raise ValueError(f"{source} is not a file")
+                destination = transfer_scheduler.remote_path_for(
+                    sftp, arguments[1] if len(arguments) > 1 else os.path.basename(source))
+            job_id = scheduler.enqueue(action, host, source, destination, priority, limit)
+            print(f"Queued job {job_id}")
+        case 'pause' | 'resume' | 'cancel':
+            if not arguments:
+                raise ValueError(f"jobs {action} requires a job id or all")
+            job_id = None if arguments[0].lower() == 'all' else int(arguments[0])
+            count = getattr(scheduler, action)(job_id)
+            print(f"{ {'pause': 'Paused', 'resume': 'Queued', 'cancel': 'Cancelled'}[action]} {count} jobs")
+        case 'priority':
+            if len(arguments) < 2:
+                raise ValueError("jobs priority requires a job id and a priority")
+            if not scheduler.set_priority(int(arguments[0]), int(arguments[1])):
+                print(f"No job {arguments[0]}")
+        case 'hostlimit':
+            if arguments:
+                scheduler.set_host_concurrency(host, int(arguments[0]))
+            print(f"At most {scheduler.host_concurrency_of(host)} transfers at a time to {host}")
+        case 'clear':
+            print(f"Removed {scheduler.clear_finished()} finished jobs")
+        case _:
+            raise ValueError(f"Unknown jobs action {action}, enter 'help' for available commands")
+
+# Remove a flag (i.e. "-L") from the argument list.  Returns whether the
+# flag was present and the remaining arguments.
+def pop_flag(arguments, flag):
+    if flag not in arguments:
+        return False, arguments
+    return True, [argument for argument in arguments if argument != flag]
+
+# -z forces gzip compression of a transfer, -Z turns it off, without
+# either the transfer decides by itself.  Returns True, False or None and
+# the remaining arguments.
+def pop_compress(arguments):
+    force, arguments = pop_flag(arguments, '-z')
+    never, arguments = pop_flag(arguments, '-Z')
+    return (True if force else False if never else None), arguments
+
 def get_option(prompt: str) -> int:
     while True:
         option = input(prompt)
@@ -210,20 +428,25 @@ def print_help_string():
     print('\n')
     print("Available commands (commands are case insensitive):")
     print("exit : Log off from server")
-    print("ls : List files in remote directory")
-    print("lsl : List files in local directory")
-    print("get *name of file*: Copy remote file to local machine")
-    print("get multiple : Copy multiple remote files to local machine")
-    print("put: Copy local file to remote")
+    print("ls [path] [-l] [--fresh]: List files in remote directory, -l shows mode, size and time, --fresh skips the listing cache")
+    print("lsl [-l]: List files in local directory")
+    print("get *name of file* [-L] [-c chunk size] [-w window] [-S segments] [-r] [-d] [-z|-Z] [--limit RATE]: Copy remote file to local machine, -L pipelines large files, -S splits it across parallel channels, -r resumes an interrupted download, -d only fetches changed blocks, -z/-Z force or disable gzip compression (chosen automatically otherwise), --limit caps its bandwidth (i.e. 500K, 2M)")
+    print("get *file1* *file2* ... [-j workers] [--limit RATE]: Copy multiple remote files to local machine in parallel")
+    print("put [-L] [-S segments] [-r] [-d] [-z|-Z] [--limit RATE]: Copy local file to remote, -L uploads it from a memory map, -S splits it across parallel channels, -r resumes an interrupted upload, -d only sends changed blocks, -z/-Z force or disable gzip compression (chosen automatically otherwise), --limit caps its bandwidth")
     print("mkdir *name of new directory*: Create Directory on Remote Server")
-    print("putm: Copy multiple local files to remote")
+    print("putm [-j workers] [--limit RATE]: Copy files, directories and glob patterns (i.e. dist, *.whl) to remote in parallel")
     print('cd *name of directory*: Change directory')
     print('mv *file/path to rename* *new file name/new path*: rename/move  file on the remote server')
     print('mvl *file/path to rename* *new file name/new path*: rename/move  file locally')
     print("cpdir: Copy a directory on Remote server")
     print("search_local: Search for files locally. Example: enter /path/to/directory then *.txt")
-    print("search_remote *directory* *pattern*: Search for files in remote server matching the pattern")
-    print("diff *directory/path to/remote_file1* *directory/to/remote_file2*: Compare two files and display differences")
+    print("search_remote *directory* *pattern* [--depth N] [--exclude pattern] [--fresh]: Search for files in remote server matching the pattern")
+    print("sync *local dir* *remote dir* [--pull] [--delete] [--checksum] [-n] [-j workers] [--limit RATE]: Copy only new or changed files, --pull copies remote to local, -n shows what would change, --limit caps the bandwidth of each file")
+    print("diff *directory/path to/remote_file1* *directory/to/remote_file2* [--stream]: Compare two files and display differences, large files (or --stream) are diffed in bounded memory and paged")
+    print("logs [text] [--level L] [--host H] [--since HH:MM] [--until HH:MM] [--date MM-DD-YYYY] [-n limit]: Search the log, i.e. errors between 10:00 and 11:00 for a host")
+    print("jobs [--all] | jobs get *remote* [local] | jobs put *local* [remote] [-p priority] [--limit RATE]: Queue transfers to run in the background, highest priority first; queued jobs survive a restart")
+    print("jobs pause|resume|cancel *id|all* | jobs priority *id* *N* | jobs hostlimit *N* | jobs clear: Manage queued jobs, hostlimit caps transfers at a time to this server")
+    print("limit [RATE] [--alias name] [--fair|--no-fair]: Show or set the bandwidth limit for all transfers or a stored connection (off removes it), --fair shares it equally between running transfers")
     print('\n')
 
 def user_input(sftp):
@@ -0,0 +1,310 @@
+import re
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+import paramiko
+
+from remote_cache import session_of
+
+# Bytes a bucket may save up while idle, in seconds of its rate, so a
+# transfer that pauses can not burst far above the limit afterwards.
+BURST_SECONDS = 0.5
+# Smallest burst, large enough for one SFTP request.
+MIN_BURST = 64 * 1024
+# Longest single sleep while waiting for tokens, so rate changes made
+# while a transfer waits take effect quickly.
+MAX_WAIT = 0.25
+
+class TransferStopped(Exception):
+    pass
+
+class TokenBucket:
+    """
+    Token bucket of `rate` bytes per second; None means unlimited.  A
+    consumer waits until the bucket holds tokens and then takes what it
+    needs, going into debt for blocks larger than the burst, so the rate
+    holds on average whatever the block size.
+    """
+
+    def __init__(self, rate: float = None):
+        self._lock = threading.Lock()
+        self.rate = None
+        self.burst = 0
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.set_rate(rate)
+
+    # Change the rate, also while transfers are waiting on the bucket.
+    def set_rate(self, rate: float = None) -> None:
+        with self._lock:
+            self._refill()
+            self.rate = rate if rate and rate > 0 else None
+            self.burst = max(self.rate * BURST_SECONDS, MIN_BURST) if self.rate else 0
+            self.tokens = min(self.tokens, self.burst)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Wait until num_bytes may be sent.
+    def consume(self, num_bytes: int) -> None:
+        while True:
+            with self._lock:
+                if self.rate is None:
+                    return
+                self._refill()
+                if self.tokens > 0:
+                    self.tokens -= num_bytes
+                    return
+                wait = max(-self.tokens / self.rate, 0.001)
+            time.sleep(min(wait, MAX_WAIT))
+
+class SharedLimit:
+    """
+    A rate shared by several transfers.  Normally they all take from one
+    bucket, first come first served.  With fair set every transfer gets its
+    own bucket at an equal share of the rate, recomputed as transfers start
+    and finish, so a fast transfer can not starve a slow one.
+    """
+
+    def __init__(self, rate: float = None, fair: bool = False):
+        self._lock = threading.Lock()
+        self.rate = rate
+        self.fair = fair
+        self.bucket = TokenBucket(rate)
+        # transfer -> its share of the rate
+        self.members = {}
+
+    def set_rate(self, rate: float = None) -> None:
+        with self._lock:
+            self.rate = rate
+            self.bucket.set_rate(rate)
+            self._rebalance()
+
+    def set_fair(self, fair: bool) -> None:
+        with self._lock:
+            self.fair = fair
+            self._rebalance()
+
+    def join(self, transfer) -> None:
+        with self._lock:
+            self.members[transfer] = TokenBucket()
+            self._rebalance()
+
+    def leave(self, transfer) -> None:
+        with self._lock:
+            self.members.pop(transfer, None)
+            self._rebalance()
+
+    def bucket_for(self, transfer) -> TokenBucket:
+        if self.fair:
+            return self.members.get(transfer, self.bucket)
+        return self.bucket
+
+    def _rebalance(self) -> None:
+        share = self.rate / len(self.members) if self.rate and self.members else None
+        for bucket in self.members.values():
+            bucket.set_rate(share)
+
+class Transfer:
+    """
+    One running transfer.  Every block it moves is taken from its own
+    bucket (the per-transfer limit) and from each shared limit it belongs
+    to (its connection alias and the global limit).  After stop() the next
+    block raises TransferStopped, which ends the transfer from whatever
+    thread is moving it.  progress, if given, is called with bytes_done
+    after every block; an exception it raises ends the transfer as well.
+    """
+
+    def __init__(self, limits, rate: float = None, progress=None):
+        self.bucket = TokenBucket(rate)
+        self.limits = limits
+        self.progress = progress
+        self.bytes_done = 0
+        self._stopped = threading.Event()
+
+    def set_rate(self, rate: float = None) -> None:
+        self.bucket.set_rate(rate)
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def consume(self, num_bytes: int) -> None:
+        if self._stopped.is_set():
+            raise TransferStopped()
+        if num_bytes <= 0:
+            return
+        self.bucket.consume(num_bytes)
+        for limit in self.limits:
+            limit.bucket_for(self).consume(num_bytes)
+        self.bytes_done += num_bytes
+        if self.progress is not None:
+            self.progress(self.bytes_done)
+
+class RateLimiter:
+    """
+    Bandwidth limits for every transfer in sftp_client: a global limit, a
+    limit per stored connection alias and a limit per transfer, all in
+    bytes per second and changeable while transfers run.  Transfers are
+    opened with transfer(); the transfer code throttles through the
+    module's throttle() and callback() hooks.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.global_limit = SharedLimit()
+        # alias -> SharedLimit
+        self.alias_limits = {}
+        # session -> alias it was opened for
+        self._aliases = weakref.WeakKeyDictionary()
+        self.fair = False
+        self.transfers = []
+
+    def set_global_rate(self, rate: float = None) -> None:
+        self.global_limit.set_rate(rate)
+
+    def set_alias_rate(self, alias: str, rate: float = None) -> None:
+        self._alias_limit(alias).set_rate(rate)
+
+    # Share every limit equally between the transfers using it (True) or
+    # first come first served (False).
+    def set_fair(self, fair: bool) -> None:
+        with self._lock:
+            self.fair = fair
+            limits = [self.global_limit] + list(self.alias_limits.values())
+        for limit in limits:
+            limit.set_fair(fair)
+
+    # Remember that sftp was opened for the stored connection alias, so its
+    # transfers count against that alias's limit.
+    def bind(self, sftp: paramiko.SFTPClient, alias: str) -> None:
+        with self._lock:
+            self._aliases[session_of(sftp)] = alias
+
+    def alias_of(self, sftp: paramiko.SFTPClient):
+        if sftp is None:
+            return None
+        with self._lock:
+            return self._aliases.get(session_of(sftp))
+
+    def _alias_limit(self, alias: str) -> SharedLimit:
+        with self._lock:
+            limit = self.alias_limits.get(alias)
+            if limit is None:
+                limit = self.alias_limits[alias] = SharedLimit(fair=self.fair)
+            return limit
+
+    # Describe the limits in force, i.e. for the "limit" command.
+    def describe(self) -> str:
+        parts = [f"global {format_rate(self.global_limit.rate)}"]
+        parts += [f"{alias} {format_rate(limit.rate)}" for alias, limit in sorted(self.alias_limits.items())
+                  if limit.rate]
+        parts.append("fair share" if self.fair else "first come first served")
+        parts.append(f"{len(self.transfers)} active transfers")
+        return ', '.join(parts)
+
+    # Run a transfer over sftp under the limits, at most rate bytes per
+    # second itself and reporting to progress (see Transfer).  The Transfer
+    # becomes the calling thread's current one for throttle() and callback().
+    @contextmanager
+    def transfer(self, sftp: paramiko.SFTPClient = None, rate: float = None, progress=None):
+        limits = [self.global_limit]
+        alias = self.alias_of(sftp)
+        if alias is not None:
+            limits.insert(0, self._alias_limit(alias))
+        transfer = Transfer(limits, rate, progress)
+        for limit in limits:
+            limit.join(transfer)
+        with self._lock:
+            self.transfers.append(transfer)
+        previous = getattr(_current, 'transfer', None)
+        _current.transfer = transfer
+        try:
+            yield transfer
+        finally:
+            _current.transfer = previous
+            with self._lock:
+                self.transfers.remove(transfer)
+            for limit in limits:
+                limit.leave(transfer)
+
+_current = threading.local()
+
+# The calling thread's transfer, or None.
+def current():
+    return getattr(_current, 'transfer', None)
+
+# Wait until num_bytes may be moved by the calling thread's transfer.
+# Does nothing outside a transfer.
+def throttle(num_bytes: int) -> None:
+    transfer = current()
+    if transfer is not None:
+        transfer.consume(num_bytes)
+
+# Progress callback for paramiko's get and put that throttles the calling
+# thread's transfer, or None outside a transfer.
+def callback():
+    transfer = current()
+    if transfer is None:
+        return None
+    sent = [0]
+
+    def progress(transferred, total):
+        transfer.consume(transferred - sent[0])
+        sent[0] = transferred
+    return progress
+
+# Run func in a worker thread as part of transfer (i.e. one segment of a
+# segmented download).
+def run_in(transfer, func, *args):
+    previous = getattr(_current, 'transfer', None)
+    _current.transfer = transfer
+    try:
+        return func(*args)
+    finally:
+        _current.transfer = previous
+
+class ThrottledFile:
+    """File object wrapper that throttles every read and write."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def read(self, size: int = -1):
+        data = self.fileobj.read(size)
+        throttle(len(data))
+        return data
+
+    def write(self, data):
+        throttle(len(data))
+        return self.fileobj.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+# Parse a rate such as "500K", "2M" or "1.5MB/s" into bytes per second.
+# "0", "off" and "none" mean unlimited (None).
+def parse_rate(text: str):
+    text = text.strip().upper()
+    if text in ('0', 'OFF', 'NONE', 'UNLIMITED'):
+        return None
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)\s*([KMG]?)(?:I?B)?(?:/S)?', text)
+    if match is None:
+        raise ValueError(f"Invalid rate {text}, use i.e. 500K or 2M")
+    return float(match.group(1)) * _UNITS[match.group(2)]
+
+def format_rate(rate) -> str:
+    if not rate:
+        return "unlimited"
+    for unit in ('G', 'M', 'K'):
+        if rate >= _UNITS[unit]:
+            return f"{rate / _UNITS[unit]:.1f} {unit}B/s"
+    return f"{rate:.0f} B/s"
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,132 @@
+import posixpath
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+import paramiko
+
+# Seconds a cached directory listing stays valid.
+DEFAULT_TTL = 30
+# Most directory listings kept per session, the least recently used is
+# dropped first.
+DEFAULT_MAX_ENTRIES = 1024
+# Most checksums kept per session.
+DEFAULT_MAX_CHECKSUMS = 4096
+
+class ListingCache:
+    """
+    Caches listdir_attr results per SSH session, keyed by absolute remote
+    path.  Every SFTP channel opened on the same transport shares one cache.
+    Entries expire after ttl seconds and the least recently used are
+    dropped beyond max_entries.  Operations that change the server call
+    invalidate so the next listing is fresh.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # session -> OrderedDict of path -> (time stored, entries)
+        self._sessions = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    # List path through the cache.  fresh skips the cached copy and
+    # replaces it with a new listing.
+    def listdir_attr(self, sftp: paramiko.SFTPClient, path: str = '.', fresh: bool = False) -> list:
+        key = self.absolute_path(sftp, path)
+        if not fresh:
+            entries = self.get(sftp, key)
+            if entries is not None:
+                return entries
+        entries = sftp.listdir_attr(path)
+        self.put(sftp, key, entries)
+        return list(entries)
+
+    # Cached entries of an absolute path, or None if missing or expired.
+    def get(self, sftp: paramiko.SFTPClient, key: str):
+        with self._lock:
+            listings = self._sessions.get(session_of(sftp))
+            if listings is None or key not in listings:
+                return None
+            stored, entries = listings[key]
+            if time.monotonic() - stored > self.ttl:
+                del listings[key]
+                return None
+            listings.move_to_end(key)
+            return list(entries)
+
+    def put(self, sftp: paramiko.SFTPClient, key: str, entries) -> None:
+        with self._lock:
+            listings = self._sessions.setdefault(session_of(sftp), OrderedDict())
+            listings[key] = (time.monotonic(), list(entries))
+            listings.move_to_end(key)
+            while len(listings) > self.max_entries:
+                listings.popitem(last=False)
+
+    # Forget the listing of the directory holding path.  With subtree, also
+    # forget path itself and everything cached below it.
+    def invalidate(self, sftp: paramiko.SFTPClient, path: str, subtree: bool = False) -> None:
+        key = self.absolute_path(sftp, path)
+        with self._lock:
+            listings = self._sessions.get(session_of(sftp))
+            if not listings:
+                return
+            listings.pop(posixpath.dirname(key) or '/', None)
+            if subtree:
+                prefix = key.rstrip('/') + '/'
+                for cached in [cached for cached in listings if cached == key or cached.startswith(prefix)]:
+                    del listings[cached]
+
+    # Forget everything cached for the session.
+    def clear(self, sftp: paramiko.SFTPClient) -> None:
+        with self._lock:
+            self._sessions.pop(session_of(sftp), None)
+
+    # Absolute form of path without asking the server.  Paths relative to
+    # the login directory, before any cd, are kept under '~'.
+    def absolute_path(self, sftp: paramiko.SFTPClient, path: str) -> str:
+        cwd = sftp.getcwd()
+        if not isinstance(cwd, str):
+            cwd = '~'
+        return posixpath.normpath(posixpath.join(cwd, path or '.'))
+
+class ChecksumCache:
+    """
+    Caches remote file checksums per SSH session.  Keys hold the absolute
+    path, size, mtime and algorithm, so a changed file is simply a miss and
+    entries never need to expire; the least recently used are dropped
+    beyond max_entries.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_CHECKSUMS):
+        self.max_entries = max_entries
+        # session -> OrderedDict of (path, size, mtime, algorithm) -> hex digest
+        self._sessions = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def get(self, sftp: paramiko.SFTPClient, key: tuple):
+        with self._lock:
+            checksums = self._sessions.get(session_of(sftp))
+            if checksums is None or key not in checksums:
+                return None
+            checksums.move_to_end(key)
+            return checksums[key]
+
+    def put(self, sftp: paramiko.SFTPClient, key: tuple, digest: str) -> None:
+        with self._lock:
+            checksums = self._sessions.setdefault(session_of(sftp), OrderedDict())
+            checksums[key] = digest
+            checksums.move_to_end(key)
+            while len(checksums) > self.max_entries:
+                checksums.popitem(last=False)
+
+# Channels opened on the same transport share a session.
+def session_of(sftp: paramiko.SFTPClient):
+    try:
+        transport = sftp.get_channel().get_transport()
+    except Exception:
+        transport = None
+    return transport if transport is not None else sftp
+
+listing_cache = ListingCache()
+checksum_cache = ChecksumCache()
@@ -0,0 +1,76 @@
+import fnmatch
+import posixpath
+import stat
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import paramiko
+
+import sftp_client
+from logger import logger
+from remote_cache import listing_cache
+
+# Most directory listings in flight at once.
+DEFAULT_WALK_WORKERS = 8
+
+def _log_error(path, error):
+    logger.log_error(f"Error accessing {path}: {error}")
+
+# True if the entry name or its path relative to the walk top matches one
+# of the exclude patterns.
+def is_excluded(relative_path: str, exclude) -> bool:
+    name = posixpath.basename(relative_path)
+    return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(relative_path, pattern)
+               for pattern in exclude)
+
+# Walk a remote tree breadth first, listing up to workers directories at
+# the same time, and yield (path, attributes, depth) for every entry as
+# soon as its directory has been listed.  Entries directly in top have
+# depth 1.
+#   - sftp / ssh: the client we are connected with.  With ssh every worker
+#     lists over its own SFTP channel, otherwise listings take turns on sftp.
+#   - max_depth: do not descend into directories deeper than this
+#   - exclude: fnmatch patterns for names or relative paths to skip,
+#     excluded directories are not descended into
+#   - on_error(path, error): called when a directory can not be listed,
+#     logs the error by default
+#   - fresh: list every directory again instead of using cached listings
+def walk_remote(sftp: paramiko.SFTPClient, top: str, ssh: paramiko.SSHClient = None,
+                workers: int = DEFAULT_WALK_WORKERS, max_depth: int = None, exclude=(),
+                on_error=_log_error, fresh: bool = False):
+    channels = sftp_client.WorkerChannels(sftp, ssh)
+
+    def list_directory(path):
+        with channels.use() as channel:
+            return listing_cache.listdir_attr(channel, path, fresh)
+
+    pool = ThreadPoolExecutor(max_workers=max(1, workers))
+    pending = deque([(top, '', 0)])
+    in_flight = {}
+    try:
+        while pending or in_flight:
+            while pending and len(in_flight) < workers:
+                path, relative_path, depth = pending.popleft()
+                in_flight[pool.submit(list_directory, path)] = (path, relative_path, depth)
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, relative_path, depth = in_flight.pop(future)
+                try:
+                    entries = future.result()
+                except Exception as e:
+                    on_error(path, e)
+                    continue
+
+                for entry in entries:
+                    entry_path = posixpath.join(path, entry.filename)
+                    entry_relative = posixpath.join(relative_path, entry.filename)
+                    if exclude and is_excluded(entry_relative, exclude):
+                        continue
+                    yield entry_path, entry, depth + 1
+                    if stat.S_ISDIR(entry.st_mode) and (max_depth is None or depth + 1 < max_depth):
+                        pending.append((entry_path, entry_relative, depth + 1))
+    finally:
+        # Also runs when the caller stops iterating early.
+        pool.shutdown(wait=True, cancel_futures=True)
+        channels.close()
@@ -4,12 +4,76 @@ import fnmatch
 from logger import logger
 import stat
 import difflib
-
-def connect_sftp(hostname, username, user_pass) -> paramiko.SSHClient:
+import threading
+import time
+import json
+import hashlib
+import io
+import shlex
+import posixpath
+import weakref
+import mmap
+import operator
+import block_delta
+import remote_walker
+import stream_diff
+import compression
+import upload_pipeline
+import tar_batch
+import rate_limit
+from rate_limit import rate_limiter
+from remote_cache import listing_cache, checksum_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+
+# Number of concurrent downloads used by get_multiple.
+DEFAULT_GET_WORKERS = 8
+# How many times get_multiple retries a file that failed to download.
+DEFAULT_GET_RETRIES = 2
+# Seconds to wait before a retry, multiplied by the attempt number.
+RETRY_BACKOFF = 0.25
+# Size of each SFTP read request used by large file downloads.  32KB is
+# accepted by every server, OpenSSH allows up to 256KB.
+DEFAULT_CHUNK_SIZE = 32768
+# Number of read requests kept in flight by large file downloads.
+DEFAULT_PREFETCH_WINDOW = 64
+# Segments smaller than this are not worth their own channel.
+MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+# Resumable transfers checkpoint their journal after this many bytes.
+CHECKPOINT_INTERVAL = 4 * 1024 * 1024
+# Number of removals in flight during rmdir -f.
+DEFAULT_REMOVE_WORKERS = 16
+# rmdir -f logs its progress once per this many removed entries.
+REMOVE_LOG_BATCH = 1000
+# Checksum algorithms remote_checksum asks the server for, in order.
+CHECKSUM_ALGORITHMS = ('sha256', 'md5')
+# Bytes local_checksum feeds to the hash at a time.
+HASH_BLOCK_SIZE = 1024 * 1024
+# Number of local files hashed at the same time by local_checksums.
+DEFAULT_HASH_WORKERS = os.cpu_count() or 4
+# Entries per batch when a directory listing is streamed.
+LISTING_BATCH_SIZE = 1000
+# diff streams files larger than this instead of reading them into memory.
+STREAMING_DIFF_THRESHOLD = 16 * 1024 * 1024
+# put uploads local files at least this large straight from a memory map.
+MMAP_UPLOAD_THRESHOLD = 8 * 1024 * 1024
+# Bytes of the memory map handed to the SFTP file per write.  paramiko
+# splits them into write requests without copying.  A multiple of the page
+# size, so the read ahead hint for the next slice is page aligned.
+MMAP_WRITE_SIZE = 1024 * 1024
+
+# Open and authenticate an SSH connection.  Raises on failure.
+#   - compress: negotiate zlib compression for the whole transport, which
+#     helps text heavy transfers over slow links
+def open_ssh(hostname, username, user_pass, compress: bool = False) -> paramiko.SSHClient:
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect(hostname=hostname, port=22, username=username, password=user_pass, compress=compress)
+    return ssh
+
+def connect_sftp(hostname, username, user_pass, compress: bool = False) -> paramiko.SSHClient:
     try: 
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(hostname=hostname, port=22, username=username, password=user_pass)
+        ssh = open_ssh(hostname, username, user_pass, compress)
         sftp = ssh.open_sftp()
         logger.log_info(f"Successfully connected to {hostname}")
         return sftp , ssh
@@ -17,40 +81,142 @@ def connect_sftp(hostname, username, user_pass) -> paramiko.SSHClient:
         logger.log_error(f"Error opening SFTP: {e}")
         return None, ''
 
+class FileEntry:
+    """
+    One directory entry with the attributes the listing already carried,
+    so showing sizes or times needs no extra stat per entry.
+    """
+
+    __slots__ = ('name', 'size', 'mode', 'mtime')
+
+    def __init__(self, name: str, size: int = 0, mode: int = 0, mtime: int = 0):
+        self.name = name
+        self.size = size
+        self.mode = mode
+        self.mtime = mtime
+
+    @classmethod
+    def from_attributes(cls, attributes: paramiko.SFTPAttributes):
+        return cls(attributes.filename, attributes.st_size or 0, attributes.st_mode or 0,
+                   int(attributes.st_mtime or 0))
+
+    @classmethod
+    def from_dir_entry(cls, entry: os.DirEntry):
+        attributes = entry.stat(follow_symlinks=False)
+        return cls(entry.name, attributes.st_size, attributes.st_mode, int(attributes.st_mtime))
+
+    @property
+    def is_dir(self) -> bool:
+        return stat.S_ISDIR(self.mode)
+
+    # ls -l style line: mode, size, modification time and name.
+    def long_format(self) -> str:
+        modified = time.strftime('%Y-%m-%d %H:%M', time.localtime(self.mtime))
+        return f"{stat.filemode(self.mode)} {self.size:>12} {modified} {self.name}"
+
+    def __repr__(self):
+        return f"FileEntry({self.name!r}, size={self.size}, mode={oct(self.mode)}, mtime={self.mtime})"
+
+# Yield the entries (FileEntry) of a directory from a single listing:
+# one listdir_attr call (through the listing cache) for a remote client,
+# one os.scandir for the os module.  Entries are filtered as they are
+# produced; only sort needs the whole listing.
+#   - list_all: include names starting with '.'
+#   - ignore_backups: skip names ending in '~'
+#   - pattern: only names matching this fnmatch pattern
+#   - sort: None for listing order, otherwise a FileEntry attribute name
+#     ('name', 'size', 'mtime') to sort by
+#   - fresh: do not use the cached listing of a remote directory
+def list_entries(client, path: str = '.', list_all: bool = True, ignore_backups: bool = False,
+                 pattern: str = None, sort: str = 'name', reverse: bool = False, fresh: bool = False):
+    if client is None:
+        raise ValueError("No client STFP object provided.")
+
+    if hasattr(client, 'listdir_attr'):
+        entries = (FileEntry.from_attributes(attributes)
+                   for attributes in listing_cache.listdir_attr(client, path, fresh))
+    else:
+        entries = _scan_local(path)
+
+    entries = (entry for entry in entries
+               if (list_all or not entry.name.startswith('.'))
+               and not (ignore_backups and entry.name.endswith('~'))
+               and (pattern is None or fnmatch.fnmatch(entry.name, pattern)))
+    if sort is None:
+        yield from entries
+    else:
+        yield from sorted(entries, key=operator.attrgetter(sort), reverse=reverse)
+
+# Stream a directory listing as lists of up to batch_size FileEntry
+# objects, as the server sends them (paramiko's listdir_iter keeps
+# read_aheads requests in flight).  A remote listing is served from the
+# listing cache while it is fresh, and a listing streamed to the end is
+# stored there for ls and list_entries; fresh skips the cached copy.
+def iter_entry_batches(client, path: str = '.', batch_size: int = LISTING_BATCH_SIZE, fresh: bool = False):
+    if client is None:
+        raise ValueError("No client STFP object provided.")
+    if hasattr(client, 'listdir_iter'):
+        entries = (FileEntry.from_attributes(attributes) for attributes in _cached_listdir_iter(client, path, fresh))
+    else:
+        entries = _scan_local(path)
+
+    batch = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# Attributes of the entries of a remote directory, from the listing cache
+# or streamed from the server.  Only a complete listing is cached, one that
+# is abandoned part way (i.e. a cancelled GUI listing) is not.
+def _cached_listdir_iter(sftp: paramiko.SFTPClient, path: str, fresh: bool):
+    key = listing_cache.absolute_path(sftp, path)
+    if not fresh:
+        cached = listing_cache.get(sftp, key)
+        if cached is not None:
+            yield from cached
+            return
+    listing = []
+    for attributes in sftp.listdir_iter(path):
+        listing.append(attributes)
+        yield attributes
+    listing_cache.put(sftp, key, listing)
+
+def _scan_local(path: str):
+    with os.scandir(path) as scanner:
+        for entry in scanner:
+            yield FileEntry.from_dir_entry(entry)
+
 # List the entries in the provided path.  If no path is given, the 
 # default path='.' will display all files in the current working 
 # directory.  The arguments (args) check for certain flags which 
 # will show more or less information. By default, ls() does not show 
 # files that start with '.' for instance.  The client can either be 
-# a remote server sftp object, or an os object.
+# a remote server sftp object, or an os object.  The listing itself comes
+# from list_entries, ls only prints it.
 # Valid Flags:
 #   -a      : list all files
 #   -B      : ignore backups
 #   -f      : do not sort
+#   -l      : long listing with mode, size and modification time
+#   --fresh : do not use the cached listing of a remote directory
 def ls (client, args="", path='.') -> bool:
-    # Parse Arguments (args)
-    sort_entries = ("-f" not in args)
-    list_all = ("-a" in args)
-    ignore_backups = ("-B" in args)
+    # Parse Arguments (args), short flags may be combined (-al)
+    flags = set()
+    for token in (args.split() if isinstance(args, str) else args):
+        if token.startswith('--'):
+            flags.add(token)
+        elif token.startswith('-'):
+            flags.update('-' + flag for flag in token[1:])
+    long_listing = ("-l" in flags)
 
     try:
-        if client is None:
-            raise ValueError ("No client STFP object provided.")
-        
-        files = client.listdir(path)
-
-        # Sort if argument specified
-        if sort_entries:
-            files = sorted(files)
-
-        for file in sorted(files):
-            if ignore_backups and file[len(file) - 1] == "~":
-                continue
-
-            if not list_all and file[0] == ".":
-                continue
-            
-            print (file)
+        for entry in list_entries(client, path, list_all=("-a" in flags), ignore_backups=("-B" in flags),
+                                  sort=None if "-f" in flags else 'name', fresh=("--fresh" in flags)):
+            print(entry.long_format() if long_listing else entry.name)
         
         logger.log_info(f"Displayed all files in {path}")
         return True
@@ -66,9 +232,32 @@ def disconnect_sftp(sftp : paramiko.SFTPClient) -> None:
     except Exception as e:
         logger.log_error(f"Error disconnecting from SFTP: {e}")
 
-import os
-
-def get_file(sftp: paramiko.SFTPClient, file_name: str = '') -> None:
+# Download a remote file into ./downloads.
+#   - sftp: the client we are connected with
+#   - file_name: remote path, prompted for if empty
+#   - large_file: use the pipelined download, which keeps prefetch_window
+#     read requests of chunk_size bytes in flight and writes them straight
+#     into a preallocated local file.
+#   - segments: split the file into this many byte ranges and download
+#     them concurrently, each over its own SFTP channel opened from ssh.
+#   - resume: keep a checkpoint journal next to the download and continue
+#     an interrupted download from its last verified offset.
+#   - delta: when an older copy is already in ./downloads, only fetch the
+#     blocks that changed (needs ssh and python3 on the server).
+#   - compress: True streams the file through gzip on the server and
+#     decompresses it on the fly, False never does, None decides from a
+#     sample of the file and the measured link speed (needs ssh and gzip).
+#     None never overrides an explicitly requested large_file transfer.
+#   - limit: at most this many bytes per second for this download, on top
+#     of the global and per alias limits of rate_limit.rate_limiter
+#   - dest: local path to save to instead of ./downloads
+#   - progress: called with the number of bytes received so far, an
+#     exception it raises stops the download (see rate_limit.Transfer)
+def get_file(sftp: paramiko.SFTPClient, file_name: str = '', large_file: bool = False,
+             chunk_size: int = DEFAULT_CHUNK_SIZE, prefetch_window: int = DEFAULT_PREFETCH_WINDOW,
+             segments: int = 1, ssh: paramiko.SSHClient = None, resume: bool = False,
+             delta: bool = False, compress: bool = None, limit: float = None,
+             dest: str = None, progress=None) -> bool:
     try:
         if sftp is not None:
             if file_name == '': 
@@ -76,12 +265,428 @@ def get_file(sftp: paramiko.SFTPClient, file_name: str = '') -> None:
             else:
                 src = file_name
 
-            dest = get_download_folder_path(src)
+            if dest is None:
+                dest = get_download_folder_path(src)
             
-            sftp.get(src, dest)
-            logger.log_info(f"Successfully downloaded file from {src} to {dest}")
+            if os.path.isfile(dest) and remote_matches_local(sftp, src, dest, ssh):
+                logger.log_info(f"{dest} already matches {src}, download skipped")
+                return True
+
+            with rate_limiter.transfer(sftp, limit, progress):
+                start = time.monotonic()
+                if delta and ssh is not None and os.path.isfile(dest):
+                    size = download_delta(ssh, exec_path(sftp, src), dest)
+                    if size is None:
+                        sftp.get(src, dest, callback=rate_limit.callback())
+                        size = _local_size(dest)
+                elif segments > 1:
+                    size = download_segmented(sftp, ssh, src, dest, segments, chunk_size, prefetch_window)
+                elif resume:
+                    size = download_resumable(sftp, src, dest, chunk_size, prefetch_window)
+                elif ssh is not None and compress is not False and \
+                        (compress or (not large_file and compression.choose_download(sftp, ssh, src))):
+                    size, received = compression.download_gzip(ssh, exec_path(sftp, src), dest)
+                    logger.log_info(f"Compressed download of {src}: {received} bytes received for {size}")
+                else:
+                    if large_file:
+                        size = download_pipelined(sftp, src, dest, chunk_size, prefetch_window)
+                    else:
+                        sftp.get(src, dest, callback=rate_limit.callback())
+                        size = _local_size(dest)
+                    compression.record_throughput(sftp, size, time.monotonic() - start)
+            elapsed = time.monotonic() - start
+            logger.log_info(f"Successfully downloaded file from {src} to {dest} "
+                            f"({size} bytes, {format_throughput(size, elapsed)})")
+            return True
     except Exception as e:
         logger.log_error(f"Error getting file from SFTP: {e}")
+    return False
+
+# Download src to dest keeping up to prefetch_window read requests in
+# flight, so the transfer is not stalled by the round trip of each
+# request.  The local file is preallocated to the remote size and every
+# block is written at its offset.  Returns the number of bytes downloaded.
+def download_pipelined(sftp: paramiko.SFTPClient, src: str, dest: str,
+                       chunk_size: int = DEFAULT_CHUNK_SIZE,
+                       prefetch_window: int = DEFAULT_PREFETCH_WINDOW) -> int:
+    if chunk_size <= 0 or prefetch_window <= 0:
+        raise ValueError("chunk size and prefetch window must be positive")
+
+    size = sftp.stat(src).st_size
+
+    with open(dest, 'wb') as local_file:
+        local_file.truncate(size)
+        _read_range(sftp, src, local_file, 0, size, chunk_size, prefetch_window)
+    return size
+
+# Read length bytes of the remote file src starting at offset, with up to
+# prefetch_window requests in flight, and write them at the same offsets
+# into the open local_file.  callback, if given, is called with every
+# block after it is written.
+def _read_range(sftp: paramiko.SFTPClient, src: str, local_file, offset: int, length: int,
+                chunk_size: int, prefetch_window: int, callback=None) -> None:
+    end = offset + length
+    chunks = [(start, min(chunk_size, end - start)) for start in range(offset, end, chunk_size)]
+
+    with sftp.open(src, 'rb') as remote_file:
+        # paramiko splits reads into MAX_REQUEST_SIZE pieces, raise it
+        # for this handle so each request carries a whole chunk.
+        remote_file.MAX_REQUEST_SIZE = chunk_size
+        for (start, size), data in zip(chunks, remote_file.readv(chunks, prefetch_window)):
+            if len(data) != size:
+                raise IOError(f"Short read at offset {start} of {src}")
+            local_file.seek(start)
+            local_file.write(data)
+            rate_limit.throttle(len(data))
+            if callback is not None:
+                callback(data)
+
+# Yield the contents of the remote file at path in blocks of chunk_size
+# bytes, with up to prefetch_window read requests in flight.  Only one
+# window of blocks is held in memory at a time.
+def iter_remote_blocks(sftp: paramiko.SFTPClient, path: str, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                       prefetch_window: int = DEFAULT_PREFETCH_WINDOW):
+    size = sftp.stat(path).st_size
+    window_bytes = chunk_size * prefetch_window
+    with sftp.open(path, 'rb') as remote_file:
+        remote_file.MAX_REQUEST_SIZE = chunk_size
+        for window_start in range(0, size, window_bytes):
+            window_end = min(size, window_start + window_bytes)
+            chunks = [(start, min(chunk_size, window_end - start))
+                      for start in range(window_start, window_end, chunk_size)]
+            for (start, length), data in zip(chunks, remote_file.readv(chunks, prefetch_window)):
+                if len(data) != length:
+                    raise IOError(f"Short read at offset {start} of {path}")
+                rate_limit.throttle(length)
+                yield data
+
+# Path of the checkpoint journal for a download saved at dest.
+def download_journal_path(dest: str) -> str:
+    return dest + '.journal'
+
+# Path of the checkpoint journal for an upload to remote_path.  Upload
+# journals are kept in ./downloads as well, named after the remote path.
+def upload_journal_path(remote_path: str) -> str:
+    return get_download_folder_path(remote_path.strip('/').replace('/', '_')) + '.upload.journal'
+
+def _save_journal(journal: str, entry: dict) -> None:
+    # Write to a temporary file first so a crash never leaves a torn journal.
+    temp = journal + '.tmp'
+    with open(temp, 'w') as file:
+        json.dump(entry, file)
+    os.replace(temp, journal)
+
+def _remove_journal(journal: str) -> None:
+    try:
+        os.remove(journal)
+    except FileNotFoundError:
+        pass
+
+# Work out where a resumable transfer should continue from.  The journal
+# must describe the same source (path, size and mtime) and prefix_path, the
+# local copy of the bytes already transferred, must still hold them.  When
+# verify is set the prefix is re-hashed and compared with the journal.
+# Returns the offset and a sha256 object fed with the prefix (or None).
+def _resume_offset(journal: str, source: str, size: int, mtime: int, prefix_path: str, verify: bool):
+    hasher = hashlib.sha256() if verify else None
+    try:
+        with open(journal, 'r') as file:
+            entry = json.load(file)
+    except (OSError, ValueError):
+        return 0, hasher
+
+    if entry.get('source') != source or entry.get('size') != size or entry.get('mtime') != mtime:
+        logger.log_warning(f"Source {source} changed since the last attempt, restarting from byte 0")
+        return 0, hasher
+
+    offset = entry.get('offset', 0)
+    if offset <= 0 or _local_size(prefix_path) < offset:
+        return 0, hasher
+
+    if verify and entry.get('sha256'):
+        with open(prefix_path, 'rb') as file:
+            remaining = offset
+            while remaining > 0:
+                data = file.read(min(CHECKPOINT_INTERVAL, remaining))
+                if not data:
+                    break
+                hasher.update(data)
+                remaining -= len(data)
+        if hasher.hexdigest() != entry['sha256']:
+            logger.log_warning(f"Checkpoint of {source} failed verification, restarting from byte 0")
+            return 0, hashlib.sha256()
+
+    return offset, hasher
+
+def _journal_entry(source: str, size: int, mtime: int, offset: int, hasher) -> dict:
+    return {'source': source, 'size': size, 'mtime': mtime, 'offset': offset,
+            'sha256': hasher.hexdigest() if hasher is not None else None}
+
+# Download src to dest, continuing from the checkpoint journal left by an
+# earlier attempt.  The journal records the remote size and mtime, the
+# offset reached and a hash of the completed prefix; it is rewritten every
+# CHECKPOINT_INTERVAL bytes and removed once the download completes.
+# Returns the number of bytes downloaded by this attempt.
+def download_resumable(sftp: paramiko.SFTPClient, src: str, dest: str,
+                       chunk_size: int = DEFAULT_CHUNK_SIZE,
+                       prefetch_window: int = DEFAULT_PREFETCH_WINDOW, verify: bool = True) -> int:
+    attributes = sftp.stat(src)
+    size, mtime = attributes.st_size, attributes.st_mtime
+    journal = download_journal_path(dest)
+    offset, hasher = _resume_offset(journal, src, size, mtime, dest, verify)
+    if offset:
+        logger.log_info(f"Resuming download of {src} at byte {offset} of {size}")
+    start_offset = offset
+
+    with open(dest, 'r+b' if offset else 'wb') as local_file:
+        # Drop anything past the verified prefix.
+        local_file.truncate(offset)
+        while offset < size:
+            length = min(CHECKPOINT_INTERVAL, size - offset)
+            _read_range(sftp, src, local_file, offset, length, chunk_size, prefetch_window,
+                        hasher.update if hasher is not None else None)
+            offset += length
+            local_file.flush()
+            os.fsync(local_file.fileno())
+            _save_journal(journal, _journal_entry(src, size, mtime, offset, hasher))
+
+    _remove_journal(journal)
+    return size - start_offset
+
+# Upload local_path to remote_path, continuing from the checkpoint journal
+# left by an earlier attempt.  The journal records the local size and
+# mtime, the offset reached and a hash of the uploaded prefix.  Returns the
+# number of bytes uploaded by this attempt.
+def upload_resumable(sftp: paramiko.SFTPClient, local_path: str, remote_path: str,
+                     chunk_size: int = DEFAULT_CHUNK_SIZE, verify: bool = True) -> int:
+    attributes = os.stat(local_path)
+    size, mtime = attributes.st_size, int(attributes.st_mtime)
+    journal = upload_journal_path(remote_path)
+    offset, hasher = _resume_offset(journal, local_path, size, mtime, local_path, verify)
+    if offset:
+        try:
+            remote_size = sftp.stat(remote_path).st_size
+        except IOError:
+            remote_size = 0
+        # Writes after the last acknowledged one may never have landed.
+        if remote_size < offset:
+            offset, hasher = 0, hashlib.sha256() if verify else None
+        else:
+            logger.log_info(f"Resuming upload of {local_path} at byte {offset} of {size}")
+    start_offset = offset
+
+    with open(local_path, 'rb') as local_file, sftp.open(remote_path, 'r+b' if offset else 'wb') as remote_file:
+        remote_file.set_pipelined(True)
+        local_file.seek(offset)
+        remote_file.seek(offset)
+        while offset < size:
+            checkpoint = min(size, offset + CHECKPOINT_INTERVAL)
+            while offset < checkpoint:
+                data = local_file.read(min(chunk_size, checkpoint - offset))
+                if not data:
+                    raise IOError(f"{local_path} changed size during upload")
+                rate_limit.throttle(len(data))
+                remote_file.write(data)
+                if hasher is not None:
+                    hasher.update(data)
+                offset += len(data)
+            remote_file.flush()
+            _save_journal(journal, _journal_entry(local_path, size, mtime, offset, hasher))
+        remote_file.truncate(size)
+
+    _remove_journal(journal)
+    return size - start_offset
+
+# Upload local_path from a memory map of it.  Slices of the mapping go
+# into the pipelined SFTP write requests as memoryviews, so no bytes object
+# is read per chunk, and while one slice is on the wire the kernel is
+# already reading the next one in.  Returns the number of bytes uploaded.
+#   - callback(bytes_done, size): called after every slice
+def upload_mmap(sftp: paramiko.SFTPClient, local_path: str, remote_path: str,
+                write_size: int = MMAP_WRITE_SIZE, callback=None) -> int:
+    will_need = getattr(mmap, 'MADV_WILLNEED', None)
+    with open(local_path, 'rb') as local_file, sftp.open(remote_path, 'wb') as remote_file:
+        size = os.fstat(local_file.fileno()).st_size
+        if size:
+            remote_file.set_pipelined(True)
+            with mmap.mmap(local_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(mapped) as view:
+                    for offset in range(0, size, write_size):
+                        end = min(size, offset + write_size)
+                        if will_need is not None and end < size:
+                            mapped.madvise(will_need, end, min(write_size, size - end))
+                        rate_limit.throttle(end - offset)
+                        with view[offset:end] as chunk:
+                            remote_file.write(chunk)
+                        if callback is not None:
+                            callback(end, size)
+    remote_size = sftp.stat(remote_path).st_size
+    if remote_size != size:
+        raise IOError(f"size mismatch in put!  {remote_size} != {size}")
+    return size
+
+# Run block_delta on the server in the given mode.  Returns the exec
+# channel's stdin and stdout.
+def _exec_block_delta(ssh: paramiko.SSHClient, mode: str, path: str, *args):
+    stdin, stdout, stderr = ssh.exec_command(block_delta.remote_command(mode, path, *args))
+    return stdin, stdout, stderr
+
+def _check_exit_status(stdout, stderr, what: str) -> None:
+    status = stdout.channel.recv_exit_status()
+    if status != 0:
+        raise IOError(f"{what} failed on the server ({status}): {stderr.read().decode(errors='replace').strip()}")
+
+# Update dest, an older local copy of src, by sending the signatures of
+# its blocks to the server and applying the delta it returns.  Only the
+# changed blocks cross the network.  Returns the size of the new file, or
+# None when the server found too much changed for a delta to pay off (see
+# block_delta.MAX_LITERAL_RATIO) and dest was left as it was.
+def download_delta(ssh: paramiko.SSHClient, src: str, dest: str) -> int:
+    block_size = block_delta.choose_block_size(_local_size(dest))
+    signatures = io.BytesIO()
+    with open(dest, 'rb') as basis:
+        signature_bytes = block_delta.write_signatures(basis, block_size, signatures)
+
+    stdin, stdout, stderr = _exec_block_delta(ssh, 'delta', src)
+    stdin.write(signatures.getvalue())
+    stdin.channel.shutdown_write()
+
+    temp = dest + '.delta'
+    try:
+        with open(dest, 'rb') as basis, open(temp, 'wb') as out:
+            copied_bytes, literal_bytes = block_delta.apply_delta(basis, block_size,
+                                                                  rate_limit.ThrottledFile(stdout), out)
+        _check_exit_status(stdout, stderr, "Delta")
+        os.replace(temp, dest)
+    except block_delta.DeltaAbandoned:
+        _check_exit_status(stdout, stderr, "Delta")
+        logger.log_info(f"Delta download of {src} abandoned, too much of the file changed")
+        return None
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+    _log_delta_savings(src, copied_bytes + literal_bytes, literal_bytes, signature_bytes)
+    return copied_bytes + literal_bytes
+
+# Update remote_path, an older copy of local_path on the server, by
+# fetching its block signatures and sending only the changed blocks.
+# Returns the size of the new file, or None when too much changed for a
+# delta to pay off and the remote file was left as it was.
+def upload_delta(ssh: paramiko.SSHClient, local_path: str, remote_path: str, remote_size: int) -> int:
+    block_size = block_delta.choose_block_size(remote_size)
+    stdin, stdout, stderr = _exec_block_delta(ssh, 'signature', remote_path, block_size)
+    stdin.channel.shutdown_write()
+    signatures = stdout.read()
+    _check_exit_status(stdout, stderr, "Signature")
+    block_size, signature_list = block_delta.read_signatures(io.BytesIO(signatures))
+
+    stdin, stdout, stderr = _exec_block_delta(ssh, 'patch', remote_path, block_size)
+    try:
+        with open(local_path, 'rb') as source:
+            literal_bytes = block_delta.compute_delta(block_size, signature_list, source,
+                                                      rate_limit.ThrottledFile(stdin))
+    except block_delta.DeltaAbandoned as e:
+        stdin.channel.shutdown_write()
+        stdout.channel.recv_exit_status()
+        logger.log_info(f"Delta upload of {local_path} abandoned: {e}")
+        return None
+    stdin.channel.shutdown_write()
+    _check_exit_status(stdout, stderr, "Patch")
+
+    size = _local_size(local_path)
+    _log_delta_savings(local_path, size, literal_bytes, len(signatures))
+    return size
+
+def _log_delta_savings(name: str, size: int, literal_bytes: int, signature_bytes: int) -> None:
+    sent = literal_bytes + signature_bytes
+    saved = max(0, size - sent)
+    logger.log_info(f"Delta transfer of {name}: {literal_bytes} literal bytes and {signature_bytes} "
+                    f"signature bytes instead of {size} ({saved} bytes saved)")
+
+# Split size bytes into at most segments contiguous (offset, length)
+# ranges of at least MIN_SEGMENT_SIZE bytes.
+def segment_ranges(size: int, segments: int) -> list:
+    if size <= 0:
+        return []
+    segments = max(1, min(segments, size // MIN_SEGMENT_SIZE))
+    step = -(-size // segments)
+    return [(offset, min(step, size - offset)) for offset in range(0, size, step)]
+
+# Run work(channel, offset, length) for every range concurrently.  Each
+# range gets its own SFTP channel opened from ssh.  Without ssh the ranges
+# run one after another on sftp, since paramiko can not serve blocking
+# requests from several threads on one channel.  Channels are closed when
+# all ranges are finished and the first error raised by a range is
+# re-raised.
+def _run_segments(sftp: paramiko.SFTPClient, ssh: paramiko.SSHClient, ranges, work) -> None:
+    channels = []
+    try:
+        for _ in ranges:
+            channels.append(open_worker_channel(sftp, ssh) if ssh is not None else sftp)
+        transfer = rate_limit.current()
+        with ThreadPoolExecutor(max_workers=len(ranges) if ssh is not None else 1) as pool:
+            futures = [pool.submit(rate_limit.run_in, transfer, work, channel, offset, length)
+                       for channel, (offset, length) in zip(channels, ranges)]
+            for future in futures:
+                future.result()
+    finally:
+        for channel in channels:
+            if channel is not sftp:
+                disconnect_sftp(channel)
+
+# Download src to dest as several byte ranges moving concurrently over
+# separate channels.  The local file is preallocated and every range is
+# written in place through its own file handle.  Returns the number of
+# bytes downloaded.
+def download_segmented(sftp: paramiko.SFTPClient, ssh: paramiko.SSHClient, src: str, dest: str,
+                       segments: int, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                       prefetch_window: int = DEFAULT_PREFETCH_WINDOW) -> int:
+    size = sftp.stat(src).st_size
+    with open(dest, 'wb') as local_file:
+        local_file.truncate(size)
+
+    def work(channel, offset, length):
+        with open(dest, 'r+b') as local_file:
+            _read_range(channel, src, local_file, offset, length, chunk_size, prefetch_window)
+
+    ranges = segment_ranges(size, segments)
+    if ranges:
+        _run_segments(sftp, ssh, ranges, work)
+    logger.log_info(f"Downloaded {src} in {len(ranges)} segments")
+    return size
+
+# Upload local_path to remote_path as several byte ranges moving
+# concurrently over separate channels.  The remote file is created at its
+# final size and every range writes in place at its offset.  Returns the
+# number of bytes uploaded.
+def upload_segmented(sftp: paramiko.SFTPClient, ssh: paramiko.SSHClient, local_path: str,
+                     remote_path: str, segments: int, chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+    size = os.path.getsize(local_path)
+    with sftp.open(remote_path, 'wb') as remote_file:
+        remote_file.truncate(size)
+
+    def work(channel, offset, length):
+        with open(local_path, 'rb') as local_file, channel.open(remote_path, 'r+b') as remote_file:
+            remote_file.set_pipelined(True)
+            local_file.seek(offset)
+            remote_file.seek(offset)
+            remaining = length
+            while remaining > 0:
+                data = local_file.read(min(chunk_size, remaining))
+                if not data:
+                    raise IOError(f"{local_path} changed size during upload")
+                rate_limit.throttle(len(data))
+                remote_file.write(data)
+                remaining -= len(data)
+
+    ranges = segment_ranges(size, segments)
+    if ranges:
+        _run_segments(sftp, ssh, ranges, work)
+    logger.log_info(f"Uploaded {local_path} in {len(ranges)} segments")
+    return size
 
 #Get the path to save a file to the downloads folder
 def get_download_folder_path(file_name):
@@ -96,6 +701,7 @@ def make_directory(sftp: paramiko.SFTPClient, dir_name = '') -> None:
             if dir_name == '':
                 dir_name = input("Please enter the name of the directory you wish to create: ")
             sftp.mkdir(path=dir_name, mode=0o0777)
+            listing_cache.invalidate(sftp, dir_name)
             logger.log_info(f"Successfully created directory: {dir_name}")
     except Exception as e:
         logger.log_error(f"Error creating directory: {e}")
@@ -121,6 +727,8 @@ def rename_file_remote(sftp: paramiko.SFTPClient, file_to_rename, new_name) -> N
     try:
         if sftp is not None and file_to_rename is not None and len(file_to_rename) > 0 and new_name is not None and len(new_name) > 0:
             sftp.rename(oldpath=file_to_rename,newpath=new_name)
+            listing_cache.invalidate(sftp, file_to_rename, subtree=True)
+            listing_cache.invalidate(sftp, new_name, subtree=True)
             logger.log_info(f"File renamed sucessfully {file_to_rename} -> {new_name}.")
         else:
             logger.log_warning(f"Usage for rename remote file is mv *file to rename* *new name* . Please try again.")
@@ -141,48 +749,250 @@ def rename_file_local(file_to_rename, new_name) -> None:
     except Exception as e:
         logger.log_error(f"Error renaming file: {e}")
 
-#Copy a file from local machine to remote server.
-def put_file(sftp: paramiko.SFTPClient):
+#Copy a file from local machine to remote server.  Returns whether it succeeded.
+#   - local_path / remote_path: prompted for if empty
+#   - large_file: upload straight from a memory map of the local file,
+#     whatever its size (files of MMAP_UPLOAD_THRESHOLD bytes or more
+#     always are).
+#   - segments: split the file into this many byte ranges and upload them
+#     concurrently, each over its own SFTP channel opened from ssh.
+#   - resume: keep a checkpoint journal in ./downloads and continue an
+#     interrupted upload from its last verified offset.
+#   - delta: when an older copy is already on the server, only send the
+#     blocks that changed (needs ssh and python3 on the server).
+#   - compress: True sends the file as a gzip stream the server
+#     decompresses, False never does, None decides from a sample of the
+#     file and the measured link speed (needs ssh and gzip).
+#     None never overrides an explicitly requested large_file transfer.
+#   - limit: at most this many bytes per second for this upload, on top of
+#     the global and per alias limits of rate_limit.rate_limiter
+#   - dest: full remote path to upload to, instead of the local file name
+#     in remote_path
+#   - progress: called with the number of bytes sent so far, an exception
+#     it raises stops the upload (see rate_limit.Transfer)
+def put_file(sftp: paramiko.SFTPClient, local_path: str = '', remote_path: str = '',
+             segments: int = 1, ssh: paramiko.SSHClient = None, resume: bool = False,
+             delta: bool = False, compress: bool = None, limit: float = None,
+             large_file: bool = False, dest: str = None, progress=None) -> bool:
     try:
-        local_path = input("Please enter the local file path:")
-        remote_path = input("Please enter the remote path. If blank this will copy to your current working directory:")
+        if not local_path:
+            local_path = input("Please enter the local file path:")
+        if not remote_path and dest is None:
+            remote_path = input("Please enter the remote path. If blank this will copy to your current working directory:")
 
         while not local_path:
             local_path = input("Invalid input. Please enter the local file path:")
-        while not remote_path:
+        while not remote_path and dest is None:
             remote_path = input("Invalid input. Please enter the remote path. If blank this will copy to your current working directory:")
 
         #Concatonate the file name to the remote path
-        remote_path = remote_path + '/' + os.path.basename(local_path) 
+        remote_path = dest if dest is not None else remote_path + '/' + os.path.basename(local_path) 
    
-        sftp.put(localpath=local_path, remotepath=remote_path)
+        with rate_limiter.transfer(sftp, limit, progress):
+            remote_size = _remote_size(sftp, remote_path) if delta and ssh is not None else 0
+            compressed = (ssh is not None and compress is not False and segments <= 1 and not resume
+                          and not remote_size
+                          and (compress or (not large_file and compression.choose_upload(sftp, ssh, local_path))))
+            start = time.monotonic()
+            if segments > 1 or resume or remote_size or compressed:
+                if remote_size:
+                    size = upload_delta(ssh, local_path, exec_path(sftp, remote_path), remote_size)
+                    if size is None:
+                        sftp.put(localpath=local_path, remotepath=remote_path, callback=rate_limit.callback())
+                        size = _local_size(local_path)
+                elif segments > 1:
+                    size = upload_segmented(sftp, ssh, local_path, remote_path, segments)
+                elif compressed:
+                    size, sent = compression.upload_gzip(ssh, local_path, exec_path(sftp, remote_path))
+                    logger.log_info(f"Compressed upload of {local_path}: {sent} bytes sent for {size}")
+                else:
+                    size = upload_resumable(sftp, local_path, remote_path)
+            else:
+                size = _local_size(local_path)
+                if large_file or size >= MMAP_UPLOAD_THRESHOLD:
+                    upload_mmap(sftp, local_path, remote_path)
+                else:
+                    sftp.put(localpath=local_path, remotepath=remote_path, callback=rate_limit.callback())
+                compression.record_throughput(sftp, size, time.monotonic() - start)
+        logger.log_info(f"Successfully uploaded file from {local_path} to {remote_path} "
+                        f"({size} bytes, {format_throughput(size, time.monotonic() - start)})")
+        listing_cache.invalidate(sftp, remote_path)
+        return True
 
     except Exception as e:
         logger.log_error(f"Error putting file on SFTP: {e}")
+    return False
 
-def put_multiple_files(sftp: paramiko.SFTPClient):
+# Upload files, directories and glob patterns (i.e. "dist, build/*.whl,
+# docs/**/*.html") from a local directory into a remote one.  See
+# upload_pipeline.upload_paths.
+def put_multiple_files(sftp: paramiko.SFTPClient, ssh: paramiko.SSHClient = None, workers: int = None,
+                       limit: float = None) -> bool:
     local_dir = input("Enter local directory path: ")
     remote_dir = input("Enter remote directory path: ")
-    files_to_upload = input("Enter the filenames to upload, separated by commas: ").split(',')
+    sources = input("Enter the files, directories or glob patterns to upload, separated by commas: ").split(',')
 
     try:
-        for filename in files_to_upload:
-            local_path = os.path.join(local_dir, filename.strip())
-            remote_path = os.path.join(remote_dir, filename.strip())
-
-            if os.path.isfile(local_path):
-                sftp.put(local_path, remote_path)
-                logger.log_info(f"Uploaded {local_path} to {remote_path}.")
-            else:
-                logger.log_warning(f"File {local_path} does not exist.")
+        return upload_pipeline.upload_paths(sftp, local_dir, sources, remote_dir, ssh,
+                                            workers or upload_pipeline.DEFAULT_UPLOAD_WORKERS, limit)
     except Exception as e:
         logger.log_error(f"Failed to upload files: {e}")
+        return False
+
+# Open another SFTP channel on the ssh transport, starting in the same
+# directory as sftp so relative paths mean the same thing on both.
+def open_worker_channel(sftp: paramiko.SFTPClient, ssh: paramiko.SSHClient) -> paramiko.SFTPClient:
+    channel = ssh.open_sftp()
+    cwd = sftp.getcwd()
+    if isinstance(cwd, str):
+        channel.chdir(cwd)
+    return channel
+
+class WorkerChannels:
+    """
+    Hands every worker thread its own SFTP channel, opened lazily on the
+    shared ssh transport.  Without ssh, or if a channel cannot be opened,
+    workers share sftp and take turns using it, because a paramiko channel
+    can not serve blocking requests from several threads at once.
+    """
+
+    def __init__(self, sftp: paramiko.SFTPClient, ssh: paramiko.SSHClient = None):
+        self.sftp = sftp
+        self.ssh = ssh
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shared_lock = threading.Lock()
+        self._opened = []
+
+    # The calling thread's channel.
+    def get(self) -> paramiko.SFTPClient:
+        if self.ssh is None:
+            return self.sftp
+        if not hasattr(self._local, 'sftp'):
+            try:
+                self._local.sftp = open_worker_channel(self.sftp, self.ssh)
+                with self._lock:
+                    self._opened.append(self._local.sftp)
+            except Exception as e:
+                logger.log_warning(f"Could not open extra SFTP channel, sharing the main one: {e}")
+                self._local.sftp = self.sftp
+        return self._local.sftp
+
+    # Use the calling thread's channel, waiting for its turn if the channel
+    # is the shared one.
+    @contextmanager
+    def use(self):
+        channel = self.get()
+        if channel is self.sftp:
+            with self._shared_lock:
+                yield channel
+        else:
+            yield channel
+
+    # Close every channel opened by get().
+    def close(self) -> None:
+        with self._lock:
+            opened, self._opened = self._opened, []
+        for channel in opened:
+            disconnect_sftp(channel)
+
+# Download several remote files concurrently.
+#   - sftp: the client we are connected with
+#   - arguments: remote paths to download into ./downloads
+#   - ssh: optional SSHClient. When given, every worker opens its own SFTP
+#     channel on the same transport, otherwise all workers share sftp.
+#   - workers: maximum number of files downloading at the same time
+#   - retries: how many more times a failed file is attempted
+#   - limit: bytes per second for each file (see rate_limit)
+# With ssh, enough small files (see tar_batch) come in tar streams instead
+# of one SFTP download each; any a stream misses are fetched one by one.
+# Returns True when every file was downloaded.
+def get_multiple(sftp: paramiko.SFTPClient, arguments, ssh: paramiko.SSHClient = None,
+                 workers: int = DEFAULT_GET_WORKERS, retries: int = DEFAULT_GET_RETRIES,
+                 limit: float = None) -> bool:
+    if sftp is None or not arguments:
+        return False
+
+    workers = max(1, min(workers, len(arguments)))
+    channels = WorkerChannels(sftp, ssh)
+    done = 0
+    failed = []
+
+    def download(argument):
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                time.sleep(RETRY_BACKOFF * attempt)
+                logger.log_warning(f"Retrying {argument} (attempt {attempt + 1} of {retries + 1})")
+            with channels.use() as channel:
+                downloaded = get_file(channel, argument, limit=limit)
+            if downloaded:
+                logger.log_info(f'Get file {argument} in get multiple files.')
+                return True
+        return False
 
-def get_multiple(sftp: paramiko.SFTPClient, arguments) -> None:
-    if sftp is not None: 
-        for argument in arguments:
-            get_file(sftp, argument)
-            logger.log_info(f'Get file {argument} in get multiple files.')
+    # Returns the arguments of the batch that could not be downloaded.
+    def download_batch(batch):
+        try:
+            with rate_limiter.transfer(sftp, limit):
+                received = tar_batch.download_tar(sftp, ssh, batch, get_download_folder_path)
+            logger.log_info(f"Got {len(received)} files in one tar stream.")
+        except Exception as e:
+            logger.log_warning(f"tar download failed, getting the files one by one: {e}")
+            received = set()
+        return [argument for argument in batch if argument not in received and not download(argument)]
+
+    start = time.monotonic()
+    batched = tar_batch.small_remote_files(sftp, arguments) if tar_batch.available(ssh) else []
+    in_batch = set(batched)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(lambda argument: [] if download(argument) else [argument], argument): [argument]
+                       for argument in arguments if argument not in in_batch}
+            for batch in tar_batch.batches(batched):
+                futures[pool.submit(download_batch, batch)] = batch
+            for future in as_completed(futures):
+                missing = future.result()
+                for argument in futures[future]:
+                    done += 1
+                    if argument not in missing:
+                        print(f"[{done}/{len(arguments)}] {argument}")
+                    else:
+                        failed.append(argument)
+                        print(f"[{done}/{len(arguments)}] {argument} FAILED")
+    finally:
+        channels.close()
+
+    elapsed = time.monotonic() - start
+    total_bytes = sum(_local_size(get_download_folder_path(argument))
+                      for argument in arguments if argument not in failed)
+    summary = (f"Downloaded {len(arguments) - len(failed)}/{len(arguments)} files, "
+               f"{total_bytes} bytes in {elapsed:.2f}s ({format_throughput(total_bytes, elapsed)}) "
+               f"using {workers} workers")
+    print(summary)
+    logger.log_info(summary)
+    if failed:
+        logger.log_error(f"Failed to download: {', '.join(failed)}")
+    return not failed
+
+# Size of a remote file, or 0 if it does not exist.
+def _remote_size(sftp: paramiko.SFTPClient, path) -> int:
+    try:
+        return sftp.stat(path).st_size
+    except IOError:
+        return 0
+
+# Size of a local file, or 0 if it does not exist.
+def _local_size(path) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+# Format a transfer rate in MB/s.
+def format_throughput(num_bytes, seconds) -> str:
+    if seconds <= 0:
+        return "0.00 MB/s"
+    return f"{num_bytes / seconds / (1024 * 1024):.2f} MB/s"
 
 def copy_directory_remote(sftp: paramiko.SFTPClient, ssh: paramiko.SSHClient):
     """Copy a directory recursively on the remote. Only works for linux systems currently."""
@@ -191,7 +1001,15 @@ def copy_directory_remote(sftp: paramiko.SFTPClient, ssh: paramiko.SSHClient):
         source = input("Enter source directory: ")
         dest = input("Enter target directory: ")
 
-        ssh.exec_command(f'cp -r {source} {dest}')
+        stdin, stdout, stderr = ssh.exec_command(
+            f"cp -r {shlex.quote(exec_path(sftp, source))} {shlex.quote(exec_path(sftp, dest))}")
+        # Wait for cp to finish, a listing cached while it runs would be partial.
+        status = stdout.channel.recv_exit_status()
+        listing_cache.invalidate(sftp, dest, subtree=True)
+        if status != 0:
+            logger.log_error(f"Error copying directory: {source} to {dest} on SFTP: cp exited with status "
+                             f"{status}: {stderr.read().decode(errors='replace').strip()}")
+            return
 
         logger.log_info(f"Successfully copied directory {source} to new directory: {dest}")
     except Exception as e:
@@ -216,6 +1034,7 @@ def rm (sftp: paramiko.SFTPClient, pathname: str) -> int:
     try:
         # Try to remove the file
         sftp.remove(pathname)
+        listing_cache.invalidate(sftp, pathname)
         logger.log_info(f"Removed file: {filename}")
         return 1
     
@@ -240,10 +1059,13 @@ def rm (sftp: paramiko.SFTPClient, pathname: str) -> int:
 # is thrown unless the -f flag is provided.  
 # Valid Flags:
 #   -f      : recursively remove all contents of directory.
+#   -n      : with -f, only count what would be removed.
+#   -x      : with -f, run rm -rf on the server through ssh.
 #   -h      : display help message
-def rmdir (client: paramiko.SFTPClient, pathStr: str, args:str = "") -> int:
-    if pathStr == "-h":
-        print(f"rmdir [path] [-fh]\n\t-f\trecursively remove all contents of the directory before removing the directory.\n\t-h\tdisplay help")
+def rmdir (client: paramiko.SFTPClient, pathStr: str, args:str = "", ssh: paramiko.SSHClient = None) -> int:
+    flags = short_flags(args)
+    if pathStr == "-h" or "h" in flags:
+        print(f"rmdir [path] [-fnxh]\n\t-f\trecursively remove all contents of the directory before removing the directory.\n\t-n\twith -f, only count what would be removed.\n\t-x\twith -f, run rm -rf on the server.\n\t-h\tdisplay help")
         return -1
 
     # Verify that an SFTP client was provided
@@ -262,11 +1084,13 @@ def rmdir (client: paramiko.SFTPClient, pathStr: str, args:str = "") -> int:
     try:
         # If the -f flag is provided, recursively remove all files in 
         # the directory, as well as all sub-directories and their contents.
-        if "-f" in args:
-            force_remove_all_contents (client, pathStr)
+        if "f" in flags:
+            if not force_remove_all_contents (client, pathStr, ssh, dry_run="n" in flags, use_exec="x" in flags):
+                return -1
         else:
             # Try to remove the folder
             client.rmdir(pathStr)
+            listing_cache.invalidate(client, pathStr, subtree=True)
             logger.log_info(f"Removed directory: {directory_name}")
 
         return 1
@@ -286,25 +1110,119 @@ def rmdir (client: paramiko.SFTPClient, pathStr: str, args:str = "") -> int:
         
         return -1
 
+# Letters of the short flags in args, a list of arguments or one string
+# of them, so combined flags like "-fx" count as "-f -x".
+def short_flags(args) -> set:
+    if isinstance(args, str):
+        args = args.split()
+    flags = set()
+    for argument in args:
+        if argument.startswith('-') and not argument.startswith('--'):
+            flags.update(argument[1:])
+    return flags
+
 # Check if item is a directory.
 def is_directory (item: paramiko.SFTPAttributes) -> bool:
     # Run "is directory" of the item mode.
     return stat.S_ISDIR(item.st_mode)
 
-def force_remove_all_contents (client: paramiko.SFTPClient, path_str: str):
-    # Get all the contents of the directory.
-    contents = client.listdir_attr(path_str)
-
-    for item in contents:
+# Remove path_str and everything below it.  The tree is listed with
+# remote_walker.walk_remote, files are removed by a pool of workers (each
+# with its own SFTP channel when ssh is given) and every directory is
+# removed as soon as all of its children are gone.  Progress is logged once
+# per REMOVE_LOG_BATCH entries instead of once per file.
+#   - dry_run: only count the files and directories that would be removed
+#   - use_exec: run rm -rf on the server instead (needs ssh)
+# Returns True when the whole tree was removed.
+def force_remove_all_contents (client: paramiko.SFTPClient, path_str: str, ssh: paramiko.SSHClient = None,
+                               workers: int = DEFAULT_REMOVE_WORKERS, dry_run: bool = False,
+                               use_exec: bool = False) -> bool:
+    top = path_str.rstrip('/') or '/'
+
+    if use_exec and ssh is not None and not dry_run:
+        try:
+            stdin, stdout, stderr = ssh.exec_command(f"rm -rf -- {shlex.quote(exec_path(client, top))}")
+            status = stdout.channel.recv_exit_status()
+        finally:
+            listing_cache.invalidate(client, top, subtree=True)
+        if status != 0:
+            logger.log_error(f"rm -rf {top} failed on the server: {stderr.read().decode(errors='replace').strip()}")
+            return False
+        logger.log_info(f"Removed directory tree {top} on the server")
+        return True
 
-        if is_directory(item):
-            force_remove_all_contents(client, f"{path_str}/{item.filename}")
+    def on_error(path, error):
+        if path == top:
+            raise error
+        logger.log_error(f"Error accessing {path}: {error}")
+
+    # Number of children still to be removed for every directory.
+    remaining = {top: 0}
+    files = []
+    empty_directories = []
+    for path, entry, depth in remote_walker.walk_remote(client, top, ssh, on_error=on_error, fresh=True):
+        remaining[posixpath.dirname(path)] += 1
+        if is_directory(entry):
+            remaining[path] = 0
         else:
-            rm(client, f"{path_str}/{item.filename}")
-    
-    rmdir(client, path_str)
+            files.append(path)
+    directory_count = len(remaining)
 
-    return
+    if dry_run:
+        print(f"rmdir: would remove {len(files)} files and {directory_count} directories under {top}")
+        return True
+
+    channels = WorkerChannels(client, ssh)
+
+    def remove(path, directory):
+        with channels.use() as channel:
+            if directory:
+                channel.rmdir(path)
+            else:
+                channel.remove(path)
+
+    removed = 0
+    failures = 0
+    pool = ThreadPoolExecutor(max_workers=max(1, workers))
+    in_flight = {}
+    try:
+        for path in files:
+            in_flight[pool.submit(remove, path, False)] = path
+        for path, count in remaining.items():
+            if count == 0:
+                in_flight[pool.submit(remove, path, True)] = path
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = in_flight.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    failures += 1
+                    logger.log_error(f"Error removing {path}: {e}")
+                    continue
+
+                removed += 1
+                if removed % REMOVE_LOG_BATCH == 0:
+                    logger.log_info(f"Removed {removed} of {len(files) + directory_count} entries under {top}")
+                if path == top:
+                    continue
+                # Bottom up: once the last child is gone remove the parent.
+                parent = posixpath.dirname(path)
+                remaining[parent] -= 1
+                if remaining[parent] == 0:
+                    in_flight[pool.submit(remove, parent, True)] = parent
+    finally:
+        pool.shutdown(wait=True)
+        channels.close()
+        listing_cache.invalidate(client, top, subtree=True)
+
+    if failures:
+        logger.log_error(f"Removed {removed} entries under {top}, {failures} could not be removed")
+        return False
+    logger.log_info(f"Removed directory: {top} ({len(files)} files, {directory_count} directories)")
+    return True
 
 def search_files_local():
     local_dir = input("Enter local directory path: ")
@@ -327,33 +1245,246 @@ def search_files_local():
     except Exception as e:
         logger.log_error(f"Failed to search files: {e}")
 
-def search_files_remote(sftp: paramiko.SFTPClient, remote_dir: str, file_pattern: str):
+# Search a remote tree for files matching file_pattern, printing each match
+# as soon as it is found.  When ssh is given and the server has a shell
+# with find, the search runs there; otherwise directories are listed
+# concurrently over SFTP by remote_walker.walk_remote.  Prints which path
+# was used and how long it took.
+#   - ssh: enables the remote find and lets walker workers use their own channels
+#   - max_depth: do not search deeper than this many levels below remote_dir
+#   - exclude: fnmatch patterns of names or relative paths to skip
+#   - use_exec: allow the remote find fast path
+#   - fresh: do not use cached directory listings
+#   - echo: print matches and timing, off for callers that only want the list
+# Returns the list of matching remote paths.
+def search_files_remote(sftp: paramiko.SFTPClient, remote_dir: str, file_pattern: str,
+                        ssh: paramiko.SSHClient = None, max_depth: int = None, exclude=(),
+                        use_exec: bool = True, fresh: bool = False, echo: bool = True) -> list:
     matching_files = []
+    start = time.monotonic()
+    method = "SFTP walker"
 
-    def recursive_search(directory):
-        nonlocal matching_files
-        try:
-            for entry in sftp.listdir_attr(directory):
-                remote_path = os.path.join(directory, entry.filename)
-                if is_directory(entry):
-                    recursive_search(remote_path)
-                elif fnmatch.fnmatch(entry.filename, file_pattern):
-                    matching_files.append(remote_path)
-        except Exception as e:
-            logger.log_error(f"Error accessing {directory}: {e}")
+    def found(remote_path):
+        matching_files.append(remote_path)
+        if echo:
+            print(remote_path)
 
     try:
-        recursive_search(remote_dir)
+        searched = False
+        if use_exec and ssh is not None and remote_command_available(ssh, 'find'):
+            try:
+                exec_dir = exec_path(sftp, remote_dir)
+                for remote_path in find_files_exec(ssh, exec_dir, file_pattern, max_depth, exclude):
+                    # Report paths the way the SFTP walker would.
+                    found(remote_dir + remote_path[len(exec_dir):])
+                searched = True
+                method = "remote find"
+            except Exception as e:
+                if matching_files:
+                    # The matches found so far were already reported, walking
+                    # again would report them twice.
+                    searched = True
+                    method = "remote find (incomplete)"
+                    logger.log_warning(f"Remote find failed after {len(matching_files)} matches, "
+                                       f"the result may be incomplete: {e}")
+                else:
+                    logger.log_warning(f"Remote find failed, falling back to SFTP: {e}")
+
+        if not searched:
+            for remote_path, entry, depth in remote_walker.walk_remote(sftp, remote_dir, ssh, max_depth=max_depth,
+                                                                       exclude=exclude, fresh=fresh):
+                if not is_directory(entry) and fnmatch.fnmatch(entry.filename, file_pattern):
+                    found(remote_path)
+
+        elapsed = time.monotonic() - start
+        if echo:
+            print(f"Searched {remote_dir} with {method} in {elapsed:.2f}s")
         if matching_files:
             logger.log_info(f"Found {len(matching_files)} matching files in {remote_dir}")
         else:
             logger.log_info(f"No matching files found in {remote_dir}")
-
-        for file in matching_files:
-            print(file)
+        logger.log_info(f"Search of {remote_dir} used {method} and took {elapsed:.2f}s")
     except Exception as e:
         logger.log_error(f"Failed to search remote files: {e}")
+    return matching_files
+
+# Path as a command run over ssh sees it.  Exec commands start in the
+# login directory, so paths relative to the SFTP working directory (after
+# a cd) are made absolute.
+def exec_path(sftp: paramiko.SFTPClient, path: str) -> str:
+    cwd = sftp.getcwd()
+    if isinstance(cwd, str) and not posixpath.isabs(path):
+        return posixpath.join(cwd, path)
+    return path
+
+# Results of remote_command_available per SSH transport.
+_available_commands = weakref.WeakKeyDictionary()
+_available_commands_lock = threading.Lock()
+
+# Check once per connection whether the server has a POSIX shell with the
+# given command on its path.  Results are kept per transport, so every
+# SSHClient sharing a pooled connection reuses them and concurrent
+# transfers do not probe the server at the same time.
+def remote_command_available(ssh: paramiko.SSHClient, command: str) -> bool:
+    connection = ssh.get_transport() or ssh
+    with _available_commands_lock:
+        known = _available_commands.setdefault(connection, {})
+        if command in known:
+            return known[command]
+        try:
+            stdin, stdout, stderr = ssh.exec_command(f"command -v {shlex.quote(command)}")
+            known[command] = stdout.channel.recv_exit_status() == 0
+        except Exception as e:
+            logger.log_warning(f"Could not run commands on the server: {e}")
+            known[command] = False
+    return known[command]
+
+# Run find on the server and yield every file under remote_dir whose name
+# matches file_pattern, in the order find reports them.  Arguments are
+# shell quoted and results are NUL separated so any file name is safe.
+def find_files_exec(ssh: paramiko.SSHClient, remote_dir: str, file_pattern: str,
+                    max_depth: int = None, exclude=()):
+    command = ['find', shlex.quote(remote_dir)]
+    if max_depth is not None:
+        command += ['-maxdepth', str(int(max_depth))]
+    if exclude:
+        prefix = remote_dir.rstrip('/') + '/'
+        tests = []
+        for pattern in exclude:
+            tests += ['-name', shlex.quote(pattern), '-o', '-path', shlex.quote(prefix + pattern), '-o']
+        command += ['\\(', *tests[:-1], '\\)', '-prune', '-o']
+    command += ['-type', 'f', '-name', shlex.quote(file_pattern), '-print0']
+
+    stdin, stdout, stderr = ssh.exec_command(' '.join(command))
+    stdin.channel.shutdown_write()
+    pending = b''
+    while True:
+        data = stdout.read(65536)
+        if not data:
+            break
+        *paths, pending = (pending + data).split(b'\0')
+        for path in paths:
+            yield path.decode(errors='surrogateescape')
+
+    status = stdout.channel.recv_exit_status()
+    if status != 0:
+        errors = stderr.read().decode(errors='replace').strip()
+        # find still prints what it could read when some directories are
+        # unreadable, anything else means the search did not run.
+        if 'No such file' in errors or 'not found' in errors or not errors:
+            raise IOError(f"find exited with status {status}: {errors}")
+        logger.log_warning(f"find reported errors searching {remote_dir}: {errors}")
+
+# SFTP sessions whose server rejected the check-file extension.
+_check_file_unsupported = weakref.WeakKeyDictionary()
+
+# Checksum of a remote file computed on the server, so the file itself
+# does not cross the network.  Returns (algorithm, hex digest), or None
+# when the server can not hash it (the checksum is unknown).
+#   - tries the SFTP check-file extension, then sha256sum / md5sum over ssh
+#   - algorithms: acceptable algorithms in order of preference
+# Results are cached per session by path, size, mtime and algorithm.
+def remote_checksum(sftp: paramiko.SFTPClient, path: str, ssh: paramiko.SSHClient = None,
+                    algorithms=CHECKSUM_ALGORITHMS):
+    attributes = sftp.stat(path)
+    key = (listing_cache.absolute_path(sftp, path), attributes.st_size, attributes.st_mtime)
+    for algorithm in algorithms:
+        digest = checksum_cache.get(sftp, key + (algorithm,))
+        if digest is not None:
+            return algorithm, digest
+
+    result = _checksum_check_file(sftp, path, algorithms)
+    if result is None and ssh is not None:
+        result = _checksum_exec(ssh, exec_path(sftp, path), algorithms)
+    if result is None:
+        # Reading the file to hash it costs as much as transferring it.
+        return None
+    checksum_cache.put(sftp, key + (result[0],), result[1])
+    return result
+
+def _checksum_check_file(sftp: paramiko.SFTPClient, path: str, algorithms):
+    if _check_file_unsupported.get(sftp):
+        return None
+    try:
+        with sftp.open(path, 'rb') as remote_file:
+            for algorithm in algorithms:
+                try:
+                    return algorithm, remote_file.check(algorithm).hex()
+                except IOError:
+                    continue
+    except IOError:
+        return None
+    # OpenSSH and most other servers do not implement check-file, do not
+    # ask again on this session.
+    _check_file_unsupported[sftp] = True
+    return None
+
+def _checksum_exec(ssh: paramiko.SSHClient, path: str, algorithms):
+    for algorithm in algorithms:
+        command = f"{algorithm}sum"
+        if not remote_command_available(ssh, command):
+            continue
+        stdin, stdout, stderr = ssh.exec_command(f"{command} -b -- {shlex.quote(path)}")
+        stdin.channel.shutdown_write()
+        output = stdout.read().decode(errors='replace')
+        _check_exit_status(stdout, stderr, command)
+        # coreutils prefixes the line with a backslash when the name was escaped.
+        return algorithm, output.split()[0].lstrip('\\').lower()
+    return None
+
+# Hash a local file through a read only mmap.  hashlib releases the GIL
+# while hashing, so local_checksums can hash several files on separate cores.
+def local_checksum(path: str, algorithm: str = 'sha256') -> str:
+    hasher = hashlib.new(algorithm)
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    for start in range(0, len(view), HASH_BLOCK_SIZE):
+                        hasher.update(view[start:start + HASH_BLOCK_SIZE])
+                finally:
+                    view.release()
+    return hasher.hexdigest()
+
+# Hash many local files concurrently.  Returns a dict of path -> hex digest.
+def local_checksums(paths, algorithm: str = 'sha256', workers: int = DEFAULT_HASH_WORKERS) -> dict:
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return dict(zip(paths, pool.map(lambda path: local_checksum(path, algorithm), paths)))
+
+# True if the remote file and the local file have the same content.  Sizes
+# are compared first, so only files of equal size are hashed.  Returns
+# False when the checksums can not be computed or the server can not hash
+# the file, the caller then transfers it as usual.
+def remote_matches_local(sftp: paramiko.SFTPClient, remote_path: str, local_path: str,
+                         ssh: paramiko.SSHClient = None) -> bool:
+    try:
+        if sftp.stat(remote_path).st_size != os.path.getsize(local_path):
+            return False
+        result = remote_checksum(sftp, remote_path, ssh)
+        if result is None:
+            return False
+        algorithm, digest = result
+        return local_checksum(local_path, algorithm) == digest
+    except Exception as e:
+        logger.log_warning(f"Could not compare checksums of {remote_path} and {local_path}: {e}")
+        return False
 
+# True if two remote files have the same content, compared by size and
+# then by server side checksums.  Returns False when they can not be computed
+# on the server, the files are then compared by content.
+def remote_files_match(sftp: paramiko.SFTPClient, remote_path1: str, remote_path2: str,
+                       ssh: paramiko.SSHClient = None) -> bool:
+    try:
+        if sftp.stat(remote_path1).st_size != sftp.stat(remote_path2).st_size:
+            return False
+        result = remote_checksum(sftp, remote_path1, ssh)
+        if result is None:
+            return False
+        return remote_checksum(sftp, remote_path2, ssh, (result[0],)) == result
+    except Exception as e:
+        logger.log_warning(f"Could not compare checksums of {remote_path1} and {remote_path2}: {e}")
+        return False
 
 def chmod (client: paramiko.SFTPClient, path_str: str, mode: int) -> int:
     '''
@@ -395,16 +1526,32 @@ def chmod (client: paramiko.SFTPClient, path_str: str, mode: int) -> int:
 
     try:
         client.chmod(file_name, permissions)
+        listing_cache.invalidate(client, file_name)
     except Exception as err :
         raise err
     return
 
-def file_diff(sftp: paramiko.SFTPClient, remote_file1: str, remote_file2: str) -> None:
+def file_diff(sftp: paramiko.SFTPClient, remote_file1: str, remote_file2: str, streaming: bool = None,
+              ssh: paramiko.SSHClient = None) -> None:
     """
     Compares two remote files and shows the first three lines of diff, 
     the percentage of difference, and prompts the user to view full comparison side by side.
+    Files with matching server side checksums are reported identical without reading them.
+    Files larger than STREAMING_DIFF_THRESHOLD (or any files when streaming
+    is True) are diffed by stream_diff without loading them into memory.
     """
     try:
+        if remote_files_match(sftp, remote_file1, remote_file2, ssh):
+            print(f"{remote_file1} and {remote_file2} are identical")
+            return
+
+        if streaming is None:
+            streaming = max(_remote_size(sftp, remote_file1),
+                            _remote_size(sftp, remote_file2)) > STREAMING_DIFF_THRESHOLD
+        if streaming:
+            stream_diff.diff_remote_files(sftp, remote_file1, remote_file2)
+            return
+
         with sftp.file(remote_file1, 'r') as file1, sftp.file(remote_file2, 'r') as file2:
             file1_lines = file1.readlines()
             file2_lines = file2.readlines()
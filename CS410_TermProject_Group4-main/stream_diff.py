@@ -0,0 +1,246 @@
+import itertools
+from difflib import SequenceMatcher
+
+import paramiko
+
+import sftp_client
+
+# Most lines held from each file while diffing.
+WINDOW_LINES = 4096
+# Longer lines are split so one huge line can not exhaust memory.
+MAX_LINE_LENGTH = 64 * 1024
+# Lines of context around every change.
+CONTEXT_LINES = 3
+# Lines printed before asking to continue.
+PAGE_LINES = 40
+# Column width of each side in the side by side view.
+SIDE_BY_SIDE_WIDTH = 60
+
+# Split a stream of byte blocks into lines (keeping the newline).
+def iter_lines(blocks, max_length: int = MAX_LINE_LENGTH):
+    pending = b''
+    for block in blocks:
+        pending += block
+        start = 0
+        while True:
+            end = pending.find(b'\n', start)
+            if end < 0 or end - start >= max_length:
+                if len(pending) - start >= max_length:
+                    yield pending[start:start + max_length]
+                    start += max_length
+                    continue
+                break
+            yield pending[start:end + 1]
+            start = end + 1
+        pending = pending[start:]
+    if pending:
+        yield pending
+
+# Compare two block streams until the first difference.  Returns the
+# number of whole lines the streams share at the start and the remaining
+# block streams, positioned at the start of the first differing line.
+# Returns None for the streams if they are identical.
+def skip_identical_prefix(blocks_a, blocks_b):
+    skipped = 0
+    blocks_a, blocks_b = iter(blocks_a), iter(blocks_b)
+    pending_a = pending_b = b''
+    # Start of the current line, already compared equal on both sides.
+    partial_line = b''
+    while True:
+        if not pending_a:
+            pending_a = next(blocks_a, b'')
+        if not pending_b:
+            pending_b = next(blocks_b, b'')
+        if not pending_a and not pending_b:
+            return skipped, None, None
+
+        length = min(len(pending_a), len(pending_b))
+        if length and pending_a[:length] == pending_b[:length]:
+            newlines = pending_a.count(b'\n', 0, length)
+            skipped += newlines
+            if newlines:
+                partial_line = pending_a[pending_a.rfind(b'\n', 0, length) + 1:length]
+            else:
+                partial_line = (partial_line + pending_a[:length])[-MAX_LINE_LENGTH:]
+            pending_a, pending_b = pending_a[length:], pending_b[length:]
+            continue
+
+        mismatch = 0
+        while mismatch < length and pending_a[mismatch] == pending_b[mismatch]:
+            mismatch += 1
+        line_start = pending_a.rfind(b'\n', 0, mismatch) + 1
+        skipped += pending_a.count(b'\n', 0, line_start)
+        if line_start:
+            partial_line = b''
+        return (skipped,
+                itertools.chain([partial_line + pending_a[line_start:]], blocks_a),
+                itertools.chain([partial_line + pending_b[line_start:]], blocks_b))
+
+def _group_opcodes(codes, context: int):
+    # Same grouping as difflib.SequenceMatcher.get_grouped_opcodes, over a
+    # precomputed list of opcodes.
+    if not codes:
+        return
+    codes = list(codes)
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal' and i2 - i1 > context * 2:
+            group.append((tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+def _format_range(start: int, length: int) -> str:
+    # Unified diff range, start is 1 based and the line before an empty range.
+    if length == 1:
+        return f"{start + 1}"
+    if length == 0:
+        return f"{start},0"
+    return f"{start + 1},{length}"
+
+class StreamingDiff:
+    """
+    Unified diff of two line streams that holds at most WINDOW_LINES lines
+    of each file.  Every window is matched with difflib, changes up to the
+    last common line are emitted and the unmatched tails are carried into
+    the next window.  Identical windows are skipped without matching.
+    After hunks() is exhausted the line and change counts are filled in.
+    """
+
+    def __init__(self, lines_a, lines_b, line_offset: int = 0, window_lines: int = WINDOW_LINES,
+                 context: int = CONTEXT_LINES):
+        self.lines_a = iter(lines_a)
+        self.lines_b = iter(lines_b)
+        self.line_offset = line_offset
+        self.window_lines = window_lines
+        self.context = context
+        self.total_a = self.total_b = line_offset
+        self.changed_lines = 0
+
+    # Yield every hunk as a list of lines, starting with its @@ header.
+    def hunks(self):
+        window_a, window_b = [], []
+        base_a = base_b = self.line_offset
+        done_a = done_b = False
+
+        while True:
+            done_a = self._fill(window_a, self.lines_a, done_a, 'a')
+            done_b = self._fill(window_b, self.lines_b, done_b, 'b')
+            if not window_a and not window_b:
+                return
+            final = done_a and done_b
+
+            if window_a == window_b:
+                settled_a = settled_b = len(window_a)
+                opcodes = []
+            else:
+                matcher = SequenceMatcher(None, window_a, window_b, autojunk=False)
+                matches = [block for block in matcher.get_matching_blocks() if block.size]
+                if final or not matches:
+                    settled_a, settled_b = len(window_a), len(window_b)
+                else:
+                    # Anything after the last common line may still match
+                    # lines that have not been read yet.
+                    settled_a = matches[-1].a + matches[-1].size
+                    settled_b = matches[-1].b + matches[-1].size
+                opcodes = [code for code in matcher.get_opcodes()
+                           if code[2] <= settled_a and code[4] <= settled_b]
+
+            for group in _group_opcodes(opcodes, self.context):
+                yield self._format_hunk(group, window_a, window_b, base_a, base_b)
+
+            del window_a[:settled_a]
+            del window_b[:settled_b]
+            base_a += settled_a
+            base_b += settled_b
+
+    # Percentage of changed lines relative to the longer file.
+    def percentage(self) -> float:
+        total = max(self.total_a, self.total_b)
+        return (self.changed_lines / total) * 100 if total else 0.0
+
+    def _fill(self, window, lines, done, side) -> bool:
+        while not done and len(window) < self.window_lines:
+            line = next(lines, None)
+            if line is None:
+                return True
+            window.append(line)
+            if side == 'a':
+                self.total_a += 1
+            else:
+                self.total_b += 1
+        return done
+
+    def _format_hunk(self, group, window_a, window_b, base_a, base_b):
+        first, last = group[0], group[-1]
+        header = (f"@@ -{_format_range(base_a + first[1], last[2] - first[1])} "
+                  f"+{_format_range(base_b + first[3], last[4] - first[3])} @@")
+        lines = [header]
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                lines += [' ' + _text(line) for line in window_a[i1:i2]]
+                continue
+            if tag in ('replace', 'delete'):
+                lines += ['-' + _text(line) for line in window_a[i1:i2]]
+                self.changed_lines += i2 - i1
+            if tag in ('replace', 'insert'):
+                lines += ['+' + _text(line) for line in window_b[j1:j2]]
+                self.changed_lines += j2 - j1
+        return lines
+
+def _text(line: bytes) -> str:
+    return line.decode('utf-8', errors='replace').rstrip('\r\n')
+
+# Print lines a page at a time.  Returns False if the user quit early.
+def page(lines, page_lines: int = PAGE_LINES, prompt=input) -> bool:
+    for count, line in enumerate(lines, 1):
+        print(line)
+        if count % page_lines == 0:
+            if prompt("-- More -- (Enter to continue, q to quit) ").strip().lower() == 'q':
+                return False
+    return True
+
+# Side by side view of two line streams with fixed column widths, so no
+# pass over the files is needed to measure them.
+def side_by_side_lines(lines_a, lines_b, width: int = SIDE_BY_SIDE_WIDTH):
+    yield f"{'---':<{width + 2}} | {'+++'}"
+    for line_a, line_b in itertools.zip_longest(lines_a, lines_b, fillvalue=b''):
+        text_a, text_b = _text(line_a), _text(line_b)
+        marker_a, marker_b = ('-', '+') if line_a != line_b else (' ', ' ')
+        if len(text_a) > width:
+            text_a = text_a[:width - 1] + '>'
+        yield f"{marker_a} {text_a:<{width}} | {marker_b} {text_b}"
+
+# Streaming version of sftp_client.file_diff for files too large to hold in
+# memory.  Both files are read in bounded blocks, the identical start is
+# skipped block by block, and hunks are printed as they are found, a page
+# at a time.
+def diff_remote_files(sftp: paramiko.SFTPClient, remote_file1: str, remote_file2: str, prompt=input) -> None:
+    skipped, blocks_a, blocks_b = skip_identical_prefix(sftp_client.iter_remote_blocks(sftp, remote_file1),
+                                                        sftp_client.iter_remote_blocks(sftp, remote_file2))
+    if blocks_a is None:
+        print(f"{remote_file1} and {remote_file2} are identical ({skipped} lines)")
+        return
+
+    diff = StreamingDiff(iter_lines(blocks_a), iter_lines(blocks_b), line_offset=skipped)
+    header = [f"--- {remote_file1}", f"+++ {remote_file2}"]
+    hunk_lines = itertools.chain.from_iterable(diff.hunks())
+    if not page(itertools.chain(header, hunk_lines), prompt=prompt):
+        return
+
+    print(f"\nDifference Percentage: {diff.percentage():.2f}%")
+
+    view_full_diff = prompt("Would you like to see the files compared line by line? (y/n): ").strip().lower()
+    if view_full_diff == 'y':
+        page(side_by_side_lines(iter_lines(sftp_client.iter_remote_blocks(sftp, remote_file1)),
+                                iter_lines(sftp_client.iter_remote_blocks(sftp, remote_file2))),
+             prompt=prompt)
@@ -0,0 +1,102 @@
+import os
+import posixpath
+import shlex
+import shutil
+import stat
+import tarfile
+
+import paramiko
+
+import rate_limit
+import sftp_client
+from logger import logger
+
+# Files up to this size travel in a tar stream when there are enough of
+# them; for these the SFTP open, write and close round trips cost more
+# than the data.
+SMALL_FILE_SIZE = 256 * 1024
+# Fewer small files than this are sent one by one, the exec channel and
+# tar process cost more than they save.
+MIN_TAR_FILES = 16
+# Files per tar stream at most, so a large batch spreads over the workers
+# and its command line stays short.
+TAR_BATCH_FILES = 500
+# Bytes copied per step while unpacking.
+TAR_BLOCK_SIZE = 256 * 1024
+
+# True if the server can run tar for this connection.
+def available(ssh: paramiko.SSHClient) -> bool:
+    return ssh is not None and sftp_client.remote_command_available(ssh, 'tar')
+
+def is_small(size: int) -> bool:
+    return size <= SMALL_FILE_SIZE
+
+# Split items into batches of at most TAR_BATCH_FILES.
+def batches(items) -> list:
+    return [items[first:first + TAR_BATCH_FILES] for first in range(0, len(items), TAR_BATCH_FILES)]
+
+# The remote paths worth fetching through tar: regular files no larger
+# than SMALL_FILE_SIZE, or [] when there are fewer than MIN_TAR_FILES of
+# them.  Sizes come from one listing of each parent directory (through the
+# listing cache) instead of a stat per file.
+def small_remote_files(sftp: paramiko.SFTPClient, remote_paths) -> list:
+    sizes = {}
+    for directory in dict.fromkeys(posixpath.dirname(path) or '.' for path in remote_paths):
+        try:
+            for entry in sftp_client.list_entries(sftp, directory, sort=None):
+                if stat.S_ISREG(entry.mode):
+                    sizes[(directory, entry.name)] = entry.size
+        except IOError:
+            continue
+    small = [path for path in remote_paths
+             if is_small(sizes.get((posixpath.dirname(path) or '.', posixpath.basename(path)), SMALL_FILE_SIZE + 1))]
+    return small if len(small) >= MIN_TAR_FILES else []
+
+# Pack files, a list of (local path, path relative to remote_dir), into a
+# tar stream that the server unpacks into remote_dir as it arrives.
+# Nothing is written to disk on either side besides the files themselves.
+def upload_tar(sftp: paramiko.SFTPClient, ssh: paramiko.SSHClient, files, remote_dir: str) -> None:
+    target = shlex.quote(sftp_client.exec_path(sftp, remote_dir))
+    stdin, stdout, stderr = ssh.exec_command(f"mkdir -p -- {target} && tar -xf - -C {target}")
+    with tarfile.open(fileobj=rate_limit.ThrottledFile(stdin), mode='w|', format=tarfile.PAX_FORMAT) as tar:
+        for local_path, relative_path in files:
+            tar.add(local_path, arcname=relative_path, recursive=False)
+    stdin.channel.shutdown_write()
+    sftp_client._check_exit_status(stdout, stderr, "tar")
+
+# Fetch remote_paths in one tar stream from the server and unpack every
+# file to dest_of(remote_path) as it arrives.  Returns the set of remote
+# paths written; files tar could not read are missing from it.
+def download_tar(sftp: paramiko.SFTPClient, ssh: paramiko.SSHClient, remote_paths, dest_of) -> set:
+    # tar runs from / on relative names, so members come back named exactly
+    # as asked for.  Paths still relative (no cd yet) are relative to the
+    # login directory, which the server resolves once for all of them.
+    login_dir = None
+    names = {}
+    for path in remote_paths:
+        absolute = sftp_client.exec_path(sftp, path)
+        if not posixpath.isabs(absolute):
+            if login_dir is None:
+                login_dir = sftp.normalize('.')
+            absolute = posixpath.join(login_dir, absolute)
+        names[posixpath.normpath(absolute).lstrip('/')] = path
+    stdin, stdout, stderr = ssh.exec_command(f"tar -C / -cf - -- {' '.join(shlex.quote(name) for name in names)}")
+    stdin.channel.shutdown_write()
+    received = set()
+    with tarfile.open(fileobj=rate_limit.ThrottledFile(stdout), mode='r|') as tar:
+        for member in tar:
+            remote_path = names.get(member.name)
+            if remote_path is None or not member.isfile():
+                continue
+            dest = dest_of(remote_path)
+            temp = dest + '.part'
+            with tar.extractfile(member) as source, open(temp, 'wb') as out:
+                shutil.copyfileobj(source, out, TAR_BLOCK_SIZE)
+            os.utime(temp, (member.mtime, member.mtime))
+            os.replace(temp, dest)
+            received.add(remote_path)
+    status = stdout.channel.recv_exit_status()
+    if status != 0:
+        logger.log_warning(f"tar could not read every file ({status}): "
+                           f"{stderr.read().decode(errors='replace').strip()}")
+    return received
@@ -0,0 +1,297 @@
+import itertools
+import os
+import queue
+import threading
+import time
+
+import paramiko
+
+import sftp_client
+from logger import logger
+from remote_cache import listing_cache
+
+# Background threads per queue.
+DEFAULT_TASK_WORKERS = 2
+# Least number of seconds between two progress reports of one task, so a
+# fast transfer does not flood the GUI thread.
+PROGRESS_INTERVAL = 0.2
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+class TaskCancelled(Exception):
+    pass
+
+class TaskResult:
+    """
+    Outcome of a finished task: status (DONE, FAILED or CANCELLED), the
+    value the task function returned, the error it raised, and how many
+    bytes it moved in how many seconds.
+    """
+
+    def __init__(self, status, value=None, error=None, elapsed=0.0, bytes_done=0):
+        self.status = status
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+        self.bytes_done = bytes_done
+
+    @property
+    def ok(self) -> bool:
+        return self.status == DONE
+
+class Task:
+    """
+    One queued operation.  The task function receives the task itself and
+    reports progress through report() and checks for cancellation through
+    check_cancelled(), both safe to call from its worker thread.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, name, func, args, kwargs, total_bytes=0, local=False):
+        self.id = next(Task._ids)
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.local = local
+        self.status = QUEUED
+        self.bytes_done = 0
+        self.total_bytes = total_bytes
+        self.started = None
+        self.result = None
+        self._cancel = threading.Event()
+        self._last_report = 0.0
+        self._queue = None
+
+    # Ask the task to stop.  Queued tasks never start, running ones stop at
+    # their next check_cancelled().
+    def cancel(self) -> None:
+        self._cancel.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def check_cancelled(self) -> None:
+        if self._cancel.is_set():
+            raise TaskCancelled(self.name)
+
+    # Record progress, called from the task function.
+    def report(self, bytes_done: int, total_bytes: int = None) -> None:
+        self.bytes_done = bytes_done
+        if total_bytes is not None:
+            self.total_bytes = total_bytes
+        now = time.monotonic()
+        if self._queue is not None and (now - self._last_report >= PROGRESS_INTERVAL
+                                        or bytes_done == self.total_bytes):
+            self._last_report = now
+            self._queue._notify_progress(self)
+
+    # Fraction done, or None when the size is unknown.
+    def fraction(self):
+        if not self.total_bytes:
+            return None
+        return min(1.0, self.bytes_done / self.total_bytes)
+
+    # Bytes per second since the task started.
+    def throughput(self) -> float:
+        if self.started is None:
+            return 0.0
+        elapsed = time.monotonic() - self.started
+        return self.bytes_done / elapsed if elapsed > 0 else 0.0
+
+    # Seconds left at the current throughput, or None when unknown.
+    def eta(self):
+        speed = self.throughput()
+        if not self.total_bytes or speed <= 0:
+            return None
+        return max(0.0, (self.total_bytes - self.bytes_done) / speed)
+
+    # One line status such as "get big.iso: 45% 3.20 MB/s ETA 12s".
+    def describe(self) -> str:
+        if self.status != RUNNING:
+            return f"{self.name}: {self.status}"
+        parts = [f"{self.name}:"]
+        fraction = self.fraction()
+        if fraction is not None:
+            parts.append(f"{fraction * 100:.0f}%")
+        parts.append(f"{self.throughput() / (1024 * 1024):.2f} MB/s")
+        eta = self.eta()
+        if eta is not None:
+            parts.append(f"ETA {eta:.0f}s")
+        return ' '.join(parts)
+
+class TaskQueue:
+    """
+    Runs tasks in submission order on background threads so the GUI thread
+    never waits on the network.  Remote tasks get an SFTP channel through
+    sftp_client.WorkerChannels (their own per thread with ssh, otherwise
+    taking turns on sftp); local tasks get None.
+
+    on_progress(task) and on_finished(task) are called from the worker
+    threads; the GUI passes Qt signal emitters, which deliver them on the
+    GUI thread.  task.result holds a TaskResult once finished.
+    """
+
+    def __init__(self, sftp: paramiko.SFTPClient, ssh: paramiko.SSHClient = None,
+                 workers: int = DEFAULT_TASK_WORKERS, on_progress=None, on_finished=None):
+        self.on_progress = on_progress
+        self.on_finished = on_finished
+        self._channels = sftp_client.WorkerChannels(sftp, ssh)
+        self._queue = queue.Queue()
+        self._tasks = []
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._work, name=f"sftp-task-{number}", daemon=True)
+                         for number in range(max(1, workers))]
+        for thread in self._threads:
+            thread.start()
+
+    # Queue func(task, channel, *args, **kwargs) and return its Task.
+    #   - total_bytes: expected size, when known up front
+    #   - local: the task does not use the server, it gets no channel and
+    #     does not wait for the shared one
+    def submit(self, name: str, func, *args, total_bytes: int = 0, local: bool = False, **kwargs) -> Task:
+        task = Task(name, func, args, kwargs, total_bytes, local)
+        task._queue = self
+        with self._lock:
+            self._tasks.append(task)
+        self._queue.put(task)
+        return task
+
+    # Tasks not finished yet, in submission order.
+    def pending(self) -> list:
+        with self._lock:
+            return [task for task in self._tasks if task.status in (QUEUED, RUNNING)]
+
+    def cancel_all(self) -> None:
+        for task in self.pending():
+            task.cancel()
+
+    # Cancel whatever is left, stop the threads and close the channels.
+    def shutdown(self, wait: bool = True) -> None:
+        self.cancel_all()
+        for _ in self._threads:
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._channels.close()
+
+    def _work(self) -> None:
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            self._run(task)
+
+    def _run(self, task: Task) -> None:
+        if task.cancelled:
+            self._finish(task, TaskResult(CANCELLED))
+            return
+        task.status = RUNNING
+        task.started = time.monotonic()
+        self._notify_progress(task)
+        try:
+            if task.local:
+                value = task.func(task, None, *task.args, **task.kwargs)
+            else:
+                with self._channels.use() as channel:
+                    task.check_cancelled()
+                    value = task.func(task, channel, *task.args, **task.kwargs)
+            result = TaskResult(DONE, value)
+        except TaskCancelled:
+            result = TaskResult(CANCELLED)
+            logger.log_info(f"Cancelled {task.name}")
+        except Exception as e:
+            result = TaskResult(FAILED, error=e)
+            logger.log_error(f"{task.name} failed: {e}")
+        result.elapsed = time.monotonic() - task.started
+        result.bytes_done = task.bytes_done
+        self._finish(task, result)
+
+    def _finish(self, task: Task, result: TaskResult) -> None:
+        task.result = result
+        task.status = result.status
+        with self._lock:
+            self._tasks.remove(task)
+        if self.on_finished is not None:
+            self.on_finished(task)
+
+    def _notify_progress(self, task: Task) -> None:
+        if self.on_progress is not None:
+            self.on_progress(task)
+
+# Task functions for TaskQueue.submit.
+
+# Entries (sftp_client.FileEntry) of a remote directory, sorted by name.
+def list_remote(task: Task, channel: paramiko.SFTPClient, path: str = '.', fresh: bool = False) -> list:
+    return list(sftp_client.list_entries(channel, path, fresh=fresh))
+
+# Entries of a local directory (submit with local=True).
+def list_local(task: Task, channel, path: str = '.') -> list:
+    return list(sftp_client.list_entries(os, path))
+
+# Stream a listing, handing every batch of FileEntry objects to
+# on_batch(task, batch) as it arrives.  Works for remote and local
+# (local=True) tasks.  Remote listings go through the listing cache unless
+# fresh is set.  Returns the number of entries.
+def stream_listing(task: Task, channel, path: str, on_batch,
+                   batch_size: int = sftp_client.LISTING_BATCH_SIZE, fresh: bool = False) -> int:
+    count = 0
+    for batch in sftp_client.iter_entry_batches(channel if channel is not None else os, path, batch_size,
+                                                fresh):
+        task.check_cancelled()
+        count += len(batch)
+        on_batch(task, batch)
+    return count
+
+# Progress hook for sftp_client transfers that reports to task and stops
+# the transfer once the task is cancelled.
+def _transfer_progress(task: Task):
+    def progress(bytes_done):
+        task.check_cancelled()
+        task.report(bytes_done)
+    return progress
+
+# Download remote_path to local_path through sftp_client.get_file, so the
+# rate limits, checksum skip and logging apply, reporting progress.
+# Options are passed to get_file (ssh, resume, large_file, ...).  A
+# cancelled download leaves no partial file behind.  Returns the number of
+# bytes.
+def download(task: Task, channel: paramiko.SFTPClient, remote_path: str, local_path: str, **options) -> int:
+    task.report(0, channel.stat(remote_path).st_size)
+    if not sftp_client.get_file(channel, remote_path, dest=local_path, progress=_transfer_progress(task),
+                                **options):
+        if task.cancelled:
+            if os.path.exists(local_path) and not options.get('resume'):
+                os.remove(local_path)
+            task.check_cancelled()
+        raise IOError(f"Download of {remote_path} failed, see the log")
+    task.report(task.total_bytes)
+    return task.total_bytes
+
+# Upload local_path to remote_path through sftp_client.put_file, reporting
+# progress.  Options are passed to put_file.  A cancelled upload removes
+# its partial remote file.  Returns the number of bytes.
+def upload(task: Task, channel: paramiko.SFTPClient, local_path: str, remote_path: str, **options) -> int:
+    task.report(0, os.path.getsize(local_path))
+    try:
+        if not sftp_client.put_file(channel, local_path, dest=remote_path, progress=_transfer_progress(task),
+                                    **options):
+            if task.cancelled:
+                if not options.get('resume'):
+                    try:
+                        channel.remove(remote_path)
+                    except IOError:
+                        pass
+                task.check_cancelled()
+            raise IOError(f"Upload of {local_path} failed, see the log")
+    finally:
+        listing_cache.invalidate(channel, remote_path)
+    task.report(task.total_bytes)
+    return task.total_bytes
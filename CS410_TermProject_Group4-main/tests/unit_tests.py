@@ -2,15 +2,36 @@ import sys
 import os
 import stat
 import paramiko
-from unittest.mock import MagicMock
+from unittest.mock import ANY, MagicMock
 import json
+import hashlib
+import io
 
 # Required line or tests fail due to imports in other modules
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from sftp_client import connect_sftp, disconnect_sftp, ls, make_directory, get_file, get_multiple, put_file, copy_directory_remote, rm, chmod, search_files_remote
+from sftp_client import connect_sftp, disconnect_sftp, ls, make_directory, get_file, get_multiple, put_file, copy_directory_remote, rm, rmdir, chmod, search_files_remote, segment_ranges, list_entries, remote_checksum, remote_matches_local, remote_command_available, iter_entry_batches, local_checksum, local_checksums
 from logger import logger  
 from connection_storage import ConnectionManager
+from connection_pool import ConnectionPool
+from directory_sync import plan_sync, sync_directories
+import block_delta
+from remote_walker import walk_remote
+from remote_cache import ListingCache, listing_cache
+import stream_diff
+import compression
+import asyncio
+import threading
+import time
+from async_client import AsyncSftpClient
+import async_client
+import task_queue
+import gzip
+import tarfile
+import rate_limit
+from transfer_scheduler import TransferScheduler, GET, PUT, QUEUED, RUNNING, PAUSED, DONE, CANCELLED
+from listing_view import ListingView
+from sftp_client import FileEntry
 
 def test_connect_sftp_success(mocker):
     mocker.patch("paramiko.SSHClient")
@@ -68,8 +89,29 @@ def test_get_file_success(mocker):
     get_file(sftp)
 
     expected_dest = os.path.normpath('downloads/file.txt')
-    sftp.get.assert_called_once_with("source/path/file.txt", f'./{expected_dest}')
-    mock_log_info.assert_called_once_with(f"Successfully downloaded file from source/path/file.txt to ./{expected_dest}")
+    sftp.get.assert_called_once_with("source/path/file.txt", f'./{expected_dest}', callback=ANY)
+    mock_log_info.assert_called_once()
+    assert mock_log_info.call_args[0][0].startswith(f"Successfully downloaded file from source/path/file.txt to ./{expected_dest} (")
+    assert "MB/s" in mock_log_info.call_args[0][0]
+
+def test_get_file_large_file_pipelined(mocker, tmp_path):
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    data = bytes(range(256)) * 40
+    sftp.stat.return_value = mocker.Mock(st_size=len(data))
+    sftp.open.return_value = MagicMock()
+    remote_file = sftp.open.return_value.__enter__.return_value
+    remote_file.readv.side_effect = lambda chunks, window: (data[offset:offset + length] for offset, length in chunks)
+    dest = tmp_path / "file.bin"
+    mocker.patch("sftp_client.get_download_folder_path", return_value=str(dest))
+    mocker.patch("logger.logger.log_info")
+
+    assert get_file(sftp, "remote/file.bin", large_file=True, chunk_size=1000, prefetch_window=4) is True
+
+    sftp.get.assert_not_called()
+    chunks = remote_file.readv.call_args[0][0]
+    assert len(chunks) == 11 and chunks[-1] == (10000, 240)
+    assert remote_file.readv.call_args[0][1] == 4
+    assert dest.read_bytes() == data
 
 
 def test_get_file_failure(mocker):
@@ -81,7 +123,7 @@ def test_get_file_failure(mocker):
 
     get_file(sftp)
 
-    sftp.get.assert_called_once_with("source/path/file.txt", f'./{expected_dest}')
+    sftp.get.assert_called_once_with("source/path/file.txt", f'./{expected_dest}', callback=ANY)
     mock_log_error.assert_called_once_with("Error getting file from SFTP: Error")
 
 def test_put_file_success(mocker):
@@ -92,7 +134,83 @@ def test_put_file_success(mocker):
     sftp.put = MagicMock()
 
     put_file(sftp)
-    sftp.put.assert_called_once_with(localpath="/local/path/file.txt", remotepath="/remote/path/file.txt")
+    sftp.put.assert_called_once_with(localpath="/local/path/file.txt", remotepath="/remote/path/file.txt", callback=ANY)
+
+def test_segment_ranges_cover_file(mocker):
+    mocker.patch("sftp_client.MIN_SEGMENT_SIZE", 10)
+    assert segment_ranges(100, 4) == [(0, 25), (25, 25), (50, 25), (75, 25)]
+    assert segment_ranges(101, 4) == [(0, 26), (26, 26), (52, 26), (78, 23)]
+    # small files are not split below the minimum segment size
+    assert segment_ranges(25, 8) == [(0, 13), (13, 12)]
+    assert segment_ranges(0, 4) == []
+
+def test_get_file_segmented(mocker, tmp_path):
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    ssh = mocker.Mock(spec=paramiko.SSHClient)
+    data = os.urandom(4000)
+    sftp.stat.return_value = mocker.Mock(st_size=len(data))
+
+    def open_channel():
+        channel = mocker.Mock(spec=paramiko.SFTPClient)
+        channel.open.return_value = MagicMock()
+        remote_file = channel.open.return_value.__enter__.return_value
+        remote_file.readv.side_effect = lambda chunks, window: (data[offset:offset + length] for offset, length in chunks)
+        return channel
+
+    ssh.open_sftp.side_effect = open_channel
+    dest = tmp_path / "dump.bin"
+    mocker.patch("sftp_client.get_download_folder_path", return_value=str(dest))
+    mocker.patch("sftp_client.MIN_SEGMENT_SIZE", 1000)
+    mocker.patch("logger.logger.log_info")
+
+    assert get_file(sftp, "remote/dump.bin", chunk_size=300, segments=4, ssh=ssh) is True
+
+    assert ssh.open_sftp.call_count == 4
+    assert dest.read_bytes() == data
+
+def test_get_file_resume_continues_from_journal(mocker, tmp_path):
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    data = os.urandom(5000)
+    sftp.stat.return_value = mocker.Mock(st_size=len(data), st_mtime=1700000000)
+    sftp.open.return_value = MagicMock()
+    remote_file = sftp.open.return_value.__enter__.return_value
+    remote_file.readv.side_effect = lambda chunks, window: (data[offset:offset + length] for offset, length in chunks)
+    dest = tmp_path / "dump.bin"
+    # an earlier attempt got 2000 bytes (plus an unverified tail) down
+    dest.write_bytes(data[:2000] + b"garbage")
+    (tmp_path / "dump.bin.journal").write_text(json.dumps({
+        'source': 'remote/dump.bin', 'size': len(data), 'mtime': 1700000000,
+        'offset': 2000, 'sha256': hashlib.sha256(data[:2000]).hexdigest()}))
+    mocker.patch("sftp_client.get_download_folder_path", return_value=str(dest))
+    mocker.patch("sftp_client.CHECKPOINT_INTERVAL", 1024)
+    mocker.patch("logger.logger.log_info")
+
+    assert get_file(sftp, "remote/dump.bin", resume=True) is True
+
+    first_chunk = remote_file.readv.call_args_list[0][0][0][0]
+    assert first_chunk[0] == 2000
+    assert dest.read_bytes() == data
+    assert not (tmp_path / "dump.bin.journal").exists()
+
+def test_get_file_resume_restarts_when_source_changed(mocker, tmp_path):
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    data = os.urandom(3000)
+    sftp.stat.return_value = mocker.Mock(st_size=len(data), st_mtime=1700000500)
+    sftp.open.return_value = MagicMock()
+    remote_file = sftp.open.return_value.__enter__.return_value
+    remote_file.readv.side_effect = lambda chunks, window: (data[offset:offset + length] for offset, length in chunks)
+    dest = tmp_path / "dump.bin"
+    dest.write_bytes(b"x" * 2000)
+    (tmp_path / "dump.bin.journal").write_text(json.dumps({
+        'source': 'remote/dump.bin', 'size': len(data), 'mtime': 1700000000, 'offset': 2000, 'sha256': None}))
+    mocker.patch("sftp_client.get_download_folder_path", return_value=str(dest))
+    mocker.patch("logger.logger.log_info")
+    mocker.patch("logger.logger.log_warning")
+
+    assert get_file(sftp, "remote/dump.bin", resume=True) is True
+
+    assert remote_file.readv.call_args_list[0][0][0][0][0] == 0
+    assert dest.read_bytes() == data
 
 def test_get_multiple_success(mocker):
     sftp = mocker.Mock(spec=paramiko.SFTPClient)
@@ -103,9 +221,10 @@ def test_get_multiple_success(mocker):
 
     get_multiple(sftp, arguments)
 
-    sftp.get.assert_any_call('file1', '/mock/dest/file1')
-    sftp.get.assert_any_call('file2', '/mock/dest/file2')
-    assert mock_log_info.call_count == 4 
+    sftp.get.assert_any_call('file1', '/mock/dest/file1', callback=ANY)
+    sftp.get.assert_any_call('file2', '/mock/dest/file2', callback=ANY)
+    # two logs per file plus the throughput summary
+    assert mock_log_info.call_count == 5 
 
 def test_get_multiple_failure(mocker):
     sftp = mocker.Mock(spec=paramiko.SFTPClient)
@@ -117,20 +236,70 @@ def test_get_multiple_failure(mocker):
     mock_os_remove = mocker.patch("sftp_client.os.remove")
     arguments = ['file1', 'file2']
 
-    get_multiple(sftp, arguments)
+    get_multiple(sftp, arguments, retries=0)
     
-    sftp.get.assert_any_call('file1', '/mock/dest/file1')
-    sftp.get.assert_any_call('file2', '/mock/dest/file2')
+    sftp.get.assert_any_call('file1', '/mock/dest/file1', callback=ANY)
+    sftp.get.assert_any_call('file2', '/mock/dest/file2', callback=ANY)
     assert sftp.get.call_count == 2 
 
+def test_get_multiple_retries_failed_file(mocker):
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    mocker.patch("logger.logger.log_info")
+    mocker.patch("logger.logger.log_warning")
+    mocker.patch("logger.logger.log_error")
+    mocker.patch("sftp_client.get_download_folder_path", side_effect = lambda file: f"/mock/dest/{file}")
+    mocker.patch("sftp_client.RETRY_BACKOFF", 0)
+    sftp.get.side_effect = [Exception("Download failed"), None]
+
+    assert get_multiple(sftp, ['file1'], retries=1) is True
+    assert sftp.get.call_count == 2
+
+def test_get_multiple_opens_channel_per_worker(mocker):
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    ssh = mocker.Mock(spec=paramiko.SSHClient)
+    channel = mocker.Mock(spec=paramiko.SFTPClient)
+    ssh.open_sftp.return_value = channel
+    mocker.patch("logger.logger.log_info")
+    mocker.patch("sftp_client.get_download_folder_path", side_effect = lambda file: f"/mock/dest/{file}")
+
+    assert get_multiple(sftp, ['file1', 'file2'], ssh, workers=1) is True
+
+    ssh.open_sftp.assert_called_once()
+    assert channel.get.call_count == 2
+    sftp.get.assert_not_called()
+    channel.close.assert_called_once()
+
 def test_copy_directory_remote_success(mocker):
     mocker.patch("paramiko.SSHClient")
     mocker.patch("builtins.input", side_effect=["SOURCE", "DEST"])
 
     ssh = MagicMock()
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    sftp.getcwd.return_value = None
+    ssh.exec_command.return_value = _exec_result()
+    invalidate = mocker.patch("remote_cache.listing_cache.invalidate")
+    mock_log_info = mocker.patch("logger.logger.log_info")
 
-    copy_directory_remote(None, ssh)
+    copy_directory_remote(sftp, ssh)
     ssh.exec_command.assert_called_once_with('cp -r SOURCE DEST')
+    ssh.exec_command.return_value[1].channel.recv_exit_status.assert_called_once()
+    invalidate.assert_called_once_with(sftp, 'DEST', subtree=True)
+    mock_log_info.assert_called_once()
+
+def test_copy_directory_remote_quotes_paths_and_reports_failure(mocker):
+    mocker.patch("builtins.input", side_effect=["my docs", "/srv/backup"])
+    ssh = mocker.Mock(spec=paramiko.SSHClient)
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    sftp.getcwd.return_value = '/home/user'
+    ssh.exec_command.return_value = _exec_result(status=1, errors=b"cp: No space left on device")
+    mock_log_error = mocker.patch("logger.logger.log_error")
+    mock_log_info = mocker.patch("logger.logger.log_info")
+
+    copy_directory_remote(sftp, ssh)
+
+    ssh.exec_command.assert_called_once_with("cp -r '/home/user/my docs' /srv/backup")
+    assert "No space left on device" in mock_log_error.call_args[0][0]
+    mock_log_info.assert_not_called()
 
 def test_remove_file_no_sftp_provided ():
     try:
@@ -298,3 +467,1193 @@ def test_search_files_remote_success(mocker):
     for file in expected_files:
         print(file)
         assert file in expected_files
+
+def test_connection_pool_reuses_live_transport(mocker):
+    mock_open_ssh = mocker.patch("sftp_client.open_ssh")
+    ssh = mock_open_ssh.return_value
+    ssh.get_transport.return_value.is_active.return_value = True
+    pool = ConnectionPool()
+
+    sftp1, ssh1 = pool.connect('hostname', 'username', 'password')
+    sftp2, ssh2 = pool.connect('hostname', 'username', 'password')
+
+    mock_open_ssh.assert_called_once_with('hostname', 'username', 'password')
+    assert ssh1 is ssh2
+    assert ssh.open_sftp.call_count == 2
+
+def test_connection_pool_reconnects_dead_transport(mocker):
+    dead, fresh = MagicMock(), MagicMock()
+    dead.get_transport.return_value.is_active.return_value = False
+    mocker.patch("sftp_client.open_ssh", side_effect=[dead, fresh])
+    pool = ConnectionPool()
+
+    pool.get_ssh('hostname', 'username', 'password')
+    assert pool.get_ssh('hostname', 'username', 'password') is fresh
+    dead.close.assert_called_once()
+
+def test_connection_pool_evicts_least_recently_used(mocker):
+    mocker.patch("sftp_client.open_ssh", side_effect=lambda host, user, password: MagicMock())
+    pool = ConnectionPool(max_connections=2)
+
+    for host in ('host1', 'host2', 'host1', 'host3'):
+        pool.release(pool.get_ssh(host, 'user', 'password'))
+
+    assert ('host1', 'user') in pool and ('host3', 'user') in pool
+    assert ('host2', 'user') not in pool
+
+def test_connection_pool_never_closes_leased_transports(mocker):
+    mocker.patch("sftp_client.open_ssh", side_effect=lambda host, user, password: MagicMock())
+    clock = mocker.patch("connection_pool.time.monotonic", return_value=1000.0)
+    pool = ConnectionPool(max_connections=2, idle_ttl=300)
+
+    held = pool.get_ssh('host1', 'user', 'password')
+    clock.return_value += 600
+    pool.get_ssh('host2', 'user', 'password')
+    pool.get_ssh('host3', 'user', 'password')
+    assert ('host1', 'user') in pool
+    held.close.assert_not_called()
+
+    # Idle time counts from the release
+    pool.release(held)
+    clock.return_value += 200
+    pool.get_ssh('host2', 'user', 'password')
+    assert ('host1', 'user') in pool
+    clock.return_value += 200
+    pool.get_ssh('host2', 'user', 'password')
+    held.close.assert_called_once()
+
+def test_connection_pool_does_not_reuse_transport_for_wrong_password(mocker):
+    good = MagicMock()
+    good.get_transport.return_value.is_active.return_value = True
+    mock_open_ssh = mocker.patch("sftp_client.open_ssh", side_effect=[good, paramiko.AuthenticationException("denied")])
+    mocker.patch("logger.logger.log_error")
+    pool = ConnectionPool()
+
+    assert pool.connect('hostname', 'username', 'password')[1] is good
+    assert pool.connect('hostname', 'username', 'wrong') == (None, '')
+    assert mock_open_ssh.call_count == 2
+
+def test_plan_sync_copies_new_and_changed_files():
+    source = {'same.txt': (10, 100), 'newer.txt': (10, 200), 'bigger.txt': (20, 100), 'new.txt': (5, 100)}
+    dest = {'same.txt': (10, 100), 'newer.txt': (10, 100), 'bigger.txt': (10, 100), 'old.txt': (1, 1)}
+
+    to_copy, extraneous = plan_sync(source, dest)
+
+    assert to_copy == ['bigger.txt', 'new.txt', 'newer.txt']
+    assert extraneous == ['old.txt']
+
+def test_plan_sync_checksum_ignores_mtime():
+    source = {'a.txt': (10, 200), 'b.txt': (10, 200)}
+    dest = {'a.txt': (10, 100), 'b.txt': (10, 100)}
+
+    to_copy, extraneous = plan_sync(source, dest, checksum=True, same_content=lambda path: path == 'a.txt')
+
+    assert to_copy == ['b.txt']
+
+def test_sync_directories_uploads_only_changed(mocker, tmp_path):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "same.txt").write_text("same")
+    (tmp_path / "sub" / "new.txt").write_text("new")
+    os.utime(tmp_path / "same.txt", (1000, 1000))
+    mocker.patch("logger.logger.log_info")
+
+    same = paramiko.SFTPAttributes()
+    same.filename, same.st_mode, same.st_size, same.st_mtime = "same.txt", stat.S_IFREG, 4, 1000
+    extra = paramiko.SFTPAttributes()
+    extra.filename, extra.st_mode, extra.st_size, extra.st_mtime = "extra.txt", stat.S_IFREG, 1, 1
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    sftp.listdir_attr.return_value = [same, extra]
+    sftp.stat.side_effect = IOError(2, "No such file")
+
+    assert sync_directories(sftp, str(tmp_path), "/srv/app", delete=True) is True
+
+    sftp.put.assert_called_once_with(str(tmp_path / "sub" / "new.txt"), "/srv/app/sub/new.txt", callback=ANY)
+    sftp.mkdir.assert_any_call("/srv/app/sub")
+    sftp.remove.assert_called_once_with("/srv/app/extra.txt")
+
+def test_sync_directories_limits_copies_and_continues_after_failed_deletes(mocker, tmp_path):
+    (tmp_path / "keep.txt").write_text("keep")
+    os.utime(tmp_path / "keep.txt", (1000, 1000))
+    (tmp_path / "new.txt").write_text("new")
+    mock_log_info = mocker.patch("logger.logger.log_info")
+    mock_log_error = mocker.patch("logger.logger.log_error")
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    sftp.listdir_attr.side_effect = lambda path: {
+        "/srv/app": [_remote_entry("keep.txt", stat.S_IFREG, 4, 1000), _remote_entry("locked.txt", stat.S_IFREG, 1, 1),
+                     _remote_entry("old.txt", stat.S_IFREG, 1, 1), _remote_entry("old", stat.S_IFDIR, 0, 1)],
+        "/srv/app/old": []}[path]
+
+    def remove(path):
+        if path.endswith("locked.txt"):
+            raise IOError(13, "Permission denied")
+    sftp.remove.side_effect = remove
+    transfer = mocker.spy(rate_limit.rate_limiter, "transfer")
+
+    assert sync_directories(sftp, str(tmp_path), "/srv/app", delete=True, limit=1000) is False
+
+    transfer.assert_called_once_with(sftp, 1000)
+    sftp.put.assert_called_once_with(str(tmp_path / "new.txt"), "/srv/app/new.txt", callback=ANY)
+    # the failed delete did not stop the others
+    sftp.remove.assert_any_call("/srv/app/old.txt")
+    sftp.rmdir.assert_called_once_with("/srv/app/old")
+    assert "Error deleting locked.txt" in mock_log_error.call_args[0][0]
+    assert "1 copied" in mock_log_info.call_args[0][0]
+    assert "2 deleted, 1 failed" in mock_log_info.call_args[0][0]
+
+def _make_delta(basis, target, block_size):
+    signatures = io.BytesIO()
+    block_delta.write_signatures(io.BytesIO(basis), block_size, signatures)
+    _, signature_list = block_delta.read_signatures(io.BytesIO(signatures.getvalue()))
+    delta = io.BytesIO()
+    literal_bytes = block_delta.compute_delta(block_size, signature_list, io.BytesIO(target), delta)
+    return delta.getvalue(), literal_bytes
+
+def test_block_delta_round_trip_with_edits():
+    basis = os.urandom(50000)
+    target = basis[:1000] + b'changed' + basis[1007:20000] + b'inserted' + basis[20000:45000] + basis[46000:]
+
+    delta, literal_bytes = _make_delta(basis, target, 2048)
+    rebuilt = io.BytesIO()
+    copied_bytes, applied_literal = block_delta.apply_delta(io.BytesIO(basis), 2048, io.BytesIO(delta), rebuilt)
+
+    assert rebuilt.getvalue() == target
+    assert applied_literal == literal_bytes
+    # only the blocks around the three edits are sent as literal data
+    assert literal_bytes < 4 * 2048
+    assert copied_bytes + literal_bytes == len(target)
+
+def test_block_delta_detects_corrupt_result():
+    basis = os.urandom(10000)
+    delta, _ = _make_delta(basis, basis, 2048)
+
+    try:
+        block_delta.apply_delta(io.BytesIO(os.urandom(10000)), 2048, io.BytesIO(delta), io.BytesIO())
+    except IOError:
+        assert True
+    else:
+        assert False
+
+def test_block_delta_abandons_heavily_changed_files(mocker):
+    mocker.patch("block_delta.DELTA_PROBE_BYTES", 64 * 1024)
+    mocker.patch("block_delta.READ_SIZE", 16 * 1024)
+    basis = os.urandom(256 * 1024)
+    signatures = io.BytesIO()
+    block_delta.write_signatures(io.BytesIO(basis), 2048, signatures)
+    _, signature_list = block_delta.read_signatures(io.BytesIO(signatures.getvalue()))
+    delta = io.BytesIO()
+
+    try:
+        block_delta.compute_delta(2048, signature_list, io.BytesIO(os.urandom(len(basis))), delta)
+    except block_delta.DeltaAbandoned:
+        pass
+    else:
+        assert False
+    # the sender stopped soon after the probe, and the receiver sees the abort
+    assert len(delta.getvalue()) < 128 * 1024
+    try:
+        block_delta.apply_delta(io.BytesIO(basis), 2048, io.BytesIO(delta.getvalue()), io.BytesIO())
+    except block_delta.DeltaAbandoned:
+        pass
+    else:
+        assert False
+
+def test_get_file_delta_applies_remote_delta(mocker, tmp_path):
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    ssh = mocker.Mock(spec=paramiko.SSHClient)
+    basis = os.urandom(30000)
+    target = basis[:5000] + b'new bytes' + basis[5000:]
+    dest = tmp_path / "data.bin"
+    dest.write_bytes(basis)
+    delta, _ = _make_delta(basis, target, block_delta.choose_block_size(len(basis)))
+    stdout = MagicMock()
+    stdout.read.side_effect = io.BytesIO(delta).read
+    stdout.channel.recv_exit_status.return_value = 0
+    ssh.exec_command.return_value = (MagicMock(), stdout, MagicMock())
+    mocker.patch("sftp_client.get_download_folder_path", return_value=str(dest))
+    mocker.patch("logger.logger.log_info")
+
+    assert get_file(sftp, "remote/data.bin", ssh=ssh, delta=True) is True
+
+    assert ssh.exec_command.call_args[0][0].startswith("python3 -c ")
+    sftp.get.assert_not_called()
+    assert dest.read_bytes() == target
+
+def _remote_entry(filename, mode, size=0, mtime=0):
+    entry = paramiko.SFTPAttributes()
+    entry.filename, entry.st_mode, entry.st_size, entry.st_mtime = filename, mode, size, mtime
+    return entry
+
+def _fake_remote_tree(mocker):
+    tree = {
+        '/top': [_remote_entry('a.txt', stat.S_IFREG), _remote_entry('sub', stat.S_IFDIR), _remote_entry('.git', stat.S_IFDIR)],
+        '/top/sub': [_remote_entry('b.txt', stat.S_IFREG), _remote_entry('deeper', stat.S_IFDIR)],
+        '/top/sub/deeper': [_remote_entry('c.txt', stat.S_IFREG)],
+        '/top/.git': [_remote_entry('HEAD', stat.S_IFREG)],
+    }
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    sftp.listdir_attr.side_effect = lambda path: tree[path]
+    return sftp
+
+def test_walk_remote_breadth_first_with_depth_and_exclude(mocker):
+    sftp = _fake_remote_tree(mocker)
+
+    walked = [(path, depth) for path, entry, depth in walk_remote(sftp, '/top', workers=1, exclude=['.git'])]
+
+    assert walked == [('/top/a.txt', 1), ('/top/sub', 1), ('/top/sub/b.txt', 2),
+                      ('/top/sub/deeper', 2), ('/top/sub/deeper/c.txt', 3)]
+    limited = [path for path, entry, depth in walk_remote(sftp, '/top', max_depth=2, exclude=['.git'])]
+    assert '/top/sub/b.txt' in limited and '/top/sub/deeper/c.txt' not in limited
+
+def test_walk_remote_lists_over_worker_channels(mocker):
+    channel = _fake_remote_tree(mocker)
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    ssh = mocker.Mock(spec=paramiko.SSHClient)
+    ssh.open_sftp.return_value = channel
+
+    paths = {path for path, entry, depth in walk_remote(sftp, '/top', ssh, workers=4)}
+
+    assert '/top/.git/HEAD' in paths and '/top/sub/deeper/c.txt' in paths
+    sftp.listdir_attr.assert_not_called()
+
+def test_search_files_remote_streams_matches(mocker, capsys):
+    sftp = _fake_remote_tree(mocker)
+    mock_log_info = mocker.patch("logger.logger.log_info")
+
+    search_files_remote(sftp, '/top', '*.txt', exclude=['deeper'])
+
+    assert capsys.readouterr().out.splitlines()[:2] == ['/top/a.txt', '/top/sub/b.txt']
+    mock_log_info.assert_any_call("Found 2 matching files in /top")
+
+def _exec_result(output=b'', status=0, errors=b''):
+    stdout = MagicMock()
+    stdout.read.side_effect = io.BytesIO(output).read
+    stdout.channel.recv_exit_status.return_value = status
+    stderr = MagicMock()
+    stderr.read.return_value = errors
+    return MagicMock(), stdout, stderr
+
+def test_search_files_remote_uses_remote_find(mocker, capsys):
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    ssh = mocker.Mock(spec=paramiko.SSHClient)
+    ssh.exec_command.side_effect = lambda command: (
+        _exec_result(b'/usr/bin/find\n') if command.startswith('command -v')
+        else _exec_result(b"/top/a.txt\0/top/it's here.txt\0"))
+    mock_log_info = mocker.patch("logger.logger.log_info")
+
+    search_files_remote(sftp, '/top', '*.txt', ssh, max_depth=3, exclude=['.git'])
+
+    find_command = ssh.exec_command.call_args[0][0]
+    assert find_command == ("find /top -maxdepth 3 \\( -name .git -o -path /top/.git \\) -prune -o "
+                            "-type f -name '*.txt' -print0")
+    output = capsys.readouterr().out
+    assert "/top/a.txt\n/top/it's here.txt\n" in output
+    assert "with remote find" in output
+    mock_log_info.assert_any_call("Found 2 matching files in /top")
+    sftp.listdir_attr.assert_not_called()
+
+def test_search_files_remote_falls_back_without_find(mocker, capsys):
+    sftp = _fake_remote_tree(mocker)
+    ssh = mocker.Mock(spec=paramiko.SSHClient)
+    ssh.exec_command.return_value = _exec_result(status=127)
+    ssh.open_sftp.return_value = sftp
+    mocker.patch("logger.logger.log_info")
+
+    search_files_remote(sftp, '/top', 'c.txt', ssh)
+
+    output = capsys.readouterr().out
+    assert "/top/sub/deeper/c.txt" in output
+    assert "with SFTP walker" in output
+
+def test_search_files_remote_keeps_partial_find_result(mocker, capsys):
+    sftp = _fake_remote_tree(mocker)
+    ssh = mocker.Mock(spec=paramiko.SSHClient)
+    ssh.exec_command.side_effect = lambda command: (
+        _exec_result(b'/usr/bin/find\n') if command.startswith('command -v')
+        else _exec_result(b"/top/a.txt\0", status=1, errors=b"find: '/top/gone': No such file or directory"))
+    mocker.patch("logger.logger.log_info")
+    mock_log_warning = mocker.patch("logger.logger.log_warning")
+
+    assert search_files_remote(sftp, '/top', '*.txt', ssh) == ['/top/a.txt']
+
+    # a.txt is printed once, the SFTP walker does not run again
+    assert capsys.readouterr().out.count("/top/a.txt") == 1
+    sftp.listdir_attr.assert_not_called()
+    assert "may be incomplete" in mock_log_warning.call_args[0][0]
+
+def test_rmdir_force_removes_bottom_up(mocker):
+    sftp = _fake_remote_tree(mocker)
+    removed = []
+    sftp.remove.side_effect = lambda path: removed.append(path)
+    sftp.rmdir.side_effect = lambda path: removed.append(path + '/')
+    mocker.patch("logger.logger.log_info")
+
+    assert rmdir(sftp, '/top', ['-f']) == 1
+
+    assert sorted(removed) == sorted(['/top/a.txt', '/top/sub/b.txt', '/top/sub/deeper/c.txt', '/top/.git/HEAD',
+                                      '/top/sub/deeper/', '/top/sub/', '/top/.git/', '/top/'])
+    assert removed.index('/top/sub/deeper/c.txt') < removed.index('/top/sub/deeper/') < removed.index('/top/sub/')
+    assert removed[-1] == '/top/'
+
+def test_rmdir_force_dry_run_only_counts(mocker, capsys):
+    sftp = _fake_remote_tree(mocker)
+
+    assert rmdir(sftp, '/top', ['-f', '-n']) == 1
+    assert rmdir(sftp, '/top', ['-fn']) == 1
+
+    assert capsys.readouterr().out.count("would remove 4 files and 4 directories") == 2
+    sftp.remove.assert_not_called()
+    sftp.rmdir.assert_not_called()
+
+def test_rmdir_force_exec_fast_path(mocker):
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    ssh = mocker.Mock(spec=paramiko.SSHClient)
+    ssh.exec_command.return_value = _exec_result()
+    mocker.patch("logger.logger.log_info")
+
+    assert rmdir(sftp, "/srv/old build", ['-f', '-x'], ssh) == 1
+
+    ssh.exec_command.assert_called_once_with("rm -rf -- '/srv/old build'")
+    sftp.listdir_attr.assert_not_called()
+
+def test_rmdir_force_exec_invalidates_listing_cache(mocker):
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    sftp.getcwd.return_value = '/srv'
+    ssh = mocker.Mock(spec=paramiko.SSHClient)
+    ssh.exec_command.return_value = _exec_result()
+    mocker.patch("logger.logger.log_info")
+    listing_cache.put(sftp, '/srv', ['build'])
+    listing_cache.put(sftp, '/srv/build', ['app.bin'])
+
+    assert rmdir(sftp, "build", ['-fx'], ssh) == 1
+
+    assert listing_cache.get(sftp, '/srv') is None
+    assert listing_cache.get(sftp, '/srv/build') is None
+
+def test_ls_uses_listing_cache_until_invalidated(mocker, capsys):
+    sftp = _fake_remote_tree(mocker)
+    sftp.getcwd.return_value = '/'
+    mocker.patch("logger.logger.log_info")
+
+    ls(sftp, "-a", "/top")
+    ls(sftp, "-a", "/top")
+    assert sftp.listdir_attr.call_count == 1
+
+    make_directory(sftp, "/top/new")
+    ls(sftp, "-a", "/top")
+    assert sftp.listdir_attr.call_count == 2
+
+    ls(sftp, "-a --fresh", "/top")
+    assert sftp.listdir_attr.call_count == 3
+    assert capsys.readouterr().out.split()[:3] == ['.git', 'a.txt', 'sub']
+
+def test_listing_cache_expires_and_evicts(mocker):
+    sftp = _fake_remote_tree(mocker)
+    sftp.getcwd.return_value = '/'
+    cache = ListingCache(ttl=10, max_entries=2)
+    clock = mocker.patch("remote_cache.time.monotonic", return_value=100)
+
+    cache.listdir_attr(sftp, '/top')
+    cache.listdir_attr(sftp, '/top/sub')
+    cache.listdir_attr(sftp, '/top/.git')
+    assert cache.get(sftp, '/top') is None
+    assert cache.get(sftp, '/top/sub') is not None
+
+    clock.return_value = 111
+    assert cache.get(sftp, '/top/sub') is None
+
+def test_listing_cache_relative_paths_and_subtree_invalidation(mocker):
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    sftp.listdir_attr.return_value = []
+    sftp.getcwd.return_value = '/top'
+    cache = ListingCache()
+
+    cache.listdir_attr(sftp, '/top')
+    cache.listdir_attr(sftp, 'sub')
+    cache.listdir_attr(sftp, 'sub/deeper')
+    assert cache.get(sftp, '/top/sub') is not None
+
+    cache.invalidate(sftp, 'sub', subtree=True)
+    assert cache.get(sftp, '/top') is None
+    assert cache.get(sftp, '/top/sub') is None
+    assert cache.get(sftp, '/top/sub/deeper') is None
+
+def _blocks(data, size):
+    return [data[start:start + size] for start in range(0, len(data), size)]
+
+def test_stream_diff_skips_identical_prefix_across_blocks():
+    old = b''.join(b'line %d\n' % number for number in range(100))
+    new = old.replace(b'line 57\n', b'line 57 changed\n')
+
+    skipped, blocks_a, blocks_b = stream_diff.skip_identical_prefix(_blocks(old, 16), _blocks(new, 16))
+    assert skipped == 57
+    assert next(stream_diff.iter_lines(blocks_a)) == b'line 57\n'
+    assert next(stream_diff.iter_lines(blocks_b)) == b'line 57 changed\n'
+
+    assert stream_diff.skip_identical_prefix(_blocks(old, 16), _blocks(old, 7))[1] is None
+
+def test_streaming_diff_matches_difflib_with_small_windows():
+    import difflib
+    old = [b'%d\n' % number for number in range(200)]
+    new = old[:30] + [b'inserted\n'] * 5 + old[30:90] + old[95:150] + [b'150 changed\n'] + old[151:]
+
+    diff = stream_diff.StreamingDiff(iter(old), iter(new), window_lines=16)
+    streamed = [line for hunk in diff.hunks() for line in hunk if line[0] in '+-']
+    expected = [line for line in difflib.unified_diff([stream_diff._text(l) for l in old],
+                                                      [stream_diff._text(l) for l in new], lineterm='')
+                if line[0] in '+-' and not line.startswith(('+++', '---'))]
+
+    assert streamed == expected
+    assert diff.changed_lines == 12
+    assert diff.total_a == diff.total_b == 200
+
+def test_remote_checksum_uses_sha256sum_and_caches(mocker, tmp_path):
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    ssh = mocker.Mock(spec=paramiko.SSHClient)
+    sftp.getcwd.return_value = '/home/user'
+    sftp.stat.return_value = mocker.Mock(st_size=11, st_mtime=1700000000)
+    # the server does not implement check-file
+    sftp.open.return_value = MagicMock()
+    sftp.open.return_value.__enter__.return_value.check.side_effect = IOError("unsupported")
+    digest = hashlib.sha256(b'hello world').hexdigest()
+    ssh.exec_command.side_effect = [_exec_result(b'/usr/bin/sha256sum\n'),
+                                    _exec_result(f'{digest} *report.txt\n'.encode())]
+
+    assert remote_checksum(sftp, 'report.txt', ssh) == ('sha256', digest)
+    assert remote_checksum(sftp, 'report.txt', ssh) == ('sha256', digest)
+
+    assert ssh.exec_command.call_args[0][0] == "sha256sum -b -- /home/user/report.txt"
+    assert ssh.exec_command.call_count == 2
+
+    local = tmp_path / "report.txt"
+    local.write_bytes(b'hello world')
+    assert local_checksum(str(local)) == digest
+    assert local_checksums([str(local)], 'md5') == {str(local): hashlib.md5(b'hello world').hexdigest()}
+
+def test_remote_checksum_prefers_check_file_extension(mocker):
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    sftp.getcwd.return_value = '/data'
+    sftp.stat.return_value = mocker.Mock(st_size=3, st_mtime=1700000001)
+    sftp.open.return_value = MagicMock()
+    sftp.open.return_value.__enter__.return_value.check.return_value = bytes.fromhex('ab' * 32)
+
+    assert remote_checksum(sftp, 'abc.bin') == ('sha256', 'ab' * 32)
+
+def test_remote_checksum_unknown_without_server_support(mocker, tmp_path):
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    ssh = mocker.Mock(spec=paramiko.SSHClient)
+    sftp.getcwd.return_value = '/srv'
+    sftp.stat.return_value = mocker.Mock(st_size=7, st_mtime=1700000003)
+    sftp.open.return_value = MagicMock()
+    sftp.open.return_value.__enter__.return_value.check.side_effect = IOError("unsupported")
+    mocker.patch("sftp_client.remote_command_available", return_value=False)
+    iter_blocks = mocker.patch("sftp_client.iter_remote_blocks")
+    local = tmp_path / "plain.txt"
+    local.write_bytes(b'content')
+
+    assert remote_checksum(sftp, 'plain.txt', ssh) is None
+    assert remote_matches_local(sftp, 'plain.txt', str(local), ssh) is False
+    # the file is never read to hash it
+    iter_blocks.assert_not_called()
+    sftp.open.return_value.__enter__.return_value.read.assert_not_called()
+
+def test_get_file_skips_download_when_checksums_match(mocker, tmp_path):
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    sftp.getcwd.return_value = '/srv'
+    sftp.stat.return_value = mocker.Mock(st_size=7, st_mtime=1700000002)
+    sftp.open.return_value = MagicMock()
+    sftp.open.return_value.__enter__.return_value.check.return_value = hashlib.sha256(b'content').digest()
+    dest = tmp_path / "same.txt"
+    dest.write_bytes(b'content')
+    mocker.patch("sftp_client.get_download_folder_path", return_value=str(dest))
+    mocker.patch("logger.logger.log_info")
+
+    assert get_file(sftp, "same.txt") is True
+    sftp.get.assert_not_called()
+
+def test_compression_choice_depends_on_ratio_and_link_speed():
+    text = b''.join(b'2024-01-01,host%d,INFO,request served\n' % (n % 50) for n in range(5000))
+    ratio = compression.compressed_ratio(text)
+    size = 50 * 1024 * 1024
+
+    assert ratio < 0.3
+    assert compression.should_compress(size, ratio, 5 * 1024 * 1024)
+    # gzip can not keep up with a fast link
+    assert not compression.should_compress(size, ratio, 1024 * 1024 * 1024)
+    assert not compression.should_compress(size, compression.compressed_ratio(os.urandom(65536)), 5 * 1024 * 1024)
+    assert not compression.should_compress(1000, ratio, 5 * 1024 * 1024)
+
+def test_get_file_compressed_download_decompresses_stream(mocker, tmp_path):
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    ssh = mocker.Mock(spec=paramiko.SSHClient)
+    data = b'timestamp,value\n' * 10000
+    ssh.exec_command.return_value = _exec_result(gzip.compress(data))
+    dest = tmp_path / "metrics.csv"
+    mocker.patch("sftp_client.get_download_folder_path", return_value=str(dest))
+    mocker.patch("logger.logger.log_info")
+
+    assert get_file(sftp, "/var/metrics.csv", ssh=ssh, compress=True) is True
+
+    assert ssh.exec_command.call_args[0][0] == "gzip -c -1 -- /var/metrics.csv"
+    sftp.get.assert_not_called()
+    assert dest.read_bytes() == data
+
+def test_put_file_compressed_upload_sends_gzip_stream(mocker, tmp_path):
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    ssh = mocker.Mock(spec=paramiko.SSHClient)
+    stdin, stdout, stderr = _exec_result()
+    ssh.exec_command.return_value = (stdin, stdout, stderr)
+    local = tmp_path / "app.log"
+    local.write_bytes(b'GET /index.html 200\n' * 5000)
+    mocker.patch("logger.logger.log_info")
+
+    put_file(sftp, str(local), "/srv/logs", ssh=ssh, compress=True)
+
+    sent = b''.join(call[0][0] for call in stdin.write.call_args_list)
+    assert gzip.decompress(sent) == local.read_bytes()
+    assert ssh.exec_command.call_args[0][0] == \
+        "gzip -dc > /srv/logs/app.log.gz.part && mv -f -- /srv/logs/app.log.gz.part /srv/logs/app.log"
+    sftp.put.assert_not_called()
+
+def test_async_client_serializes_calls_on_shared_channel(mocker):
+    sftp = _fake_remote_tree(mocker)
+    sftp.getcwd.return_value = '/'
+    listing = sftp.listdir_attr.side_effect
+    active = []
+    overlaps = []
+
+    def slow_listing(path):
+        active.append(path)
+        overlaps.append(len(active))
+        time.sleep(0.01)
+        active.remove(path)
+        return listing(path)
+    sftp.listdir_attr.side_effect = slow_listing
+    mocker.patch("logger.logger.log_info")
+
+    async def main():
+        async with AsyncSftpClient(sftp, max_workers=4) as client:
+            return await asyncio.gather(client.ls('/top', fresh=True),
+                                        client.ls('/top/sub', fresh=True),
+                                        client.search('/top', '*.txt', fresh=True))
+
+    top, sub, found = asyncio.run(main())
+
+    assert [entry.name for entry in top] == ['.git', 'a.txt', 'sub']
+    assert [entry.name for entry in sub] == ['b.txt', 'deeper']
+    assert sorted(found) == ['/top/a.txt', '/top/sub/b.txt', '/top/sub/deeper/c.txt']
+    # every call took its turn on the one channel
+    assert max(overlaps) == 1
+
+def test_async_client_streams_diff_hunks_and_put_result(mocker, tmp_path):
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    mocker.patch("sftp_client.remote_files_match", return_value=False)
+    mocker.patch("sftp_client.iter_remote_blocks", return_value=iter(()))
+    mocker.patch("logger.logger.log_info")
+    produced = []
+
+    def endless_hunks(self):
+        while True:
+            produced.append(len(produced))
+            yield [f"@@ -{len(produced)} +{len(produced)} @@\n"]
+    mocker.patch("stream_diff.StreamingDiff.hunks", endless_hunks)
+    local = tmp_path / "notes.txt"
+    local.write_bytes(b'notes')
+
+    async def main():
+        async with AsyncSftpClient(sftp, max_workers=2) as client:
+            hunks = client.diff('a.log', 'b.log')
+            first = [await hunks.__anext__() for _ in range(3)]
+            await hunks.aclose()
+            return first, await client.put(str(local), 'docs')
+
+    first, uploaded = asyncio.run(main())
+
+    assert first == [["@@ -1 +1 @@\n"], ["@@ -2 +2 @@\n"], ["@@ -3 +3 @@\n"]]
+    # the diff thread stayed a bounded number of hunks ahead and stopped
+    assert len(produced) <= 3 + async_client.DIFF_QUEUE_HUNKS + 2
+    assert uploaded is True
+    sftp.put.assert_called_once_with(localpath=str(local), remotepath='docs/notes.txt', callback=ANY)
+
+def test_async_client_cancels_queued_calls(mocker):
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    release = threading.Event()
+    ran = []
+
+    def blocking(channel, name):
+        ran.append(name)
+        release.wait(5)
+        return name
+
+    async def main():
+        client = AsyncSftpClient(sftp, max_workers=1)
+        first = asyncio.ensure_future(client.run(blocking, 'first'))
+        queued = asyncio.ensure_future(client.run(blocking, 'queued'))
+        await asyncio.sleep(0.05)
+        queued.cancel()
+        await asyncio.sleep(0.05)
+        release.set()
+        result = await first
+        try:
+            await queued
+        except asyncio.CancelledError:
+            pass
+        await client.close()
+        return result, queued.cancelled()
+
+    assert asyncio.run(main()) == ('first', True)
+    assert ran == ['first']
+
+def _fake_get(chunks):
+    def get(remote_path, local_path, callback=None):
+        with open(local_path, 'wb') as file:
+            for number in range(1, chunks + 1):
+                file.write(b'x' * 100)
+                callback(number * 100, chunks * 100)
+    return get
+
+def test_task_queue_download_reports_progress_and_result(mocker, tmp_path):
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    sftp.stat.return_value = mocker.Mock(st_size=1000)
+    sftp.get.side_effect = _fake_get(10)
+    mocker.patch("logger.logger.log_info")
+    progress = []
+    finished = threading.Event()
+    tasks = task_queue.TaskQueue(sftp, on_progress=lambda task: progress.append(task.bytes_done),
+                                 on_finished=lambda task: finished.set())
+
+    task = tasks.submit("get big.bin", task_queue.download, "big.bin", str(tmp_path / "big.bin"))
+    assert finished.wait(5)
+    tasks.shutdown()
+
+    assert task.result.ok and task.result.value == 1000 and task.result.bytes_done == 1000
+    assert progress[-1] == 1000
+    assert (tmp_path / "big.bin").stat().st_size == 1000
+
+def test_task_queue_cancels_running_and_queued_tasks(mocker, tmp_path):
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    sftp.stat.return_value = mocker.Mock(st_size=1000)
+    sftp.get.side_effect = _fake_get(10)
+    mocker.patch("logger.logger.log_info")
+    done = []
+    all_done = threading.Event()
+
+    def on_progress(task):
+        # cancel the first download half way through
+        if task.bytes_done >= 500:
+            task.cancel()
+
+    def on_finished(task):
+        done.append(task)
+        if len(done) == 2:
+            all_done.set()
+
+    mocker.patch("task_queue.PROGRESS_INTERVAL", 0)
+    tasks = task_queue.TaskQueue(sftp, workers=1, on_progress=on_progress, on_finished=on_finished)
+    first = tasks.submit("get a", task_queue.download, "a", str(tmp_path / "a"))
+    second = tasks.submit("get b", task_queue.download, "b", str(tmp_path / "b"))
+    second.cancel()
+    assert all_done.wait(5)
+    tasks.shutdown()
+
+    assert first.result.status == task_queue.CANCELLED and first.result.bytes_done == 500
+    assert second.result.status == task_queue.CANCELLED
+    assert sftp.get.call_count == 1
+    assert not (tmp_path / "a").exists()
+
+def test_task_queue_upload_goes_through_put_file(mocker, tmp_path):
+    local = tmp_path / "report.txt"
+    local.write_bytes(b'x' * 1000)
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+
+    def put(localpath, remotepath, callback):
+        for number in range(1, 11):
+            callback(number * 100, 1000)
+    sftp.put.side_effect = put
+    log_info = mocker.patch("logger.logger.log_info")
+    progress = []
+    finished = threading.Event()
+    mocker.patch("task_queue.PROGRESS_INTERVAL", 0)
+    tasks = task_queue.TaskQueue(sftp, on_progress=lambda task: progress.append(task.bytes_done),
+                                 on_finished=lambda task: finished.set())
+
+    task = tasks.submit("put report.txt", task_queue.upload, str(local), "/srv/in/report.txt", limit=10 ** 9)
+    assert finished.wait(5)
+    tasks.shutdown()
+
+    assert task.result.ok and task.result.value == 1000
+    sftp.put.assert_called_once_with(localpath=str(local), remotepath="/srv/in/report.txt", callback=ANY)
+    assert progress[-1] == 1000 and 500 in progress
+    assert any(call[0][0].startswith("Successfully uploaded file from") for call in log_info.call_args_list)
+
+def test_list_entries_typed_filtered_and_sorted_from_one_listing(mocker):
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    sftp.getcwd.return_value = '/data'
+    sftp.listdir_attr.return_value = [
+        _remote_entry('report.csv', stat.S_IFREG | 0o644, 300, 1700000300),
+        _remote_entry('.cache', stat.S_IFDIR | 0o755, 0, 1700000100),
+        _remote_entry('notes.txt~', stat.S_IFREG | 0o644, 10, 1700000200),
+        _remote_entry('archive', stat.S_IFDIR | 0o755, 4096, 1700000000),
+    ]
+
+    unsorted = list_entries(sftp, '/data/list_entries', sort=None, fresh=True)
+    assert [entry.name for entry in unsorted] == ['report.csv', '.cache', 'notes.txt~', 'archive']
+
+    by_size = list(list_entries(sftp, '/data/list_entries', list_all=False, ignore_backups=True,
+                                sort='size', reverse=True))
+    assert [(entry.name, entry.size, entry.is_dir) for entry in by_size] == [('archive', 4096, True),
+                                                                           ('report.csv', 300, False)]
+    assert by_size[1].mtime == 1700000300
+    assert sftp.listdir_attr.call_count == 1
+
+def test_ls_prints_long_listing_locally(tmp_path, capsys, mocker):
+    (tmp_path / 'b.txt').write_bytes(b'12345')
+    (tmp_path / 'a.txt').write_bytes(b'1')
+    (tmp_path / '.hidden').write_bytes(b'')
+    mocker.patch("logger.logger.log_info")
+
+    assert ls(os, "-l", str(tmp_path)) is True
+
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split()[-1] for line in lines] == ['a.txt', 'b.txt']
+    assert lines[1].startswith('-rw') and lines[1].split()[1] == '5'
+
+def test_stream_listing_hands_over_batches_as_they_arrive(mocker):
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    sftp.listdir_iter.return_value = iter([_remote_entry(f"f{number}", stat.S_IFREG | 0o644, number, 0)
+                                           for number in range(5)])
+    batches = []
+    done = threading.Event()
+    tasks = task_queue.TaskQueue(sftp, workers=1, on_finished=lambda task: done.set())
+    task = tasks.submit("ls", task_queue.stream_listing, "/big", lambda task, batch: batches.append(batch),
+                        batch_size=2)
+    assert done.wait(5)
+    tasks.shutdown()
+
+    assert task.result.value == 5
+    assert [[entry.name for entry in batch] for batch in batches] == [['f0', 'f1'], ['f2', 'f3'], ['f4']]
+    sftp.listdir_iter.assert_called_once_with("/big")
+    sftp.listdir_attr.assert_not_called()
+    listing_cache.clear(sftp)
+
+def test_streamed_listings_fill_and_use_listing_cache(mocker):
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    sftp.getcwd.return_value = '/data'
+    entries = [_remote_entry(f"f{number}", stat.S_IFREG | 0o644, number, 0) for number in range(5)]
+    sftp.listdir_iter.side_effect = lambda path: iter(entries)
+
+    # an abandoned listing is not cached
+    partial = iter_entry_batches(sftp, 'big', 2)
+    next(partial)
+    partial.close()
+    assert sum(len(batch) for batch in iter_entry_batches(sftp, 'big', 2)) == 5
+    assert sftp.listdir_iter.call_count == 2
+
+    cached = [entry.name for batch in iter_entry_batches(sftp, 'big', 2) for entry in batch]
+    assert cached == ['f0', 'f1', 'f2', 'f3', 'f4']
+    assert [entry.name for entry in list_entries(sftp, '/data/big')] == cached
+    assert sftp.listdir_iter.call_count == 2
+    sftp.listdir_attr.assert_not_called()
+
+    list(iter_entry_batches(sftp, 'big', fresh=True))
+    assert sftp.listdir_iter.call_count == 3
+    listing_cache.clear(sftp)
+
+def test_listing_view_defers_sorting_of_unshown_rows():
+    view = ListingView(page_size=50)
+    view.sort('name')
+    # every name once, in scrambled listing order
+    names = [f"f{number * 7919 % 20000:06}" for number in range(20000)]
+    for start in range(0, len(names), 1000):
+        view.add([FileEntry(name, 0, stat.S_IFREG, 0) for name in names[start:start + 1000]])
+        if view.shown < view.page_size and view.can_fetch_more():
+            view.show_more(view.fetch_count())
+
+    # the first page is exact while the listing streams in
+    assert [entry.name for entry in view.rows[:view.shown]] == sorted(names)[:50]
+    # and the rest was never sorted per batch, it waits to be merged once
+    assert len(view.rows) < 2000 and len(view.rows) + len(view.pending) == len(names)
+    while view.can_fetch_more():
+        view.show_more(view.fetch_count())
+    assert [entry.name for entry in view.rows] == sorted(names)
+
+def test_listing_view_pages_merges_sorted_batches_and_filters():
+    view = ListingView(page_size=3)
+    view.add([FileEntry(f"file{number:02}.log", number, stat.S_IFREG, 0) for number in range(5, 10)])
+    assert view.shown == 0 and view.fetch_count() == 3
+    view.show_more(view.fetch_count())
+    assert view.can_fetch_more() and view.fetch_count() == 2
+
+    view.sort('size', reverse=True)
+    assert view.shown == 3
+    assert view.add([FileEntry("b.txt", 100, stat.S_IFREG, 0), FileEntry("c.log", 1, stat.S_IFREG, 0)]) is True
+    assert [entry.name for entry in view.rows[:view.shown]] == ['b.txt', 'file09.log', 'file08.log']
+    # rows past the shown ones are merged in when the view asks for them
+    assert [entry.name for entry in view.pending] == ['c.log'] and view.fetch_count() == 3
+    view.show_more(view.fetch_count())
+    assert [entry.size for entry in view.rows] == [100, 9, 8, 7, 6, 5, 1] and not view.pending
+
+    view.set_filter('FILE0')
+    assert [entry.size for entry in view.rows] == [9, 8, 7, 6, 5] and view.shown == 3
+    view.set_filter('*.txt')
+    assert [entry.name for entry in view.rows] == ['b.txt']
+
+def test_logger_drop_policy_counts_and_reports_dropped_lines(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    from logger import Logger, DROP
+    log = Logger(queue_size=1, policy=DROP)
+    # Hold the writer back so the queue fills up
+    log._start = lambda: None
+    for number in range(3):
+        log.log_info(f"line {number}")
+    assert log.dropped == 2
+
+    del log._start
+    log._start()
+    assert log.flush(5)
+    lines = open(log.log_file).read().splitlines()
+    assert lines[0].endswith("| line 0")
+    assert lines[1].endswith("dropped 2 messages")
+
+    log.close()
+    log.log_error("after close")
+    assert log.contains_string(log.log_file, "after close")
+
+def _write_log(path, lines):
+    with open(path, 'a') as f:
+        f.write(''.join(f"{line}\n" for line in lines))
+
+def test_log_search_filters_by_level_host_and_time_range(tmp_path):
+    import log_search
+    log_file = str(tmp_path / "01-31-2024_rolling_log.txt")
+    _write_log(log_file, [
+        "INFO | 2024-01-31 09:59:59 | host=alpha | Successfully downloaded file from a to b",
+        "ERROR | 2024-01-31 10:15:00 | host=alpha | Error getting file: timeout",
+        "ERROR | 2024-01-31 10:30:00 | host=beta | Error getting file: denied",
+        "ERROR | 2024-01-31 10:45:00 | Error opening SFTP: refused",
+        "  a continuation line",
+        "WARNING | 2024-01-31 11:00:00 | host=alpha | Slow transfer",
+        "ERROR | 2024-01-31 11:00:01 | host=alpha | Error getting file: late",
+    ])
+    since = log_search.parse_time("10:00", "01-31-2024")
+    until = log_search.parse_time("11:00", "01-31-2024")
+
+    records = log_search.search_log(log_file, level='error', host='alpha', since=since, until=until)
+    assert [record.line.split(' | ')[-1] for record in records] == ["Error getting file: timeout"]
+    assert records[0].host == 'alpha' and records[0].level == 'ERROR'
+
+    in_range = log_search.search_log(log_file, since=since, until=until)
+    assert [record.level for record in in_range] == ['ERROR', 'ERROR', 'ERROR', 'WARNING']
+    assert log_search.search_log(log_file, level='ERROR', text='denied')[0].host == 'beta'
+    assert os.path.exists(log_file + log_search.INDEX_SUFFIX)
+
+def test_log_index_only_scans_appended_lines(tmp_path, mocker):
+    import log_search
+    log_file = str(tmp_path / "log.txt")
+    _write_log(log_file, ["INFO | 2024-01-31 10:00:00 | first", "INFO | 2024-01-31 10:00:01 | second"])
+    assert len(log_search.LogIndex.open(log_file)) == 2
+
+    _write_log(log_file, ["ERROR | 2024-01-31 10:00:02 | host=alpha | third"])
+    scan = mocker.spy(log_search.LogIndex, "_add_line")
+    index = log_search.LogIndex.open(log_file)
+    assert scan.call_count == 1
+    assert len(index) == 3 and index.query(host='alpha') == [2]
+
+    with open(log_file, 'w') as f:
+        f.write("WARNING | 2024-01-31 12:00:00 | rotated\n")
+    index = log_search.LogIndex.open(log_file)
+    assert len(index) == 1 and index.query(level='WARNING') == [0]
+
+def test_upload_paths_expands_directories_and_globs_and_batches_mkdir(tmp_path, mocker, capsys):
+    import upload_pipeline
+    (tmp_path / "dist" / "lib" / "deep").mkdir(parents=True)
+    (tmp_path / "dist" / "app.bin").write_bytes(b"a" * 10)
+    (tmp_path / "dist" / "lib" / "core.so").write_bytes(b"b" * 20)
+    (tmp_path / "dist" / "lib" / "deep" / "x.dat").write_bytes(b"c" * 30)
+    (tmp_path / "one.whl").write_bytes(b"d" * 40)
+    (tmp_path / "two.whl").write_bytes(b"e" * 50)
+    (tmp_path / "notes.txt").write_bytes(b"skip")
+    mocker.patch("logger.logger.log_info")
+
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    sftp.getcwd.return_value = '/home/user'
+    ssh = mocker.Mock(spec=paramiko.SSHClient)
+    ssh.exec_command.side_effect = lambda command: _exec_result()
+    ssh.open_sftp.return_value = sftp
+    mocker.patch("upload_pipeline.SCAN_WORKERS", 2)
+
+    assert upload_pipeline.upload_paths(sftp, str(tmp_path), ["dist", "*.whl", "missing.txt"], "release",
+                                        ssh, workers=3) is True
+
+    uploaded = {call.args[1]: call.args[0] for call in sftp.put.call_args_list}
+    assert sorted(uploaded) == ['release/dist/app.bin', 'release/dist/lib/core.so', 'release/dist/lib/deep/x.dat',
+                                'release/one.whl', 'release/two.whl']
+    assert uploaded['release/dist/lib/deep/x.dat'] == str(tmp_path / "dist" / "lib" / "deep" / "x.dat")
+
+    mkdirs = [call.args[0] for call in ssh.exec_command.call_args_list if call.args[0].startswith('mkdir')]
+    created = [path for command in mkdirs for path in command.split()[3:]]
+    assert sorted(created) == ['/home/user/release', '/home/user/release/dist', '/home/user/release/dist/lib',
+                               '/home/user/release/dist/lib/deep']
+    assert len(mkdirs) <= 4
+    assert "Uploaded 5/5 files, 150 bytes" in capsys.readouterr().out
+
+def _tar_bytes(files):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = 1700000000
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+def test_get_multiple_fetches_small_files_in_one_tar_stream(tmp_path, mocker):
+    names = [f"f{number:02}.txt" for number in range(16)]
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    sftp.getcwd.return_value = '/home/user'
+    sftp.listdir_attr.return_value = [_remote_entry(name, stat.S_IFREG | 0o644, 5, 1700000000) for name in names]
+    members = {f"home/user/small/{name}": name.encode() for name in names[1:]}
+    ssh = mocker.Mock(spec=paramiko.SSHClient)
+    ssh.exec_command.side_effect = lambda command: (
+        _exec_result(_tar_bytes(members), status=2, errors=b"f00.txt: Permission denied")
+        if command.startswith('tar') else _exec_result())
+    ssh.open_sftp.return_value = sftp
+    mocker.patch("logger.logger.log_info")
+    mocker.patch("logger.logger.log_warning")
+    mocker.patch("sftp_client.get_download_folder_path", side_effect=lambda file: str(tmp_path / os.path.basename(file)))
+    sftp.get.side_effect = lambda remote, local, callback=None: open(local, 'wb').write(b"single")
+
+    assert get_multiple(sftp, [f"small/{name}" for name in names], ssh, workers=2) is True
+
+    tar_commands = [call.args[0] for call in ssh.exec_command.call_args_list if call.args[0].startswith('tar')]
+    assert tar_commands == ["tar -C / -cf - -- " + ' '.join(f"home/user/small/{name}" for name in names)]
+    # The file tar could not read falls back to SFTP
+    sftp.get.assert_called_once_with("small/f00.txt", str(tmp_path / "f00.txt"), callback=ANY)
+    assert (tmp_path / "f07.txt").read_bytes() == b"f07.txt"
+    assert (tmp_path / "f00.txt").read_bytes() == b"single"
+    assert os.path.getmtime(tmp_path / "f07.txt") == 1700000000
+
+def test_download_tar_resolves_relative_paths_against_login_directory(tmp_path, mocker):
+    import tar_batch
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    sftp.getcwd.return_value = None
+    sftp.normalize.return_value = '/home/user'
+    ssh = mocker.Mock(spec=paramiko.SSHClient)
+    ssh.exec_command.return_value = _exec_result(_tar_bytes({"home/user/notes/a.txt": b"a",
+                                                             "etc/motd": b"motd"}))
+
+    received = tar_batch.download_tar(sftp, ssh, ["notes/a.txt", "/etc/motd"],
+                                      lambda remote_path: str(tmp_path / os.path.basename(remote_path)))
+
+    assert ssh.exec_command.call_args[0][0] == "tar -C / -cf - -- home/user/notes/a.txt etc/motd"
+    sftp.normalize.assert_called_once_with('.')
+    assert received == {"notes/a.txt", "/etc/motd"}
+    assert (tmp_path / "a.txt").read_bytes() == b"a"
+
+def test_upload_paths_packs_small_files_into_tar(tmp_path, mocker):
+    import upload_pipeline
+    import tar_batch
+    (tmp_path / "site" / "css").mkdir(parents=True)
+    for number in range(20):
+        (tmp_path / "site" / f"page{number}.html").write_text(f"page {number}")
+    (tmp_path / "site" / "css" / "main.css").write_text("body {}")
+    (tmp_path / "site" / "video.mp4").write_bytes(b"v" * (tar_batch.SMALL_FILE_SIZE + 1))
+    mocker.patch("logger.logger.log_info")
+
+    sent = io.BytesIO()
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    sftp.getcwd.return_value = '/srv'
+    ssh = mocker.Mock(spec=paramiko.SSHClient)
+    ssh.open_sftp.return_value = sftp
+
+    def exec_command(command):
+        stdin, stdout, stderr = _exec_result()
+        stdin.write.side_effect = sent.write
+        return stdin, stdout, stderr
+    ssh.exec_command.side_effect = exec_command
+
+    assert upload_pipeline.upload_paths(sftp, str(tmp_path), ["site"], "www", ssh, workers=2) is True
+
+    sftp.put.assert_called_once_with(str(tmp_path / "site" / "video.mp4"), "www/site/video.mp4", callback=ANY)
+    assert "mkdir -p -- /srv/www && tar -xf - -C /srv/www" in [call.args[0] for call in ssh.exec_command.call_args_list]
+    with tarfile.open(fileobj=io.BytesIO(sent.getvalue())) as tar:
+        contents = {member.name: tar.extractfile(member).read() for member in tar}
+    assert len(contents) == 21
+    assert contents["site/css/main.css"] == b"body {}"
+    assert contents["site/page7.html"] == b"page 7"
+
+def test_put_file_uploads_large_files_from_memory_map(tmp_path, mocker):
+    data = os.urandom(3 * 1024 * 1024 + 123)
+    local = tmp_path / "image.iso"
+    local.write_bytes(data)
+    mocker.patch("sftp_client.MMAP_UPLOAD_THRESHOLD", 1024 * 1024)
+    mocker.patch("logger.logger.log_info")
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    remote_file = sftp.open.return_value = MagicMock()
+    remote_file.__enter__.return_value = remote_file
+    written = []
+    remote_file.write.side_effect = lambda chunk: written.append((type(chunk), bytes(chunk)))
+    sftp.stat.return_value = _remote_entry("image.iso", stat.S_IFREG | 0o644, len(data), 0)
+
+    put_file(sftp, str(local), "isos")
+
+    sftp.put.assert_not_called()
+    sftp.open.assert_called_once_with("isos/image.iso", 'wb')
+    remote_file.set_pipelined.assert_called_once_with(True)
+    assert all(kind is memoryview for kind, _ in written)
+    assert [len(chunk) for _, chunk in written] == [1024 * 1024] * 3 + [123]
+    assert b''.join(chunk for _, chunk in written) == data
+
+def test_explicit_large_file_transfers_skip_automatic_compression(tmp_path, mocker):
+    data = b'compressible line\n' * 1000
+    local = tmp_path / "report.csv"
+    local.write_bytes(data)
+    mocker.patch("logger.logger.log_info")
+    choose_download = mocker.patch("compression.choose_download", return_value=True)
+    choose_upload = mocker.patch("compression.choose_upload", return_value=True)
+    ssh = mocker.Mock(spec=paramiko.SSHClient)
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    remote_file = sftp.open.return_value = MagicMock()
+    remote_file.__enter__.return_value = remote_file
+    remote_file.readv.side_effect = lambda chunks, window: (data[offset:offset + length] for offset, length in chunks)
+    sftp.stat.return_value = _remote_entry("report.csv", stat.S_IFREG | 0o644, len(data), 0)
+    mocker.patch("sftp_client.get_download_folder_path", return_value=str(tmp_path / "copy.csv"))
+
+    assert get_file(sftp, "report.csv", large_file=True, ssh=ssh) is True
+    put_file(sftp, str(local), "reports", ssh=ssh, large_file=True)
+
+    choose_download.assert_not_called()
+    choose_upload.assert_not_called()
+    ssh.exec_command.assert_not_called()
+    assert (tmp_path / "copy.csv").read_bytes() == data
+    # the small file still went through the memory map
+    sftp.put.assert_not_called()
+    remote_file.set_pipelined.assert_called_once_with(True)
+
+def test_remote_command_available_probes_once_per_transport(mocker):
+    transport = mocker.Mock()
+    first = mocker.Mock(spec=paramiko.SSHClient)
+    second = mocker.Mock(spec=paramiko.SSHClient)
+    first.get_transport.return_value = second.get_transport.return_value = transport
+    first.exec_command.return_value = _exec_result(b'/usr/bin/gzip\n')
+
+    assert remote_command_available(first, 'gzip') is True
+    assert remote_command_available(second, 'gzip') is True
+    first.exec_command.assert_called_once()
+    second.exec_command.assert_not_called()
+
+def test_transfer_is_held_to_the_lowest_limit():
+    limiter = rate_limit.RateLimiter()
+    limiter.set_global_rate(8 * 1024 * 1024)
+    start = time.monotonic()
+    with limiter.transfer(rate=4 * 1024 * 1024) as transfer:
+        for _ in range(32):
+            rate_limit.throttle(64 * 1024)
+    elapsed = time.monotonic() - start
+
+    assert transfer.bytes_done == 2 * 1024 * 1024
+    assert 0.4 <= elapsed < 1.5
+    assert limiter.transfers == []
+
+def test_fair_share_splits_alias_limit_between_transfers(mocker):
+    limiter = rate_limit.RateLimiter()
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    limiter.bind(sftp, "backup")
+    limiter.set_alias_rate("backup", 100 * 1024)
+    limiter.set_fair(True)
+    alias_limit = limiter.alias_limits["backup"]
+
+    with limiter.transfer(sftp) as first:
+        with limiter.transfer(sftp) as second:
+            assert alias_limit.bucket_for(first).rate == alias_limit.bucket_for(second).rate == 50 * 1024
+            limiter.set_alias_rate("backup", 200 * 1024)
+            assert alias_limit.bucket_for(first).rate == 100 * 1024
+        assert alias_limit.bucket_for(first).rate == 200 * 1024
+    assert rate_limit.parse_rate("1.5M") == 1.5 * 1024 * 1024
+    assert rate_limit.parse_rate("off") is None
+
+def test_scheduler_keeps_jobs_across_restarts_and_runs_by_priority(tmp_path, mocker):
+    mocker.patch("logger.logger.log_info")
+    mocker.patch("connection_storage.connection_info.list_available_connection_names", return_value=[])
+    path = str(tmp_path / "jobs.db")
+    first = TransferScheduler(path)
+    low = first.enqueue(GET, "web", "/srv/a.txt", "/tmp/a.txt")
+    high = first.enqueue(PUT, "web", "/tmp/b.txt", "/srv/b.txt", priority=5)
+    other = first.enqueue(GET, "db", "/srv/c.txt", "/tmp/c.txt")
+    first.set_host_concurrency("web", 1)
+    first._database().execute("UPDATE jobs SET status = 'running' WHERE id = ?", (low,))
+    first._database().commit()
+    first.shutdown()
+
+    scheduler = TransferScheduler(path)
+    assert [job.id for job in scheduler.jobs()] == [high, low, other]
+    assert all(job.status == QUEUED for job in scheduler.jobs())
+    ssh = mocker.Mock(spec=paramiko.SSHClient)
+    scheduler.register_host("web", ssh)
+    with scheduler._lock:
+        claimed = scheduler._claim()
+        # one transfer at a time for web, and db has no session
+        assert scheduler._claim() is None
+    assert claimed.id == high and claimed.attempts == 1
+    assert scheduler.pause(low) == 1
+    assert scheduler.cancel(other) == 1
+    assert {job.id: job.status for job in scheduler.jobs(include_finished=True)} == {
+        high: RUNNING, low: PAUSED, other: CANCELLED}
+
+def test_scheduler_reads_aliases_once_and_waits_only_for_retries(tmp_path, mocker):
+    mocker.patch("logger.logger.log_info")
+    aliases = mocker.patch("connection_storage.connection_info.list_available_connection_names",
+                           return_value=["backup"])
+    scheduler = TransferScheduler(str(tmp_path / "jobs.db"))
+    job_id = scheduler.enqueue(GET, "web", "/srv/a.txt", "/tmp/a.txt")
+    with scheduler._lock:
+        for _ in range(3):
+            assert scheduler._claim() is None
+        # nothing is waiting for a retry, so an idle worker sleeps until notified
+        assert scheduler._next_retry() is None
+    assert aliases.call_count == 1
+
+    scheduler.register_host("web", mocker.Mock(spec=paramiko.SSHClient))
+    assert aliases.call_count == 2
+    with scheduler._lock:
+        job = scheduler._claim()
+    scheduler._finish(job, QUEUED, "timeout", not_before=time.time() + 30)
+    with scheduler._lock:
+        assert 29 < scheduler._next_retry() <= 30
+    assert scheduler.job(job_id).status == QUEUED
+    scheduler.shutdown()
+
+def test_scheduler_workers_download_and_pause_running_jobs(tmp_path, mocker):
+    mocker.patch("logger.logger.log_info")
+    mocker.patch("connection_storage.connection_info.list_available_connection_names", return_value=[])
+    sftp = mocker.Mock(spec=paramiko.SFTPClient)
+    sftp.stat.return_value = _remote_entry("a.bin", stat.S_IFREG | 0o644, 4 * 64 * 1024, 0)
+    ssh = mocker.Mock(spec=paramiko.SSHClient)
+    ssh.open_sftp.return_value = sftp
+    started = threading.Event()
+
+    def download(channel, src, dest):
+        with open(dest, 'wb') as local_file:
+            for _ in range(4):
+                if src.endswith('slow.bin'):
+                    started.set()
+                    time.sleep(0.1)
+                rate_limit.throttle(64 * 1024)
+                local_file.write(b'x' * 64 * 1024)
+    mocker.patch("sftp_client.download_resumable", side_effect=download)
+    scheduler = TransferScheduler(str(tmp_path / "jobs.db"), workers=2)
+    scheduler.register_host("web", ssh)
+    done = scheduler.enqueue(GET, "web", "/srv/a.bin", str(tmp_path / "a.bin"))
+    slow = scheduler.enqueue(GET, "web", "/srv/slow.bin", str(tmp_path / "slow.bin"))
+    scheduler.start()
+    try:
+        assert started.wait(5)
+        assert scheduler.pause(slow) == 1
+        deadline = time.monotonic() + 5
+        while any(job.status in (QUEUED, RUNNING) for job in scheduler.jobs()) and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        scheduler.shutdown()
+
+    assert scheduler.job(done).status == DONE
+    assert scheduler.job(slow).status == PAUSED
+    assert (tmp_path / "a.bin").stat().st_size == 4 * 64 * 1024
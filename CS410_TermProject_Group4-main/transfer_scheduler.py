@@ -0,0 +1,505 @@
+import atexit
+import os
+import posixpath
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+import paramiko
+
+import rate_limit
+import sftp_client
+from connection_pool import connection_pool
+from connection_storage import connection_info
+from logger import logger
+from remote_cache import listing_cache
+
+# File the job queue is kept in, so queued transfers survive a restart.
+JOBS_DATABASE = 'transfer_jobs.db'
+# Transfers running at the same time over all hosts.
+DEFAULT_SCHEDULER_WORKERS = 8
+# Transfers running at the same time against one host, unless set for
+# the host with set_host_concurrency.
+DEFAULT_HOST_CONCURRENCY = 4
+# Attempts of a job before it is marked failed.
+MAX_ATTEMPTS = 3
+# Seconds before a failed attempt is retried, times the attempts so far.
+RETRY_DELAY = 5.0
+# Seconds shutdown waits for running transfers to stop.
+SHUTDOWN_TIMEOUT = 5.0
+
+GET = 'get'
+PUT = 'put'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+PAUSED = 'paused'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+FINISHED = (DONE, FAILED, CANCELLED)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    host TEXT NOT NULL,
+    source TEXT NOT NULL,
+    destination TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    rate_limit REAL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL DEFAULT 0,
+    total_bytes INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_priority ON jobs (status, priority DESC, id);
+CREATE TABLE IF NOT EXISTS hosts (
+    host TEXT PRIMARY KEY,
+    concurrency INTEGER NOT NULL
+);
+"""
+
+class Job:
+    """
+    One queued transfer as stored in the jobs table.  host is a stored
+    connection alias or the key a logged on session was registered under;
+    source and destination are absolute local or remote paths.
+    """
+
+    def __init__(self, row):
+        self.id = row['id']
+        self.kind = row['kind']
+        self.host = row['host']
+        self.source = row['source']
+        self.destination = row['destination']
+        self.priority = row['priority']
+        self.rate_limit = row['rate_limit']
+        self.status = row['status']
+        self.attempts = row['attempts']
+        self.total_bytes = row['total_bytes']
+        self.error = row['error']
+        # bytes moved by the running attempt
+        self.bytes_done = 0
+
+    # One line status such as
+    # "   7 running   p5 get backup:/srv/a.iso -> /home/me/downloads/a.iso 45% of 2.0 GB".
+    def describe(self) -> str:
+        line = (f"{self.id:>4} {self.status:<9} p{self.priority:<3} {self.kind} "
+                f"{self.host}:{self.source if self.kind == GET else self.destination} "
+                f"{'->' if self.kind == GET else '<-'} {self.destination if self.kind == GET else self.source}")
+        if self.status == RUNNING and self.total_bytes:
+            line += f" {min(100, 100 * self.bytes_done // self.total_bytes)}% of {_format_size(self.total_bytes)}"
+        if self.rate_limit:
+            line += f" limit {rate_limit.format_rate(self.rate_limit)}"
+        if self.error and self.status != DONE:
+            line += f" ({self.error})"
+        return line
+
+def _format_size(num_bytes) -> str:
+    for unit, size in (('GB', 1024 ** 3), ('MB', 1024 ** 2), ('KB', 1024)):
+        if num_bytes >= size:
+            return f"{num_bytes / size:.1f} {unit}"
+    return f"{num_bytes} B"
+
+class TransferScheduler:
+    """
+    Runs queued downloads and uploads in the background.  Jobs are kept in
+    a SQLite database and run highest priority first (oldest first within
+    a priority) on a pool of worker threads, at most the host's concurrency
+    at a time against one host.  Transfers are resumable (see
+    sftp_client.download_resumable), so a job stopped by pause, a failure
+    or the end of the program continues where it left off; jobs that were
+    running when the program ended are queued again on the next start.
+
+    Jobs for a stored connection alias can run at any time, the scheduler
+    connects through the connection pool.  Other hosts only run while a
+    session registered with register_host is alive.
+    """
+
+    def __init__(self, path: str = JOBS_DATABASE, workers: int = DEFAULT_SCHEDULER_WORKERS,
+                 host_concurrency: int = DEFAULT_HOST_CONCURRENCY):
+        self.path = path
+        self.workers = max(1, workers)
+        self.host_concurrency = host_concurrency
+        self._db = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._threads = []
+        self._stopping = False
+        # host -> SSHClient of a logged on session
+        self._sessions = {}
+        # Stored connection aliases, read from connection_info when jobs are
+        # queued or hosts registered rather than on every claim.
+        self._aliases = None
+        # job id -> [host, rate_limit.Transfer or None until it starts]
+        self._running = {}
+        # job id -> status a stopped running job is left in
+        self._stop_as = {}
+
+    # The database connection, created with the tables on first use.  Jobs
+    # marked running were interrupted by the end of the last run.
+    def _database(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.row_factory = sqlite3.Row
+            self._db.executescript(_SCHEMA)
+            with self._db:
+                self._db.execute("UPDATE jobs SET status = ? WHERE status = ?", (QUEUED, RUNNING))
+        return self._db
+
+    # Queue a transfer and return its job id.
+    #   - kind: GET (source remote, destination local) or PUT (the reverse)
+    #   - host: stored connection alias or registered session key
+    #   - priority: higher runs first
+    #   - limit: bytes per second for the transfer (see rate_limit)
+    def enqueue(self, kind: str, host: str, source: str, destination: str, priority: int = 0,
+                limit: float = None) -> int:
+        if kind not in (GET, PUT):
+            raise ValueError(f"Unknown transfer kind {kind}, use {GET} or {PUT}")
+        now = time.time()
+        aliases = self._load_aliases()
+        with self._lock:
+            self._aliases = aliases
+            with self._database() as db:
+                job_id = db.execute(
+                    "INSERT INTO jobs (kind, host, source, destination, priority, rate_limit, status, created, updated) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (kind, host, source, destination, priority, limit, QUEUED, now, now)).lastrowid
+            self._wakeup.notify()
+        logger.log_info(f"Queued job {job_id}: {kind} {source} -> {destination} on {host} (priority {priority})")
+        return job_id
+
+    # Jobs ordered the way they run, finished ones only with
+    # include_finished.
+    def jobs(self, include_finished: bool = False) -> list:
+        with self._lock:
+            query = "SELECT * FROM jobs"
+            if not include_finished:
+                query += f" WHERE status NOT IN ({', '.join('?' * len(FINISHED))})"
+            rows = self._database().execute(query + " ORDER BY priority DESC, id",
+                                            () if include_finished else FINISHED).fetchall()
+            jobs = [Job(row) for row in rows]
+            for job in jobs:
+                transfer = self._running.get(job.id, [None, None])[1]
+                if transfer is not None:
+                    job.bytes_done = transfer.bytes_done
+        return jobs
+
+    def job(self, job_id: int):
+        with self._lock:
+            row = self._database().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return Job(row) if row is not None else None
+
+    # Pause a job, or every unfinished job when job_id is None.  Running
+    # transfers stop at their next block and keep what they transferred.
+    # Returns the number of jobs paused.
+    def pause(self, job_id: int = None) -> int:
+        return self._stop(job_id, PAUSED, (QUEUED, RUNNING))
+
+    # Cancel a job, or every unfinished job when job_id is None.  Partial
+    # files of cancelled transfers are removed.  Returns the number of jobs
+    # cancelled.
+    def cancel(self, job_id: int = None) -> int:
+        return self._stop(job_id, CANCELLED, (QUEUED, RUNNING, PAUSED))
+
+    # Queue paused and failed jobs again, one or all (job_id None).
+    # Returns the number of jobs queued.
+    def resume(self, job_id: int = None) -> int:
+        aliases = self._load_aliases()
+        with self._lock:
+            self._aliases = aliases
+            with self._database() as db:
+                count = db.execute(
+                    f"UPDATE jobs SET status = ?, attempts = 0, not_before = 0, updated = ? "
+                    f"WHERE status IN (?, ?){' AND id = ?' if job_id is not None else ''}",
+                    (QUEUED, time.time(), PAUSED, FAILED) + ((job_id,) if job_id is not None else ())).rowcount
+            self._wakeup.notify_all()
+        return count
+
+    def set_priority(self, job_id: int, priority: int) -> bool:
+        with self._lock:
+            with self._database() as db:
+                return db.execute("UPDATE jobs SET priority = ?, updated = ? WHERE id = ?",
+                                  (priority, time.time(), job_id)).rowcount > 0
+
+    # Run at most concurrency transfers against host at a time; None goes
+    # back to DEFAULT_HOST_CONCURRENCY.  Kept with the jobs.
+    def set_host_concurrency(self, host: str, concurrency: int = None) -> None:
+        with self._lock:
+            with self._database() as db:
+                if concurrency is None:
+                    db.execute("DELETE FROM hosts WHERE host = ?", (host,))
+                else:
+                    db.execute("INSERT OR REPLACE INTO hosts (host, concurrency) VALUES (?, ?)",
+                               (host, max(1, concurrency)))
+            self._wakeup.notify_all()
+
+    def host_concurrency_of(self, host: str) -> int:
+        with self._lock:
+            return self._concurrency(host)
+
+    # Delete finished jobs.  Returns how many were deleted.
+    def clear_finished(self) -> int:
+        with self._lock:
+            with self._database() as db:
+                return db.execute(f"DELETE FROM jobs WHERE status IN ({', '.join('?' * len(FINISHED))})",
+                                  FINISHED).rowcount
+
+    # Let jobs for host run over the transport of a logged on session.
+    def register_host(self, host: str, ssh: paramiko.SSHClient) -> None:
+        aliases = self._load_aliases()
+        with self._lock:
+            self._aliases = aliases
+            self._sessions[host] = ssh
+            self._wakeup.notify_all()
+
+    # Start the worker threads, if not running yet.
+    def start(self) -> None:
+        with self._lock:
+            self._database()
+            self._stopping = False
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name=f"transfer-job-{len(self._threads)}", daemon=True)
+                self._threads.append(thread)
+                thread.start()
+
+    # Stop the workers.  Running transfers are queued again and continue
+    # on the next start.
+    def shutdown(self, timeout: float = SHUTDOWN_TIMEOUT) -> None:
+        with self._lock:
+            self._stopping = True
+            for job_id, (_, transfer) in self._running.items():
+                self._stop_as.setdefault(job_id, QUEUED)
+                if transfer is not None:
+                    transfer.stop()
+            self._wakeup.notify_all()
+            threads, self._threads = self._threads, []
+        deadline = time.monotonic() + timeout
+        for thread in threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        with self._lock:
+            if self._db is not None and not self._running:
+                self._db.close()
+                self._db = None
+
+    def _stop(self, job_id, status: str, from_statuses) -> int:
+        with self._lock:
+            db = self._database()
+            query = f"SELECT id, status FROM jobs WHERE status IN ({', '.join('?' * len(from_statuses))})"
+            parameters = tuple(from_statuses)
+            if job_id is not None:
+                query += " AND id = ?"
+                parameters += (job_id,)
+            count = 0
+            with db:
+                for row in db.execute(query, parameters).fetchall():
+                    count += 1
+                    if row['id'] in self._running:
+                        # The worker records the status once the transfer stops.
+                        self._stop_as[row['id']] = status
+                        transfer = self._running[row['id']][1]
+                        if transfer is not None:
+                            transfer.stop()
+                    else:
+                        db.execute("UPDATE jobs SET status = ?, updated = ? WHERE id = ?",
+                                   (status, time.time(), row['id']))
+        return count
+
+    def _concurrency(self, host: str) -> int:
+        row = self._database().execute("SELECT concurrency FROM hosts WHERE host = ?", (host,)).fetchone()
+        return row['concurrency'] if row is not None else self.host_concurrency
+
+    # Stored connection aliases, read outside the lock since the keyring
+    # can be slow.  A failed read counts as no aliases.
+    def _load_aliases(self) -> set:
+        try:
+            return set(connection_info.list_available_connection_names())
+        except Exception as e:
+            logger.log_warning(f"Could not read the stored connections: {e}")
+            return set()
+
+    # Hosts jobs can run against now: live registered sessions and stored
+    # connections.  Called with the lock held.
+    def _available_hosts(self) -> set:
+        if self._aliases is None:
+            self._aliases = self._load_aliases()
+        hosts = set(self._aliases)
+        for host, ssh in self._sessions.items():
+            transport = ssh.get_transport()
+            if transport is not None and transport.is_active():
+                hosts.add(host)
+        return hosts
+
+    # Mark the next runnable job running and return it, or None.  Called
+    # with the lock held.
+    def _claim(self):
+        db = self._database()
+        now = time.time()
+        running = Counter(host for host, _ in self._running.values())
+        available = self._available_hosts()
+        full = set()
+        for row in db.execute("SELECT * FROM jobs WHERE status = ? AND not_before <= ? ORDER BY priority DESC, id",
+                              (QUEUED, now)):
+            host = row['host']
+            if host not in available or host in full:
+                continue
+            if running[host] >= self._concurrency(host):
+                full.add(host)
+                continue
+            with db:
+                db.execute("UPDATE jobs SET status = ?, attempts = attempts + 1, updated = ? WHERE id = ?",
+                           (RUNNING, now, row['id']))
+            self._running[row['id']] = [host, None]
+            job = Job(row)
+            job.status = RUNNING
+            job.attempts += 1
+            return job
+        return None
+
+    # Seconds until the next queued job waiting for a retry comes due, or
+    # None when none is waiting.  Called with the lock held.
+    def _next_retry(self):
+        row = self._database().execute("SELECT MIN(not_before) AS due FROM jobs WHERE status = ? AND not_before > ?",
+                                       (QUEUED, time.time())).fetchone()
+        return None if row['due'] is None else max(0.0, row['due'] - time.time())
+
+    def _work(self) -> None:
+        # host -> (this worker's SFTP channel, the ssh it is leased on)
+        channels = {}
+        try:
+            while True:
+                with self._lock:
+                    job = None
+                    while not self._stopping:
+                        job = self._claim()
+                        if job is not None:
+                            break
+                        # Queued jobs, registered hosts and finished jobs
+                        # notify; only retries need a timeout.
+                        self._wakeup.wait(self._next_retry())
+                    if job is None:
+                        return
+                self._run(job, channels)
+        finally:
+            for host in list(channels):
+                self._drop_channel(host, channels)
+
+    # An SFTP channel to host for the calling worker, connecting to stored
+    # aliases through the connection pool when there is no live session.
+    # The worker holds a pool lease on the transport while it keeps the
+    # channel, so the pool never closes it under a running transfer.
+    def _channel(self, host: str, channels: dict) -> paramiko.SFTPClient:
+        if host in channels:
+            return channels[host][0]
+        with self._lock:
+            ssh = self._sessions.get(host)
+        transport = ssh.get_transport() if ssh is not None else None
+        if transport is not None and transport.is_active():
+            connection_pool.acquire(ssh)
+        else:
+            sftp, ssh = connection_pool.connect_alias(host)
+            if sftp is None:
+                raise ConnectionError(f"Could not connect to {host}")
+            # Only the transport is needed, every worker opens its own channel.
+            sftp_client.disconnect_sftp(sftp)
+        try:
+            channel = ssh.open_sftp()
+        except Exception:
+            connection_pool.release(ssh)
+            raise
+        channels[host] = (channel, ssh)
+        return channel
+
+    # Close the worker's channel to host and release its transport.
+    def _drop_channel(self, host: str, channels: dict) -> None:
+        channel, ssh = channels.pop(host, (None, None))
+        if channel is not None:
+            sftp_client.disconnect_sftp(channel)
+            connection_pool.release(ssh)
+
+    def _run(self, job: Job, channels: dict) -> None:
+        channel = None
+        try:
+            channel = self._channel(job.host, channels)
+            size = channel.stat(job.source).st_size if job.kind == GET else os.path.getsize(job.source)
+            self._update(job, total_bytes=size)
+            with rate_limit.rate_limiter.transfer(channel, job.rate_limit) as transfer:
+                with self._lock:
+                    self._running[job.id][1] = transfer
+                    if job.id in self._stop_as:
+                        transfer.stop()
+                if job.kind == GET:
+                    os.makedirs(os.path.dirname(job.destination) or '.', exist_ok=True)
+                    sftp_client.download_resumable(channel, job.source, job.destination)
+                else:
+                    try:
+                        sftp_client.upload_resumable(channel, job.source, job.destination)
+                    finally:
+                        listing_cache.invalidate(channel, job.destination)
+            logger.log_info(f"Job {job.id} finished: {job.kind} {job.source} -> {job.destination}")
+            self._finish(job, DONE)
+        except rate_limit.TransferStopped:
+            with self._lock:
+                status = self._stop_as.get(job.id, QUEUED)
+            if status == CANCELLED:
+                self._discard_partial(job, channel)
+            logger.log_info(f"Job {job.id} {'queued again' if status == QUEUED else status}")
+            self._finish(job, status)
+        except Exception as e:
+            # The channel may be broken, the next attempt opens a new one.
+            self._drop_channel(job.host, channels)
+            logger.log_error(f"Job {job.id} ({job.kind} {job.source}) failed, attempt {job.attempts}: {e}")
+            if job.attempts >= MAX_ATTEMPTS:
+                self._finish(job, FAILED, str(e))
+            else:
+                self._finish(job, QUEUED, str(e), not_before=time.time() + RETRY_DELAY * job.attempts)
+
+    def _update(self, job: Job, **columns) -> None:
+        assignments = ', '.join(f"{column} = ?" for column in columns)
+        with self._lock:
+            with self._database() as db:
+                db.execute(f"UPDATE jobs SET {assignments}, updated = ? WHERE id = ?",
+                           tuple(columns.values()) + (time.time(), job.id))
+
+    def _finish(self, job: Job, status: str, error: str = None, not_before: float = 0) -> None:
+        with self._lock:
+            self._running.pop(job.id, None)
+            # A job paused or cancelled while failing stays paused or cancelled.
+            requested = self._stop_as.pop(job.id, None)
+            if requested is not None and status != DONE:
+                status = requested
+            with self._database() as db:
+                db.execute("UPDATE jobs SET status = ?, error = ?, not_before = ?, updated = ? WHERE id = ?",
+                           (status, error, not_before, time.time(), job.id))
+            self._wakeup.notify_all()
+
+    # Remove what a cancelled transfer left behind.
+    def _discard_partial(self, job: Job, channel: paramiko.SFTPClient) -> None:
+        try:
+            if job.kind == GET:
+                sftp_client._remove_journal(sftp_client.download_journal_path(job.destination))
+                if os.path.exists(job.destination):
+                    os.remove(job.destination)
+            else:
+                sftp_client._remove_journal(sftp_client.upload_journal_path(job.destination))
+                channel.remove(job.destination)
+        except (IOError, OSError) as e:
+            logger.log_warning(f"Could not remove the partial file of job {job.id}: {e}")
+
+# Absolute form of a remote path typed in a session, so the job means the
+# same file on the scheduler's own channels.
+def remote_path_for(sftp: paramiko.SFTPClient, path: str) -> str:
+    cwd = sftp.getcwd()
+    if posixpath.isabs(path) or not isinstance(cwd, str):
+        return path
+    return posixpath.join(cwd, path)
+
+scheduler = TransferScheduler()
+atexit.register(scheduler.shutdown)
@@ -0,0 +1,265 @@
+import glob
+import os
+import posixpath
+import queue
+import shlex
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import paramiko
+
+import rate_limit
+import sftp_client
+import tar_batch
+from logger import logger
+from remote_cache import listing_cache
+
+# Files uploaded at the same time.
+DEFAULT_UPLOAD_WORKERS = 8
+# Local directories scanned at the same time.
+SCAN_WORKERS = 4
+# Scanned files waiting for an uploader at most; scanning pauses when the
+# uploads fall this far behind.
+UPLOAD_QUEUE_SIZE = 1000
+# Directories created per mkdir -p command at most.
+MKDIR_BATCH_SIZE = 200
+
+class RemoteDirectories:
+    """
+    Creates remote directories on demand.  Directories are announced with
+    add() while the local tree is scanned, and the first upload that needs
+    one of them creates every announced directory not created yet: with
+    ssh in one "mkdir -p" per MKDIR_BATCH_SIZE directories, otherwise with
+    one SFTP mkdir per missing directory on the channel given to ensure().
+    """
+
+    def __init__(self, sftp: paramiko.SFTPClient, ssh: paramiko.SSHClient = None):
+        self.sftp = sftp
+        self.use_exec = ssh is not None and sftp_client.remote_command_available(ssh, 'mkdir')
+        self.ssh = ssh
+        self.created = set()
+        self.pending = []
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def add(self, remote_dir: str) -> None:
+        with self._lock:
+            if remote_dir not in self.created:
+                self.pending.append(remote_dir)
+
+    # Make sure remote_dir exists, creating the pending directories with it.
+    # channel is the caller's SFTP channel, used when there is no ssh.
+    def ensure(self, remote_dir: str, channel: paramiko.SFTPClient = None) -> None:
+        if remote_dir in ('', '.', '/') or remote_dir in self.created:
+            return
+        with self._lock:
+            if remote_dir in self.created:
+                return
+            batch = [path for path in dict.fromkeys(self.pending + [remote_dir]) if path not in self.created]
+            self.pending = []
+            if self.use_exec:
+                for first in range(0, len(batch), MKDIR_BATCH_SIZE):
+                    self._mkdir_exec(batch[first:first + MKDIR_BATCH_SIZE])
+            else:
+                for path in batch:
+                    self._mkdir_sftp(channel or self.sftp, path)
+            self.created.update(batch)
+
+    def _mkdir_exec(self, paths) -> None:
+        quoted = ' '.join(shlex.quote(sftp_client.exec_path(self.sftp, path)) for path in paths)
+        stdin, stdout, stderr = self.ssh.exec_command(f"mkdir -p -- {quoted}")
+        self.requests += 1
+        sftp_client._check_exit_status(stdout, stderr, "mkdir")
+
+    # Create path and any missing parents, like mkdir -p.
+    def _mkdir_sftp(self, channel: paramiko.SFTPClient, path: str) -> None:
+        if path in self.created:
+            return
+        parent = posixpath.dirname(path.rstrip('/'))
+        if parent not in ('', '.', '/'):
+            self._mkdir_sftp(channel, parent)
+        try:
+            channel.stat(path)
+        except IOError:
+            self.requests += 1
+            channel.mkdir(path)
+        self.created.add(path)
+
+# Resolve sources (file names, directories and glob patterns, relative to
+# local_dir) into the (local path, path relative to the upload) pairs to
+# start from.  Directories keep their name at the destination.
+def expand_sources(local_dir: str, sources) -> list:
+    expanded = []
+    for source in sources:
+        source = source.strip()
+        if not source:
+            continue
+        pattern = os.path.join(local_dir, source)
+        matches = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(source) else [pattern]
+        if not matches or not any(os.path.exists(match) for match in matches):
+            logger.log_warning(f"No files match {pattern}.")
+            continue
+        for match in matches:
+            relative_path = os.path.relpath(match, local_dir)
+            if relative_path.startswith(os.pardir):
+                relative_path = os.path.basename(os.path.normpath(match))
+            expanded.append((match, relative_path.replace(os.sep, '/')))
+    return expanded
+
+# Upload files, directories and glob patterns under local_dir into
+# remote_dir.  Directories are scanned on SCAN_WORKERS threads while the
+# first files already upload on `workers` SFTP channels; remote
+# directories are created as uploads reach them.  With ssh and tar on the
+# server, small files are packed TAR_BATCH_FILES at a time into tar streams
+# (see tar_batch) instead of being put one by one.  Prints a throughput
+# report and returns True if every file was uploaded.
+#   - limit: bytes per second for each file or tar stream (see rate_limit)
+def upload_paths(sftp: paramiko.SFTPClient, local_dir: str, sources, remote_dir: str,
+                 ssh: paramiko.SSHClient = None, workers: int = DEFAULT_UPLOAD_WORKERS,
+                 limit: float = None) -> bool:
+    if sftp is None:
+        raise ValueError("No client STFP object provided.")
+    workers = max(1, workers)
+    directories = RemoteDirectories(sftp, ssh)
+    channels = sftp_client.WorkerChannels(sftp, ssh)
+    files = queue.Queue(maxsize=UPLOAD_QUEUE_SIZE)
+    lock = threading.Lock()
+    stats = {'scanned': 0, 'uploaded': 0, 'bytes': 0}
+    failed = []
+    outstanding = [0]
+    scan_done = threading.Event()
+    scan_pool = ThreadPoolExecutor(max_workers=SCAN_WORKERS, thread_name_prefix='upload-scan')
+    use_tar = tar_batch.available(ssh)
+    # small files waiting for a full tar batch
+    small = []
+
+    def remote_path_of(relative_path):
+        return posixpath.join(remote_dir, relative_path)
+
+    def queue_file(local_path, relative_path, size):
+        batch = None
+        with lock:
+            stats['scanned'] += 1
+            if use_tar and tar_batch.is_small(size):
+                small.append((local_path, relative_path, size))
+                if len(small) < tar_batch.TAR_BATCH_FILES:
+                    return
+                batch = small[:]
+                small.clear()
+        files.put(batch or (local_path, relative_path, size))
+
+    def submit_scan(local_path, relative_path):
+        with lock:
+            outstanding[0] += 1
+        directories.add(remote_path_of(relative_path))
+        scan_pool.submit(scan, local_path, relative_path)
+
+    # Queue the files of one directory and hand its subdirectories to the
+    # other scanners.
+    def scan(local_path, relative_path):
+        try:
+            with os.scandir(local_path) as entries:
+                for entry in entries:
+                    child = posixpath.join(relative_path, entry.name)
+                    if entry.is_dir(follow_symlinks=False):
+                        submit_scan(entry.path, child)
+                    elif entry.is_file():
+                        queue_file(entry.path, child, entry.stat().st_size)
+        except OSError as e:
+            logger.log_warning(f"Could not scan {local_path}: {e}")
+        finally:
+            with lock:
+                outstanding[0] -= 1
+                finished = outstanding[0] == 0
+            if finished:
+                scan_done.set()
+
+    def upload_worker():
+        while True:
+            item = files.get()
+            if item is None:
+                return
+            if isinstance(item, list):
+                upload_batch(item)
+            else:
+                upload_file(*item)
+
+    def upload_batch(batch):
+        try:
+            with rate_limit.rate_limiter.transfer(sftp, limit):
+                tar_batch.upload_tar(sftp, ssh,
+                                     [(local_path, relative_path) for local_path, relative_path, _ in batch],
+                                     remote_dir)
+        except Exception as e:
+            logger.log_warning(f"tar upload failed, putting the files one by one: {e}")
+            for item in batch:
+                upload_file(*item)
+            return
+        logger.log_info(f"Uploaded {len(batch)} files to {remote_dir} in one tar stream.")
+        with lock:
+            stats['uploaded'] += len(batch)
+            stats['bytes'] += sum(size for _, _, size in batch)
+            print(f"[{stats['uploaded']}/{stats['scanned']}] {len(batch)} small files in one tar stream")
+
+    def upload_file(local_path, relative_path, size):
+        remote_path = remote_path_of(relative_path)
+        try:
+            with channels.use() as channel:
+                directories.ensure(posixpath.dirname(remote_path), channel)
+                with rate_limit.rate_limiter.transfer(channel, limit):
+                    channel.put(local_path, remote_path, callback=rate_limit.callback())
+            logger.log_info(f"Uploaded {local_path} to {remote_path}.")
+            with lock:
+                stats['uploaded'] += 1
+                stats['bytes'] += size
+                print(f"[{stats['uploaded']}/{stats['scanned']}] {relative_path}")
+        except Exception as e:
+            with lock:
+                failed.append(relative_path)
+            logger.log_error(f"Failed to upload {local_path}: {e}")
+
+    start = time.monotonic()
+    uploaders = [threading.Thread(target=upload_worker, name=f"upload-{number}", daemon=True)
+                 for number in range(workers)]
+    for thread in uploaders:
+        thread.start()
+    try:
+        with lock:
+            # Held until every source is handed out so the scan can not
+            # look finished while it is still starting.
+            outstanding[0] += 1
+        for local_path, relative_path in expand_sources(local_dir, sources):
+            if os.path.isdir(local_path):
+                submit_scan(local_path, relative_path)
+            elif os.path.isfile(local_path):
+                queue_file(local_path, relative_path, os.path.getsize(local_path))
+        with lock:
+            outstanding[0] -= 1
+            if outstanding[0] == 0:
+                scan_done.set()
+        scan_done.wait()
+        if len(small) >= tar_batch.MIN_TAR_FILES:
+            files.put(small[:])
+        else:
+            for item in small:
+                files.put(item)
+    finally:
+        scan_pool.shutdown(wait=True)
+        for _ in uploaders:
+            files.put(None)
+        for thread in uploaders:
+            thread.join()
+        channels.close()
+        listing_cache.invalidate(sftp, remote_dir, subtree=True)
+
+    elapsed = time.monotonic() - start
+    summary = (f"Uploaded {stats['uploaded']}/{stats['scanned']} files, {stats['bytes']} bytes in {elapsed:.2f}s "
+               f"({sftp_client.format_throughput(stats['bytes'], elapsed)}, "
+               f"{stats['uploaded'] / elapsed if elapsed > 0 else 0:.1f} files/s) using {workers} workers, "
+               f"{len(directories.created)} remote directories in {directories.requests} requests")
+    print(summary)
+    logger.log_info(summary)
+    if failed:
+        logger.log_error(f"Failed to upload: {', '.join(failed)}")
+    return not failed